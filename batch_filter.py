@@ -0,0 +1,118 @@
+import logging
+from itertools import repeat
+
+from .metadata_filter import CompiledMetadataFilter, FilterCondition
+from .exceptions import ConditionPairProcessingException
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class BatchFilterResult:
+
+    def __init__(self, mask: list, errors: dict):
+        self._mask = mask
+        self._errors = errors
+
+    @property
+    def mask(self) -> list:
+        return self._mask
+
+    @property
+    def errors(self) -> dict:
+        return self._errors
+
+    def __len__(self):
+        return len(self._mask)
+
+
+class BatchMetadataFilter:
+
+    NUMERIC_TYPES = (int, float)
+
+    def __init__(self, compiled: CompiledMetadataFilter, use_numpy: bool = True):
+        self._compiled = compiled
+        self._use_numpy = use_numpy and numpy is not None
+
+    def _extract_column(self, condition: FilterCondition, results: list, rows: list, errors: dict) -> tuple:
+        try:
+            return rows, [condition.get_value(results[r]) for r in rows]
+        except Exception:
+            logging.debug('Unable to extract column for {} in one pass - falling back to per-row'.format(condition))
+        column_rows = []
+        column = []
+        for r in rows:
+            try:
+                column.append(condition.get_value(results[r]))
+            except Exception as e:
+                errors[r] = e
+            else:
+                column_rows.append(r)
+        return column_rows, column
+
+    @staticmethod
+    def _wrap_pair_exception(exception: Exception, value_left, operator_name: str, value_right) -> Exception:
+        wrapped = ConditionPairProcessingException(value_left, operator_name, value_right)
+        wrapped.__cause__ = exception
+        return wrapped
+
+    def _convert_column(self, rows: list, column: list, predicate: tuple, errors: dict) -> tuple:
+        operator_name, operator_func, value_right, value_type = predicate
+        try:
+            return list(range(len(column))), list(map(value_type, column))
+        except Exception:
+            logging.debug('Unable to convert column to {} in one pass - falling back to per-row'.format(value_type))
+        positions = []
+        typed_column = []
+        for n, value in enumerate(column):
+            try:
+                typed_column.append(value_type(value))
+            except ValueError as e:
+                errors[rows[n]] = self._wrap_pair_exception(e, value, operator_name, value_right)
+            except Exception as e:
+                errors[rows[n]] = e
+            else:
+                positions.append(n)
+        return positions, typed_column
+
+    def _compare_column(self, rows: list, column: list, predicate: tuple, errors: dict) -> list:
+        operator_name, operator_func, value_right, value_type = predicate
+        if self._use_numpy and value_type in self.NUMERIC_TYPES:
+            try:
+                return operator_func(numpy.asarray(column, dtype=value_type), value_right).tolist()
+            except (OverflowError, TypeError, ValueError):
+                logging.debug('Unable to compare column as an array - falling back to per-row')
+        try:
+            return list(map(operator_func, column, repeat(value_right)))
+        except Exception:
+            logging.debug('Unable to compare column in one pass - falling back to per-row')
+        passed = []
+        for r, value in zip(rows, column):
+            try:
+                passed.append(operator_func(value, value_right))
+            except Exception as e:
+                errors[r] = self._wrap_pair_exception(e, value, operator_name, value_right)
+                passed.append(False)
+        return passed
+
+    def evaluate(self, results: list) -> BatchFilterResult:
+        errors = {}
+        alive = list(range(len(results)))
+        for condition in self._compiled.conditions:
+            if not alive:
+                break
+            rows, column = self._extract_column(condition, results, alive, errors)
+            for predicate in condition.predicates:
+                positions, typed_column = self._convert_column(rows, column, predicate, errors)
+                passed = self._compare_column([rows[p] for p in positions], typed_column, predicate, errors)
+                kept = [p for p, ok in zip(positions, passed) if ok]
+                rows = [rows[p] for p in kept]
+                column = [column[p] for p in kept]
+            alive = rows
+            logging.debug('{} row(s) left after {}'.format(len(alive), condition))
+        mask = [False] * len(results)
+        for r in alive:
+            mask[r] = True
+        return BatchFilterResult(mask, errors)
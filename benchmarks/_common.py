@@ -0,0 +1,38 @@
+import importlib
+import importlib.util
+import json
+import os
+import sys
+import time
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PACKAGE_NAME = 'pyffwrapper'
+
+
+def load_package():
+    if PACKAGE_NAME not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            PACKAGE_NAME, os.path.join(ROOT_DIR, '__init__.py'), submodule_search_locations=[ROOT_DIR]
+        )
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[PACKAGE_NAME] = module
+        spec.loader.exec_module(module)
+    return sys.modules[PACKAGE_NAME]
+
+
+def import_module(name: str):
+    load_package()
+    return importlib.import_module('{}.{}'.format(PACKAGE_NAME, name))
+
+
+def timed(func: callable, *args, **kwargs) -> tuple:
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def dump_results(results: dict) -> None:
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
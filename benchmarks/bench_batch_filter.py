@@ -0,0 +1,95 @@
+import argparse
+import random
+
+from _common import import_module, timed, dump_results
+
+
+FILTER_PARAMS = {
+    'format': {
+        'format_name': ['neq', 'avi'],
+        'duration': [['gte', 5.0], ['lt', 3600.0]],
+    },
+    'stream:v:0': {
+        'codec_name': 'mpeg2video',
+        'width': ['gte', 1280],
+        'height': 1080,
+    },
+    'count:a': ['gte', 2],
+}
+
+
+def make_info(rnd: random.Random) -> dict:
+    return {
+        'format': {
+            'format_name': rnd.choice(['mxf', 'mov,mp4,m4a,3gp,3g2,mj2', 'avi']),
+            'duration': rnd.choice(['{:.6f}'.format(rnd.uniform(1, 7200)), 'N/A']),
+            'size': str(rnd.randint(10 ** 6, 10 ** 10)),
+        },
+        'streams': [
+            {
+                'index': 0,
+                'codec_type': 'video',
+                'codec_name': rnd.choice(['mpeg2video', 'h264', 'dvvideo']),
+                'width': rnd.choice([720, 1280, 1920]),
+                'height': rnd.choice([576, 720, 1080]),
+            }
+        ] + [
+            {'index': n + 1, 'codec_type': 'audio', 'codec_name': 'pcm_s24le', 'channels': 1}
+            for n in range(rnd.randint(0, 8))
+        ]
+    }
+
+
+def run_per_file(compiled, results: list) -> tuple:
+    mask = []
+    errors = {}
+    for n, r in enumerate(results):
+        try:
+            mask.append(compiled(r))
+        except Exception as e:
+            mask.append(False)
+            errors[n] = e
+    return mask, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-file vs batch metadata filter evaluation')
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-numpy', action='store_true')
+    args = parser.parse_args()
+
+    metadata_collector = import_module('metadata_collector')
+    metadata_filter = import_module('metadata_filter')
+    batch_filter = import_module('batch_filter')
+
+    rnd = random.Random(args.seed)
+    results = [
+        metadata_collector.FFprobeMetadataResult('/media/{}.mxf'.format(n), make_info(rnd), None)
+        for n in range(args.count)
+    ]
+    compiled = metadata_filter.MetadataFilterCompiler().compile(FILTER_PARAMS)
+    batch = batch_filter.BatchMetadataFilter(compiled, use_numpy=not args.no_numpy)
+
+    per_file_time, (per_file_mask, per_file_errors) = timed(run_per_file, compiled, results)
+    batch_time, batch_result = timed(batch.evaluate, results)
+
+    if per_file_mask != batch_result.mask:
+        raise AssertionError('Batch mask differs from per-file results')
+    if {n: type(e) for n, e in per_file_errors.items()} != {n: type(e) for n, e in batch_result.errors.items()}:
+        raise AssertionError('Batch errors differ from per-file results')
+
+    dump_results({
+        'benchmark': 'batch_filter',
+        'count': args.count,
+        'numpy': batch_filter.numpy is not None and not args.no_numpy,
+        'passed': sum(per_file_mask),
+        'errors': len(per_file_errors),
+        'per_file_seconds': per_file_time,
+        'batch_seconds': batch_time,
+        'speedup': per_file_time / batch_time,
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import argparse
+import os
+import statistics
+import time
+
+from _common import import_module, dump_results
+
+
+def allocate_rss(size_mb: int) -> bytearray:
+    ballast = bytearray(size_mb * 1024 * 1024)
+    for n in range(0, len(ballast), 4096):
+        ballast[n] = 1
+    return ballast
+
+
+def open_fds(count: int) -> list:
+    return [os.open(os.devnull, os.O_RDONLY) for _ in range(count)]
+
+
+def measure(launcher, args: list, spawns: int) -> dict:
+    samples = []
+    for _ in range(spawns):
+        start = time.perf_counter()
+        proc = launcher.run(args)
+        samples.append(time.perf_counter() - start)
+        if proc.returncode != 0:
+            raise RuntimeError('"{}" exited with code {}'.format(' '.join(args), proc.returncode))
+    ordered = sorted(samples)
+    return {
+        'mean': statistics.mean(samples),
+        'p50': statistics.median(samples),
+        'p95': ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+        'total': sum(samples),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Process spawn latency of the available launchers')
+    parser.add_argument('--spawns', type=int, default=200)
+    parser.add_argument('--rss-mb', type=int, default=1024)
+    parser.add_argument('--fds', type=int, default=1000)
+    parser.add_argument('--command', nargs='+', default=['/bin/true'])
+    args = parser.parse_args()
+
+    launcher = import_module('launcher')
+
+    fork_server = launcher.ForkServerLauncher()
+    ballast = allocate_rss(args.rss_mb)
+    fds = open_fds(args.fds)
+    results = {
+        'benchmark': 'launcher',
+        'spawns': args.spawns,
+        'rss_mb': args.rss_mb,
+        'open_fds': args.fds,
+        'command': args.command,
+    }
+    try:
+        for name, instance in (('subprocess', launcher.SubprocessLauncher()),
+                               ('posix_spawn', launcher.PosixSpawnLauncher()),
+                               ('fork_server', fork_server)):
+            results[name] = measure(instance, args.command, args.spawns)
+    finally:
+        fork_server.close()
+        for fd in fds:
+            os.close(fd)
+        del ballast
+    for name in ('posix_spawn', 'fork_server'):
+        results['{}_speedup'.format(name)] = results['subprocess']['mean'] / results[name]['mean']
+    dump_results(results)
+
+
+if __name__ == '__main__':
+    main()
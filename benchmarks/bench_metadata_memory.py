@@ -0,0 +1,155 @@
+import argparse
+import gc
+import json
+import random
+import tracemalloc
+
+from _common import import_module, timed, dump_results
+
+
+def make_info_json(rnd: random.Random) -> str:
+    v_codec, pix_fmt = rnd.choice([('mpeg2video', 'yuv422p'), ('h264', 'yuv420p'), ('dvvideo', 'yuv411p')])
+    info = {
+        'format': {
+            'filename': '/media/{}.mxf'.format(rnd.getrandbits(64)),
+            'nb_streams': 0,
+            'format_name': rnd.choice(['mxf', 'mov,mp4,m4a,3gp,3g2,mj2']),
+            'format_long_name': 'MXF (Material eXchange Format)',
+            'start_time': '0.000000',
+            'duration': '{:.6f}'.format(rnd.uniform(1, 7200)),
+            'size': str(rnd.randint(10 ** 6, 10 ** 10)),
+            'bit_rate': str(rnd.randint(10 ** 6, 10 ** 8)),
+            'probe_score': 100,
+            'tags': {'operational_pattern_ul': '060e2b34.04010101.0d010201.01010900', 'company_name': 'ACME'},
+        },
+        'streams': [{
+            'index': 0,
+            'codec_name': v_codec,
+            'codec_long_name': 'MPEG-2 video',
+            'profile': '4:2:2',
+            'codec_type': 'video',
+            'codec_tag_string': '[0][0][0][0]',
+            'codec_tag': '0x0000',
+            'width': 1920,
+            'height': 1080,
+            'coded_width': 1920,
+            'coded_height': 1088,
+            'has_b_frames': 1,
+            'sample_aspect_ratio': '1:1',
+            'display_aspect_ratio': '16:9',
+            'pix_fmt': pix_fmt,
+            'level': 2,
+            'color_range': 'tv',
+            'field_order': 'tt',
+            'r_frame_rate': '25/1',
+            'avg_frame_rate': '25/1',
+            'time_base': '1/25',
+            'start_pts': 0,
+            'start_time': '0.000000',
+            'duration': '{:.6f}'.format(rnd.uniform(1, 7200)),
+            'bit_rate': '50000000',
+            'disposition': {'default': 0, 'dub': 0, 'original': 0, 'comment': 0, 'lyrics': 0, 'karaoke': 0},
+        }],
+    }
+    for n in range(rnd.randint(2, 8)):
+        info['streams'].append({
+            'index': n + 1,
+            'codec_name': 'pcm_s24le',
+            'codec_long_name': 'PCM signed 24-bit little-endian',
+            'codec_type': 'audio',
+            'codec_tag_string': '[0][0][0][0]',
+            'codec_tag': '0x0000',
+            'sample_fmt': 's32',
+            'sample_rate': '48000',
+            'channels': 1,
+            'bits_per_sample': 24,
+            'r_frame_rate': '0/0',
+            'avg_frame_rate': '0/0',
+            'time_base': '1/48000',
+            'start_pts': 0,
+            'start_time': '0.000000',
+            'bit_rate': '1152000',
+            'disposition': {'default': 0, 'dub': 0, 'original': 0, 'comment': 0, 'lyrics': 0, 'karaoke': 0},
+        })
+    info['format']['nb_streams'] = len(info['streams'])
+    return json.dumps(info)
+
+
+class RawMetadataResult:
+
+    def __init__(self, input_url: str, info: dict):
+        self._input_url = input_url
+        self._info = info
+
+    @property
+    def v_streams(self) -> dict:
+        return {s['index']: s for s in self._info['streams'] if s['codec_type'] == 'video'}
+
+    @property
+    def a_streams(self) -> dict:
+        return {s['index']: s for s in self._info['streams'] if s['codec_type'] == 'audio'}
+
+
+def measure(build: callable, documents: list) -> tuple:
+    gc.collect()
+    tracemalloc.start()
+    build_time, results = timed(build, documents)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return results, current, peak, build_time
+
+
+def access(results: list, rounds: int) -> int:
+    total = 0
+    for _ in range(rounds):
+        for r in results:
+            total += len(r.a_streams) + len(r.v_streams)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory footprint of raw vs compact metadata results')
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    metadata_collector = import_module('metadata_collector')
+
+    rnd = random.Random(args.seed)
+    documents = [make_info_json(rnd) for _ in range(args.count)]
+
+    raw, raw_current, raw_peak, raw_build = measure(
+        lambda d: [RawMetadataResult('/media/{}.mxf'.format(n), json.loads(i)) for n, i in enumerate(d)], documents
+    )
+    raw_access, _ = timed(access, raw, args.rounds)
+    del raw
+
+    compact, compact_current, compact_peak, compact_build = measure(
+        lambda d: [
+            metadata_collector.FFprobeMetadataResult('/media/{}.mxf'.format(n), json.loads(i), None)
+            for n, i in enumerate(d)
+        ],
+        documents
+    )
+    compact_access, _ = timed(access, compact, args.rounds)
+
+    dump_results({
+        'benchmark': 'metadata_memory',
+        'count': args.count,
+        'rounds': args.rounds,
+        'raw_bytes': raw_current,
+        'raw_peak_bytes': raw_peak,
+        'raw_build_seconds': raw_build,
+        'raw_access_seconds': raw_access,
+        'compact_bytes': compact_current,
+        'compact_peak_bytes': compact_peak,
+        'compact_build_seconds': compact_build,
+        'compact_access_seconds': compact_access,
+        'memory_ratio': raw_current / compact_current,
+        'access_speedup': raw_access / compact_access,
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,384 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from _common import ROOT_DIR, import_module, timed
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STUB_DIR = os.path.join(BENCH_DIR, 'stubs')
+
+FIXTURE_DIR = os.path.join(BENCH_DIR, 'fixtures')
+
+FIXTURES = ('hd_tff_mxf', 'sd_progressive_mov', 'hd_mixed_mp4')
+
+FILTER_PARAMS = {
+    'format': {
+        'format_name': ['neq', 'avi'],
+        'duration': [['gte', 5.0], ['lt', 36000.0]],
+    },
+    'stream:v:0': {
+        'width': ['gte', 720],
+        'field_mode': ['neq', 0],
+    },
+    'count:a': ['gte', 1],
+}
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name: str):
+    def _register(func):
+        BENCHMARKS[name] = func
+        return func
+    return _register
+
+
+class Workspace:
+
+    def __init__(self, root: str):
+        self.root = root
+        self.input_dir = os.path.join(root, 'inputs')
+        self.output_dir = os.path.join(root, 'outputs')
+        self.tmp_dir = os.path.join(root, 'tmp')
+        for d in (self.input_dir, self.output_dir, self.tmp_dir):
+            os.makedirs(d)
+        self._count = 0
+
+    def make_inputs(self, count: int, fixtures: tuple=FIXTURES) -> list:
+        paths = []
+        for n in range(count):
+            fixture = fixtures[n % len(fixtures)]
+            path = os.path.join(self.input_dir, '{}_{:06d}.bin'.format(fixture, self._count))
+            with open(path, 'w') as f:
+                json.dump({'fixture': fixture}, f)
+            paths.append(path)
+            self._count += 1
+        return paths
+
+    def make_output_path(self, ext: str='.mp4') -> str:
+        self._count += 1
+        return os.path.join(self.output_dir, 'out_{:06d}{}'.format(self._count, ext))
+
+
+def summarize(samples: list) -> dict:
+    ordered = sorted(samples)
+    return OrderedDict([
+        ('n', len(samples)),
+        ('mean', statistics.mean(samples)),
+        ('median', statistics.median(samples)),
+        ('p95', ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))]),
+        ('min', ordered[0]),
+        ('max', ordered[-1]),
+        ('stdev', statistics.stdev(samples) if len(samples) > 1 else 0.0),
+    ])
+
+
+def spawn_stub(name: str, args: list, env: dict=None) -> float:
+    start = time.perf_counter()
+    subprocess.run([os.path.join(STUB_DIR, name)] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                   env=env, check=False)
+    return time.perf_counter() - start
+
+
+@benchmark('ffprobe')
+def bench_ffprobe(ctx, args) -> dict:
+    ffprobe = import_module('ffprobe')
+    urls = ctx.workspace.make_inputs(args.iterations)
+    baseline = [spawn_stub('ffprobe', ['-show_format', '-show_streams', '-show_programs', u]) for u in urls]
+    cmd = ffprobe.FFprobeInfoCommand(ctx.ffprobe_path, ctx.probe_timeout)
+    cold = []
+    cached = []
+    for u in urls:
+        cmd_args = cmd._build_args(u)
+        cold.append(timed(cmd._exec, cmd_args, u)[0])
+        cached.append(timed(cmd._exec, cmd_args, u)[0])
+    return {'stub_spawn_ffprobe': baseline, 'ffprobe_exec_cold': cold, 'ffprobe_exec_cached': cached}
+
+
+@benchmark('field_mode')
+def bench_field_mode(ctx, args) -> dict:
+    field_mode_solver = import_module('field_mode_solver')
+    solver = ctx.factory.ffprobe_factory.get_ffprobe_field_mode_solver(field_mode_solver.FFprobeFieldModeSolver)
+    results = {}
+    for fixture in FIXTURES:
+        with open(os.path.join(FIXTURE_DIR, '{}.json'.format(fixture))) as f:
+            duration = float(json.load(f)['info']['format']['duration'])
+        samples = []
+        for u in ctx.workspace.make_inputs(args.iterations, (fixture, )):
+            samples.append(timed(solver.solve, u, 0, duration)[0])
+        results['field_mode_solve:{}'.format(fixture)] = samples
+    return results
+
+
+@benchmark('metadata_filter')
+def bench_metadata_filter(ctx, args) -> dict:
+    metadata_filter = import_module('metadata_filter')
+    f = ctx.factory.ffprobe_factory.get_ffprobe_metadata_filter(metadata_filter.FFprobeMetadataFilter)
+    compiled = f.compile(FILTER_PARAMS)
+    cold = [timed(f.filter, u, FILTER_PARAMS)[0] for u in ctx.workspace.make_inputs(args.iterations)]
+    warm_url = ctx.workspace.make_inputs(1)[0]
+    f.filter(warm_url, compiled)
+    warm = [timed(f.filter, warm_url, compiled)[0] for n in range(args.iterations * 10)]
+    return {'metadata_filter_cold': cold, 'metadata_filter_cached': warm}
+
+
+@benchmark('profiles')
+def bench_profiles(ctx, args) -> dict:
+    metadata_collector = import_module('metadata_collector')
+    profile_loader = import_module('profile_loader')
+    profile_data_provider = import_module('profile_data_provider')
+    profile_data_parser = import_module('profile_data_parser')
+    collector = ctx.factory.ffprobe_factory.get_ffprobe_metadata_collector(metadata_collector.FFprobeMetadataCollector)
+
+    metas = []
+    for u in ctx.workspace.make_inputs(args.iterations):
+        meta = collector.get_metadata(u)
+        meta.get_field_mode(0)
+        metas.append(meta)
+
+    results = {}
+    provider = profile_data_provider.JinjaProfileDataProvider()
+    parser = profile_data_parser.JsonProfileDataParser()
+    loaders = (
+        ('profile_render', profile_loader.ProfileLoader(provider, parser, memo_size=0)),
+        ('profile_memo', profile_loader.ProfileLoader(provider, parser)),
+    )
+    for profile_name in sorted(os.listdir(os.path.join(ROOT_DIR, 'ff_profiles'))):
+        for prefix, loader in loaders:
+            samples = []
+            for meta in metas:
+                context = {'input': meta, 'vars': {}}
+                samples.append(timed(loader.get_profile, profile_name, context=context)[0])
+            results['{}:{}'.format(prefix, profile_name)] = samples
+    return results
+
+
+@benchmark('ffmpeg_progress')
+def bench_ffmpeg_progress(ctx, args) -> dict:
+    ffmpeg = import_module('ffmpeg')
+    cmd = ffmpeg.FFmpegBaseCommand(ctx.ffmpeg_path, ctx.workspace.tmp_dir)
+    env = dict(os.environ, PYFF_STUB_FRAMES=str(args.frames))
+    os.environ['PYFF_STUB_FRAMES'] = str(args.frames)
+    try:
+        url = ctx.workspace.make_inputs(1)[0]
+        baseline = [spawn_stub('ffmpeg', [], env) for n in range(args.iterations)]
+        baseline_pipe = [spawn_stub('ffmpeg', ['-progress', 'pipe:1'], env) for n in range(args.iterations)]
+        stats = []
+        pipe = []
+        for n in range(args.iterations):
+            stats.append(timed(cmd.exec, [([], url)], [([], ctx.workspace.make_output_path())], False)[0])
+            pipe.append(timed(cmd.exec, [([], url)], [([], ctx.workspace.make_output_path())], False, None, True)[0])
+    finally:
+        del os.environ['PYFF_STUB_FRAMES']
+    return {
+        'stub_spawn_ffmpeg_stats': baseline,
+        'stub_spawn_ffmpeg_progress': baseline_pipe,
+        'ffmpeg_exec_stats': stats,
+        'ffmpeg_exec_progress_pipe': pipe,
+    }
+
+
+@benchmark('result_store')
+def bench_result_store(ctx, args) -> dict:
+    ffmpeg = import_module('ffmpeg')
+    result_store = import_module('result_store')
+    store = result_store.TranscodeResultStore(os.path.join(ctx.workspace.root, 'results'), 1024 ** 3)
+    cmd = ffmpeg.FFmpegBaseCommand(ctx.ffmpeg_path, ctx.workspace.tmp_dir, result_store=store)
+    os.environ['PYFF_STUB_FRAMES'] = str(args.frames)
+    try:
+        urls = ctx.workspace.make_inputs(args.iterations)
+        cold = [timed(cmd.exec, [([], u)], [([], ctx.workspace.make_output_path())], False)[0] for u in urls]
+        hit = [timed(cmd.exec, [([], u)], [([], ctx.workspace.make_output_path())], False)[0] for u in urls]
+    finally:
+        del os.environ['PYFF_STUB_FRAMES']
+        store.close()
+    hits, misses, total, ratio = store.get_stats()
+    ctx.extra['result_store'] = {'hits': hits, 'misses': misses, 'ratio': ratio}
+    return {'ffmpeg_exec_result_store_miss': cold, 'ffmpeg_exec_result_store_hit': hit}
+
+
+@benchmark('soak')
+def bench_soak(ctx, args) -> dict:
+    metadata_filter = import_module('metadata_filter')
+    ffmpeg = import_module('ffmpeg')
+    f = ctx.factory.ffprobe_factory.get_ffprobe_metadata_filter(metadata_filter.FFprobeMetadataFilter)
+    compiled = f.compile(FILTER_PARAMS)
+    cmd = ffmpeg.FFmpegBaseCommand(ctx.ffmpeg_path, ctx.workspace.tmp_dir)
+    urls = ctx.workspace.make_inputs(args.soak_jobs)
+    errors = []
+
+    def _job(url):
+        start = time.perf_counter()
+        if f.filter(url, compiled):
+            cmd.exec([([], url)], [([], ctx.workspace.make_output_path())], False)
+        return time.perf_counter() - start
+
+    os.environ['PYFF_STUB_FRAMES'] = '50'
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.soak_jobs) as executor:
+            futures = [executor.submit(_job, u) for u in urls]
+        latencies = []
+        for future in futures:
+            try:
+                latencies.append(future.result())
+            except Exception as e:
+                errors.append(repr(e))
+        wall = time.perf_counter() - start
+    finally:
+        del os.environ['PYFF_STUB_FRAMES']
+    ctx.extra['soak'] = {'jobs': args.soak_jobs, 'errors': len(errors), 'wall_seconds': wall,
+                         'jobs_per_second': args.soak_jobs / wall, 'first_errors': errors[:5]}
+    return {'soak_job_latency': latencies} if latencies else {}
+
+
+@benchmark('pipeline')
+def bench_pipeline(ctx, args) -> dict:
+    pipeline = import_module('pipeline')
+    profile_loader = import_module('profile_loader')
+    profile_data_provider = import_module('profile_data_provider')
+    profile_data_parser = import_module('profile_data_parser')
+    watch_dir = os.path.join(ctx.workspace.root, 'watch')
+    os.makedirs(watch_dir)
+    loader = profile_loader.ProfileLoader(
+        profile_data_provider.JinjaProfileDataProvider(), profile_data_parser.JsonProfileDataParser()
+    )
+    routes = [pipeline.PipelineRoute('x264_540.json', FILTER_PARAMS)]
+    finished = []
+    depth = {}
+    os.environ['PYFF_STUB_FRAMES'] = '50'
+    try:
+        p = pipeline.WatchFolderPipeline(
+            watch_dir, routes, ctx.workspace.output_dir, loader, workers={'probe': 4, 'encode': 4},
+            settle_time=0.2, poll_interval=0.05, callback=finished.append
+        )
+        start = time.perf_counter()
+        for n in range(args.pipeline_files):
+            with open(os.path.join(watch_dir, 'in_{:06d}.bin'.format(n)), 'w') as f:
+                json.dump({'fixture': FIXTURES[n % len(FIXTURES)]}, f)
+        while len(finished) < args.pipeline_files and time.perf_counter() - start < args.probe_timeout:
+            for name, s in p.get_stats()['stages'].items():
+                depth[name] = max(depth.get(name, 0), s['queue_depth'] + s['busy'])
+            time.sleep(0.05)
+        wall = time.perf_counter() - start
+        stats = p.get_stats()
+        p.shutdown()
+    finally:
+        del os.environ['PYFF_STUB_FRAMES']
+    ctx.extra['pipeline'] = {'files': args.pipeline_files, 'finished': stats['finished'], 'wall_seconds': wall,
+                             'files_per_second': len(finished) / wall, 'max_in_flight': depth}
+    latencies = [i.latency for i in finished if i.latency is not None]
+    return {'pipeline_item_latency': latencies} if latencies else {}
+
+
+class Context:
+
+    def __init__(self, workspace: Workspace, probe_timeout: int):
+        self.workspace = workspace
+        self.probe_timeout = probe_timeout
+        self.ffprobe_path = os.path.join(STUB_DIR, 'ffprobe')
+        self.ffmpeg_path = os.path.join(STUB_DIR, 'ffmpeg')
+        self.factory = import_module('factory')
+        self.factory.ffprobe_factory = self.factory.FFprobeFactory(self.ffprobe_path, probe_timeout)
+        self.factory.ffmpeg_factory = self.factory.FFmpegFactory(self.ffmpeg_path, workspace.tmp_dir)
+        self.extra = {}
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> dict:
+    comparison = OrderedDict()
+    for name, summary in results.items():
+        base = baseline.get('results', {}).get(name)
+        if base is None or not base['median']:
+            continue
+        ratio = summary['median'] / base['median']
+        comparison[name] = {
+            'baseline_median': base['median'],
+            'median': summary['median'],
+            'ratio': ratio,
+            'regression': ratio > 1 + threshold,
+        }
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pyffwrapper benchmark suite (stub ffmpeg/ffprobe)')
+    parser.add_argument('--only', nargs='*', choices=list(BENCHMARKS), help='benchmarks to run (default: all)')
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--frames', type=int, default=5000, help='frames emitted by the ffmpeg stub')
+    parser.add_argument('--soak-jobs', type=int, default=300)
+    parser.add_argument('--pipeline-files', type=int, default=200)
+    parser.add_argument('--probe-timeout', type=int, default=120)
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    parser.add_argument('--compare', help='baseline JSON produced by a previous run')
+    parser.add_argument('--threshold', type=float, default=0.1, help='median slowdown treated as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args()
+
+    os.environ.setdefault('PYFF_STUB_FIXTURES', FIXTURE_DIR)
+    root = tempfile.mkdtemp(prefix='pyffwrapper_bench_')
+    try:
+        ctx = Context(Workspace(root), args.probe_timeout)
+        results = OrderedDict()
+        for name in args.only or BENCHMARKS:
+            sys.stderr.write('Running {}...\n'.format(name))
+            for result_name, samples in BENCHMARKS[name](ctx, args).items():
+                results[result_name] = summarize(samples)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    report = OrderedDict([
+        ('meta', OrderedDict([
+            ('commit', get_commit()),
+            ('timestamp', time.time()),
+            ('python', platform.python_version()),
+            ('platform', platform.platform()),
+            ('cpu_count', os.cpu_count()),
+            ('iterations', args.iterations),
+            ('frames', args.frames),
+        ])),
+        ('results', results),
+        ('extra', ctx.extra),
+    ])
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            report['comparison'] = compare(results, json.load(f), args.threshold)
+        regressions = [n for n, c in report['comparison'].items() if c['regression']]
+        for n, c in report['comparison'].items():
+            sys.stderr.write('{:60s} {:10.6f} -> {:10.6f} ({:+.1%}){}\n'.format(
+                n, c['baseline_median'], c['median'], c['ratio'] - 1, '  REGRESSION' if c['regression'] else ''
+            ))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
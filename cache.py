@@ -1,43 +1,688 @@
+import asyncio
 import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
 from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import Future
+
+from .metrics import track_cache
+from .exceptions import CacheNamespaceConflictException
 
 
 class CacheMissException(RuntimeWarning):
     pass
 
 
+class _CacheShard:
+
+    __slots__ = ('lock', 'items', 'flights', 'size', 'hits', 'misses', 'evictions', 'coalesced')
+
+    def __init__(self, size: int):
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.flights = {}
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+
+
+_MISSING = object()
+
+
 class HashCache:
 
-    def __init__(self, cache_size: int, logging_func: callable = None):
-        self._cache = OrderedDict()
+    SHARDS = 8
+
+    MIN_SHARD_SIZE = 8
+
+    def __init__(self, cache_size: int, logging_func: callable = None, name: str = None, shards: int = None):
+        shard_count = max(1, min(shards or self.SHARDS, cache_size // self.MIN_SHARD_SIZE))
+        self._shards = tuple(
+            _CacheShard(cache_size // shard_count + (1 if n < cache_size % shard_count else 0))
+            for n in range(shard_count)
+        )
         self._logging_func = logging_func
         self._cache_size = cache_size
-        self._cache_hits = 0
-        self._cache_misses = 0
+        self._name = name
+        if name is not None:
+            track_cache(name, self)
+
+    @property
+    def name(self) -> str:
+        return self._name
 
     @staticmethod
     def _get_hashed_id(item_id: str) -> str:
         return hashlib.sha1(item_id.encode()).hexdigest()
 
+    def _get_shard(self, hashed_id: str) -> _CacheShard:
+        return self._shards[int(hashed_id[:8], 16) % len(self._shards)]
+
+    def _log(self, msg: str) -> None:
+        if self._logging_func:
+            self._logging_func(msg)
+
+    @staticmethod
+    def _store(shard: _CacheShard, hashed_id: str, item) -> None:
+        shard.items[hashed_id] = item
+        if len(shard.items) > shard.size:
+            shard.items.popitem(last=False)
+            shard.evictions += 1
+
     def to_cache(self, item_id: str, item):
-        self._cache[self._get_hashed_id(item_id)] = item
-        if len(self._cache) > self._cache_size:
-            self._cache.popitem(last=False)
+        hashed_id = self._get_hashed_id(item_id)
+        shard = self._get_shard(hashed_id)
+        with shard.lock:
+            self._store(shard, hashed_id, item)
 
     def from_cache(self, item_id: str):
+        hashed_id = self._get_hashed_id(item_id)
+        shard = self._get_shard(hashed_id)
+        with shard.lock:
+            try:
+                value = shard.items[hashed_id]
+            except KeyError:
+                shard.misses += 1
+                hit = False
+            else:
+                shard.hits += 1
+                hit = True
+        if not hit:
+            self._log('Cache miss')
+            raise CacheMissException
+        self._log('Cache hit')
+        return value
+
+    def _join(self, hashed_id: str) -> tuple:
+        shard = self._get_shard(hashed_id)
+        with shard.lock:
+            try:
+                value = shard.items[hashed_id]
+            except KeyError:
+                pass
+            else:
+                shard.hits += 1
+                return value, None, False
+            flight = shard.flights.get(hashed_id)
+            if flight is not None:
+                shard.coalesced += 1
+                return _MISSING, flight, False
+            shard.misses += 1
+            flight = shard.flights[hashed_id] = Future()
+            return _MISSING, flight, True
+
+    def _land(self, hashed_id: str, flight: Future, value=_MISSING, exception: Exception = None) -> None:
+        shard = self._get_shard(hashed_id)
+        with shard.lock:
+            del shard.flights[hashed_id]
+            if value is not _MISSING:
+                self._store(shard, hashed_id, value)
+        if exception is not None:
+            flight.set_exception(exception)
+        else:
+            flight.set_result(value)
+
+    def get_or_compute(self, item_id: str, compute: callable):
+        hashed_id = self._get_hashed_id(item_id)
+        while True:
+            value, flight, leader = self._join(hashed_id)
+            if flight is None:
+                self._log('Cache hit')
+                return value
+            if not leader:
+                self._log('Waiting for in-flight computation')
+                value = flight.result()
+                if value is _MISSING:
+                    continue
+                return value
+            self._log('Cache miss')
+            try:
+                value = compute()
+            except Exception as e:
+                self._land(hashed_id, flight, exception=e)
+                raise
+            except BaseException:
+                self._land(hashed_id, flight)
+                raise
+            self._land(hashed_id, flight, value)
+            return value
+
+    async def get_or_compute_async(self, item_id: str, compute: callable):
+        hashed_id = self._get_hashed_id(item_id)
+        while True:
+            value, flight, leader = self._join(hashed_id)
+            if flight is None:
+                self._log('Cache hit')
+                return value
+            if not leader:
+                self._log('Waiting for in-flight computation')
+                value = await asyncio.shield(asyncio.wrap_future(flight))
+                if value is _MISSING:
+                    continue
+                return value
+            self._log('Cache miss')
+            try:
+                value = await compute()
+            except Exception as e:
+                self._land(hashed_id, flight, exception=e)
+                raise
+            except BaseException:
+                self._land(hashed_id, flight)
+                raise
+            self._land(hashed_id, flight, value)
+            return value
+
+    def get_stats(self):
+        cache_hits = sum(s.hits for s in self._shards)
+        total_requests = cache_hits + sum(s.misses for s in self._shards)
         try:
-            value = self._cache[self._get_hashed_id(item_id)]
-        except KeyError:
-            if self._logging_func:
-                self._logging_func('Cache miss')
-            self._cache_misses += 1
+            ratio = cache_hits / total_requests
+        except ZeroDivisionError:
+            ratio = 0.0
+        return cache_hits, total_requests - cache_hits, total_requests, ratio
+
+    def get_evictions(self) -> int:
+        return sum(s.evictions for s in self._shards)
+
+    def get_coalesced(self) -> int:
+        return sum(s.coalesced for s in self._shards)
+
+
+def estimate_size(value, _seen: set=None) -> int:
+    if _seen is None:
+        _seen = set()
+    if id(value) in _seen:
+        return 0
+    _seen.add(id(value))
+    size = sys.getsizeof(value)
+    t = type(value)
+    if t in (str, bytes, int, float, bool) or value is None:
+        return size
+    if isinstance(value, Mapping):
+        for k, v in value.items():
+            size += estimate_size(k, _seen) + estimate_size(v, _seen)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for v in value:
+            size += estimate_size(v, _seen)
+    return size
+
+
+class _NamespaceStats:
+
+    __slots__ = ('hits', 'misses', 'evictions', 'expirations', 'coalesced', 'entries', 'size')
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+        self.entries = 0
+        self.size = 0
+
+
+class _CacheEntry:
+
+    __slots__ = ('namespace', 'value', 'size', 'expires')
+
+    def __init__(self, namespace, value, size: int, expires: float):
+        self.namespace = namespace
+        self.value = value
+        self.size = size
+        self.expires = expires
+
+
+class _MemoryShard:
+
+    __slots__ = ('index', 'lock', 'items', 'flights', 'max_size', 'size')
+
+    def __init__(self, index: int, max_size: int):
+        self.index = index
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.flights = {}
+        self.max_size = max_size
+        self.size = 0
+
+
+class CacheNamespace:
+
+    def __init__(self, manager: 'CacheManager', name: str, ttl: float=None, sizer: callable=None,
+                 logging_func: callable=None):
+        self._manager = manager
+        self._name = name
+        self._ttl = ttl
+        self._sizer = sizer or estimate_size
+        self._logging_func = logging_func
+        self._stats = tuple(_NamespaceStats() for _ in manager.shards)
+        track_cache(name, self)
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def ttl(self) -> float:
+        return self._ttl
+
+    @property
+    def sizer(self) -> callable:
+        return self._sizer
+
+    def _log(self, msg: str) -> None:
+        if self._logging_func:
+            self._logging_func(msg)
+
+    def _get_entry_size(self, item_id: tuple, item) -> int:
+        return estimate_size(item_id) + self._sizer(item)
+
+    def _get_expires(self, ttl: float=None) -> float:
+        ttl = self._ttl if ttl is None else ttl
+        return time.monotonic() + ttl if ttl else None
+
+    def _get(self, shard: _MemoryShard, key: tuple):
+        entry = shard.items.get(key)
+        if entry is None:
+            return _MISSING
+        if entry.expires is not None and entry.expires <= time.monotonic():
+            self._manager._remove(shard, key)
+            self._stats[shard.index].expirations += 1
+            return _MISSING
+        shard.items.move_to_end(key)
+        return entry.value
+
+    def to_cache(self, item_id: tuple, item, ttl: float=None) -> None:
+        key = (self._name, item_id)
+        entry = _CacheEntry(self, item, self._get_entry_size(item_id, item), self._get_expires(ttl))
+        shard = self._manager._get_shard(key)
+        with shard.lock:
+            self._manager._store(shard, key, entry)
+
+    def from_cache(self, item_id: tuple):
+        key = (self._name, item_id)
+        shard = self._manager._get_shard(key)
+        with shard.lock:
+            value = self._get(shard, key)
+            if value is _MISSING:
+                self._stats[shard.index].misses += 1
+            else:
+                self._stats[shard.index].hits += 1
+        if value is _MISSING:
+            self._log('Cache miss')
             raise CacheMissException
+        self._log('Cache hit')
+        return value
+
+    def invalidate(self, item_id: tuple) -> None:
+        key = (self._name, item_id)
+        shard = self._manager._get_shard(key)
+        with shard.lock:
+            if key in shard.items:
+                self._manager._remove(shard, key)
+
+    def _join(self, key: tuple) -> tuple:
+        shard = self._manager._get_shard(key)
+        with shard.lock:
+            value = self._get(shard, key)
+            if value is not _MISSING:
+                self._stats[shard.index].hits += 1
+                return value, None, False
+            flight = shard.flights.get(key)
+            if flight is not None:
+                self._stats[shard.index].coalesced += 1
+                return _MISSING, flight, False
+            self._stats[shard.index].misses += 1
+            flight = shard.flights[key] = Future()
+            return _MISSING, flight, True
+
+    def _land(self, key: tuple, flight: Future, value=_MISSING, exception: Exception = None) -> None:
+        entry = None
+        if value is not _MISSING:
+            entry = _CacheEntry(self, value, self._get_entry_size(key[1], value), self._get_expires())
+        shard = self._manager._get_shard(key)
+        with shard.lock:
+            del shard.flights[key]
+            if entry is not None:
+                self._manager._store(shard, key, entry)
+        if exception is not None:
+            flight.set_exception(exception)
         else:
-            if self._logging_func:
-                self._logging_func('Cache hit')
-            self._cache_hits += 1
+            flight.set_result(value)
+
+    def get_or_compute(self, item_id: tuple, compute: callable):
+        key = (self._name, item_id)
+        while True:
+            value, flight, leader = self._join(key)
+            if flight is None:
+                self._log('Cache hit')
+                return value
+            if not leader:
+                self._log('Waiting for in-flight computation')
+                value = flight.result()
+                if value is _MISSING:
+                    continue
+                return value
+            self._log('Cache miss')
+            try:
+                value = compute()
+            except Exception as e:
+                self._land(key, flight, exception=e)
+                raise
+            except BaseException:
+                self._land(key, flight)
+                raise
+            self._land(key, flight, value)
+            return value
+
+    async def get_or_compute_async(self, item_id: tuple, compute: callable):
+        key = (self._name, item_id)
+        while True:
+            value, flight, leader = self._join(key)
+            if flight is None:
+                self._log('Cache hit')
+                return value
+            if not leader:
+                self._log('Waiting for in-flight computation')
+                value = await asyncio.shield(asyncio.wrap_future(flight))
+                if value is _MISSING:
+                    continue
+                return value
+            self._log('Cache miss')
+            try:
+                value = await compute()
+            except Exception as e:
+                self._land(key, flight, exception=e)
+                raise
+            except BaseException:
+                self._land(key, flight)
+                raise
+            self._land(key, flight, value)
             return value
 
+    def get_stats(self):
+        cache_hits = sum(s.hits for s in self._stats)
+        total_requests = cache_hits + sum(s.misses for s in self._stats)
+        try:
+            ratio = cache_hits / total_requests
+        except ZeroDivisionError:
+            ratio = 0.0
+        return cache_hits, total_requests - cache_hits, total_requests, ratio
+
+    def get_evictions(self) -> int:
+        return sum(s.evictions for s in self._stats)
+
+    def get_expirations(self) -> int:
+        return sum(s.expirations for s in self._stats)
+
+    def get_coalesced(self) -> int:
+        return sum(s.coalesced for s in self._stats)
+
+    def get_entry_count(self) -> int:
+        return sum(s.entries for s in self._stats)
+
+    def get_size(self) -> int:
+        return sum(s.size for s in self._stats)
+
+
+class CacheManager:
+
+    DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+    SHARDS = 8
+
+    MIN_SHARD_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, max_size: int=None, default_ttl: float=None, logging_func: callable=None,
+                 shards: int=None):
+        self._max_size = self.DEFAULT_MAX_SIZE if max_size is None else max_size
+        self._default_ttl = default_ttl
+        self._logging_func = logging_func
+        shard_count = max(1, min(shards or self.SHARDS, self._max_size // self.MIN_SHARD_SIZE))
+        self._shards = tuple(
+            _MemoryShard(n, self._max_size // shard_count + (1 if n < self._max_size % shard_count else 0))
+            for n in range(shard_count)
+        )
+        self._namespaces = {}
+        self._lock = threading.Lock()
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+
+    @property
+    def shards(self) -> tuple:
+        return self._shards
+
+    def get_namespace(self, name: str, ttl: float=None, sizer: callable=None,
+                      logging_func: callable=None) -> CacheNamespace:
+        namespace = self._namespaces.get(name)
+        if namespace is None:
+            with self._lock:
+                namespace = self._namespaces.get(name)
+                if namespace is None:
+                    namespace = self._namespaces[name] = CacheNamespace(
+                        self, name, self._default_ttl if ttl is None else ttl, sizer,
+                        logging_func or self._logging_func
+                    )
+                    return namespace
+        if ttl is not None and ttl != namespace.ttl:
+            raise CacheNamespaceConflictException('Cache namespace "{}" already exists with ttl {}, not {}'.format(
+                name, namespace.ttl, ttl))
+        if sizer is not None and sizer != namespace.sizer:
+            raise CacheNamespaceConflictException('Cache namespace "{}" already exists with a different sizer'.format(
+                name))
+        return namespace
+
+    def _get_shard(self, key: tuple) -> _MemoryShard:
+        return self._shards[hash(key) % len(self._shards)]
+
+    def _remove(self, shard: _MemoryShard, key: tuple) -> _CacheEntry:
+        entry = shard.items.pop(key)
+        shard.size -= entry.size
+        stats = entry.namespace._stats[shard.index]
+        stats.entries -= 1
+        stats.size -= entry.size
+        return entry
+
+    def _store(self, shard: _MemoryShard, key: tuple, entry: _CacheEntry) -> None:
+        stats = entry.namespace._stats[shard.index]
+        if key in shard.items:
+            self._remove(shard, key)
+        if entry.size > shard.max_size:
+            stats.evictions += 1
+            return
+        shard.items[key] = entry
+        shard.size += entry.size
+        stats.entries += 1
+        stats.size += entry.size
+        while shard.size > shard.max_size:
+            victim = self._remove(shard, next(iter(shard.items)))
+            victim.namespace._stats[shard.index].evictions += 1
+
+    def clear(self) -> None:
+        for shard in self._shards:
+            with shard.lock:
+                for key in list(shard.items):
+                    self._remove(shard, key)
+
+    def get_size(self) -> int:
+        return sum(s.size for s in self._shards)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            namespaces = list(self._namespaces.values())
+        stats = {}
+        for namespace in namespaces:
+            hits, misses, total, ratio = namespace.get_stats()
+            stats[namespace.name] = {
+                'hits': hits,
+                'misses': misses,
+                'ratio': ratio,
+                'evictions': namespace.get_evictions(),
+                'expirations': namespace.get_expirations(),
+                'coalesced': namespace.get_coalesced(),
+                'entries': namespace.get_entry_count(),
+                'size': namespace.get_size(),
+            }
+        return {'max_size': self._max_size, 'size': self.get_size(), 'namespaces': stats}
+
+
+class PersistentCache:
+
+    DB_FILENAME = 'ffprobe_cache.sqlite3'
+
+    ACCESS_RESOLUTION = 60.0
+
+    ACCESS_BATCH_SIZE = 256
+
+    def __init__(self, cache_dir: str, max_size: int, fingerprint_size: int = 0, logging_func: callable = None):
+        cache_dir = os.path.abspath(cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        self._db_path = os.path.join(cache_dir, self.DB_FILENAME)
+        self._max_size = max_size
+        self._fingerprint_size = fingerprint_size
+        self._logging_func = logging_func
+        self._lock = threading.Lock()
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._cache_evictions = 0
+        self._accessed = {}
+        track_cache('ffprobe_persistent', self)
+        self._db = sqlite3.connect(self._db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'item_id TEXT PRIMARY KEY, identity TEXT NOT NULL, value TEXT NOT NULL, '
+            'size INTEGER NOT NULL, accessed REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS meta (id INTEGER PRIMARY KEY CHECK (id = 0), total_size INTEGER NOT NULL)'
+        )
+        self._db.execute(
+            'INSERT OR IGNORE INTO meta (id, total_size) SELECT 0, COALESCE(SUM(size), 0) FROM entries'
+        )
+
+    def _log(self, msg: str) -> None:
+        if self._logging_func:
+            self._logging_func(msg)
+
+    def _get_fingerprint(self, file_path: str, file_size: int) -> str:
+        h = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            h.update(f.read(self._fingerprint_size))
+            if file_size > 2 * self._fingerprint_size:
+                f.seek(-self._fingerprint_size, os.SEEK_END)
+                h.update(f.read(self._fingerprint_size))
+        return h.hexdigest()
+
+    def get_file_identity(self, file_path: str):
+        try:
+            st = os.stat(file_path)
+        except (OSError, ValueError):
+            return None
+        identity = [st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev]
+        if self._fingerprint_size > 0:
+            try:
+                identity.append(self._get_fingerprint(file_path, st.st_size))
+            except OSError:
+                return None
+        return json.dumps(identity)
+
+    def to_cache(self, item_id: str, file_path: str, item) -> None:
+        identity = self.get_file_identity(file_path)
+        if identity is None:
+            self._log('Not caching result for "{}" - unable to determine file identity'.format(file_path))
+            return
+        value = json.dumps(item)
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._flush_accessed()
+                row = self._db.execute('SELECT size FROM entries WHERE item_id = ?', (item_id, )).fetchone()
+                self._db.execute(
+                    'INSERT OR REPLACE INTO entries (item_id, identity, value, size, accessed) VALUES (?, ?, ?, ?, ?)',
+                    (item_id, identity, value, len(value), time.time())
+                )
+                self._evict(len(value) - (row[0] if row is not None else 0))
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+
+    def from_cache(self, item_id: str, file_path: str):
+        identity = self.get_file_identity(file_path)
+        with self._lock:
+            row = None
+            if identity is not None:
+                row = self._db.execute(
+                    'SELECT identity, value, size, accessed FROM entries WHERE item_id = ?', (item_id, )
+                ).fetchone()
+            if row is not None and row[0] != identity:
+                self._log('Persistent cache entry is stale - removing')
+                self._remove(item_id, row[2])
+                row = None
+            if row is None:
+                self._log('Persistent cache miss')
+                self._cache_misses += 1
+                raise CacheMissException
+            now = time.time()
+            if now - row[3] >= self.ACCESS_RESOLUTION:
+                self._accessed[item_id] = now
+                if len(self._accessed) >= self.ACCESS_BATCH_SIZE:
+                    self._db.execute('BEGIN IMMEDIATE')
+                    try:
+                        self._flush_accessed()
+                        self._db.execute('COMMIT')
+                    except BaseException:
+                        self._db.execute('ROLLBACK')
+                        raise
+            self._log('Persistent cache hit')
+            self._cache_hits += 1
+        return json.loads(row[1])
+
+    def _flush_accessed(self) -> None:
+        if self._accessed:
+            self._db.executemany(
+                'UPDATE entries SET accessed = ? WHERE item_id = ?', [(a, i) for i, a in self._accessed.items()]
+            )
+            self._accessed.clear()
+
+    def _remove(self, item_id: str, size: int) -> None:
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            if self._db.execute('DELETE FROM entries WHERE item_id = ?', (item_id, )).rowcount:
+                self._db.execute('UPDATE meta SET total_size = total_size - ? WHERE id = 0', (size, ))
+            self._db.execute('COMMIT')
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._accessed.pop(item_id, None)
+
+    def _evict(self, size_delta: int) -> None:
+        total_size = self._db.execute('SELECT total_size FROM meta WHERE id = 0').fetchone()[0] + size_delta
+        while total_size > self._max_size:
+            row = self._db.execute('SELECT item_id, size FROM entries ORDER BY accessed LIMIT 1').fetchone()
+            if row is None:
+                break
+            self._db.execute('DELETE FROM entries WHERE item_id = ?', (row[0], ))
+            self._accessed.pop(row[0], None)
+            total_size -= row[1]
+            self._cache_evictions += 1
+            self._log('Persistent cache eviction')
+        self._db.execute('UPDATE meta SET total_size = ? WHERE id = 0', (total_size, ))
+
+    def get_size(self) -> int:
+        with self._lock:
+            return self._db.execute('SELECT total_size FROM meta WHERE id = 0').fetchone()[0]
+
     def get_stats(self):
         total_requests = self._cache_hits + self._cache_misses
         try:
@@ -45,3 +690,26 @@ class HashCache:
         except ZeroDivisionError:
             ratio = 0.0
         return self._cache_hits, self._cache_misses, total_requests, ratio
+
+    def get_evictions(self) -> int:
+        return self._cache_evictions
+
+    def close(self) -> None:
+        with self._lock:
+            if self._accessed:
+                self._db.execute('BEGIN IMMEDIATE')
+                self._flush_accessed()
+                self._db.execute('COMMIT')
+            self._db.close()
+
+
+_cache_manager = CacheManager()
+
+
+def get_cache_manager() -> CacheManager:
+    return _cache_manager
+
+
+def set_cache_manager(manager: CacheManager) -> None:
+    global _cache_manager
+    _cache_manager = manager if manager is not None else CacheManager()
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import subprocess
+import tempfile
+import threading
+
+from .profile import FFmpegProfile
+from .launcher import get_launcher
+from .exceptions import CapabilityDiscoveryException, MissingCapabilityException
+
+
+class FFCapabilities:
+
+    ENCODERS = 'encoders'
+    DECODERS = 'decoders'
+    FILTERS = 'filters'
+    MUXERS = 'muxers'
+    PIX_FMTS = 'pix_fmts'
+
+    KINDS = (ENCODERS, DECODERS, FILTERS, MUXERS, PIX_FMTS)
+
+    FILTER_LINE_RE = re.compile(r'^\s*[T.][S.][C.]\s+(\S+)\s+\S*->\S*\s')
+
+    SEPARATOR_RE = re.compile(r'^\s*-+\s*$')
+
+    CACHE_NAME = 'capabilities_{}.json'
+
+    DISCOVERY_TIMEOUT = 30
+
+    _memory_cache = {}
+    _memory_cache_lock = threading.Lock()
+
+    def __init__(self, components: dict):
+        self._components = {kind: frozenset(components.get(kind, ())) for kind in self.KINDS}
+
+    def __getitem__(self, kind: str) -> frozenset:
+        return self._components[kind]
+
+    def has(self, kind: str, name: str) -> bool:
+        return name in self._components[kind]
+
+    def to_dict(self) -> dict:
+        return {kind: sorted(names) for kind, names in self._components.items()}
+
+    @classmethod
+    def _parse_listing(cls, kind: str, output: str) -> set:
+        names = set()
+        lines = output.splitlines()
+        if kind == cls.FILTERS:
+            for line in lines:
+                match = cls.FILTER_LINE_RE.match(line)
+                if match:
+                    names.add(match.group(1))
+            return names
+        for n, line in enumerate(lines):
+            if cls.SEPARATOR_RE.match(line):
+                lines = lines[n + 1:]
+                break
+        else:
+            return names
+        for line in lines:
+            fields = line.split()
+            if len(fields) >= 2:
+                names.update(fields[1].split(','))
+        return names
+
+    @classmethod
+    def _run_listing(cls, bin_path: str, kind: str, timeout: int) -> set:
+        args = [bin_path, '-hide_banner', '-{}'.format(kind)]
+        logging.debug('Starting {}'.format(' '.join(args)))
+        try:
+            proc = get_launcher().run(args, timeout=timeout, stdin=subprocess.DEVNULL)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            raise CapabilityDiscoveryException('Unable to run "{}"'.format(' '.join(args))) from e
+        if proc.returncode != 0:
+            raise CapabilityDiscoveryException('"{}" exited with code {}: {}'.format(
+                ' '.join(args), proc.returncode, proc.stderr.decode('utf-8', errors='replace')
+            ))
+        return cls._parse_listing(kind, proc.stdout.decode('utf-8', errors='replace'))
+
+    @staticmethod
+    def get_binary_key(bin_path: str) -> str:
+        bin_path = os.path.abspath(bin_path)
+        st = os.stat(bin_path)
+        return hashlib.sha1(json.dumps([bin_path, st.st_size, st.st_mtime_ns]).encode()).hexdigest()
+
+    @classmethod
+    def _load(cls, cache_path: str) -> 'FFCapabilities':
+        try:
+            with open(cache_path) as f:
+                return cls(json.load(f))
+        except (OSError, ValueError, AttributeError) as e:
+            logging.debug('Unable to load capabilities from "{}": {}'.format(cache_path, e))
+            return None
+
+    def _save(self, cache_dir: str, cache_path: str) -> None:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.to_dict(), f)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logging.warning('Unable to save capabilities to "{}": {}'.format(cache_path, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @classmethod
+    def discover(cls, bin_path: str, cache_dir: str=None, timeout: int=None) -> 'FFCapabilities':
+        try:
+            key = cls.get_binary_key(bin_path)
+        except OSError as e:
+            raise CapabilityDiscoveryException('Unable to stat "{}"'.format(bin_path)) from e
+        with cls._memory_cache_lock:
+            capabilities = cls._memory_cache.get(key)
+            if capabilities is not None:
+                return capabilities
+            cache_path = os.path.join(cache_dir, cls.CACHE_NAME.format(key)) if cache_dir is not None else None
+            if cache_path is not None:
+                capabilities = cls._load(cache_path)
+            if capabilities is None:
+                logging.info('Discovering capabilities of "{}"...'.format(bin_path))
+                capabilities = cls({
+                    kind: cls._run_listing(bin_path, kind, timeout or cls.DISCOVERY_TIMEOUT) for kind in cls.KINDS
+                })
+                if cache_path is not None:
+                    capabilities._save(cache_dir, cache_path)
+            cls._memory_cache[key] = capabilities
+        return capabilities
+
+    def get_missing(self, requirements: dict) -> list:
+        return sorted(
+            (kind, name) for kind, names in requirements.items() for name in names
+            if name not in self._components[kind]
+        )
+
+    def check(self, requirements: dict) -> None:
+        missing = self.get_missing(requirements)
+        if missing:
+            raise MissingCapabilityException(missing)
+
+    def check_profile(self, profile: FFmpegProfile) -> None:
+        self.check(FFmpegRequirements.from_profile(profile))
+
+    def check_args(self, inputs: list, outputs: list) -> None:
+        self.check(FFmpegRequirements.from_args([a for a, _ in inputs], [a for a, _ in outputs]))
+
+
+class FFmpegRequirements:
+
+    CODEC_ARGS_RE = re.compile(r'^-(c|codec|vcodec|acodec|scodec)(:.*)?$')
+
+    FILTER_ARGS_RE = re.compile(r'^-(vf|af|filter|filter_complex|lavfi)(:.*)?$')
+
+    FILTER_LABEL_RE = re.compile(r'\[[^\[\]]*\]')
+
+    NOT_ENCODERS = ('copy', )
+
+    @classmethod
+    def split_filter_graph(cls, graph: str) -> list:
+        filters = []
+        current = []
+        quoted = False
+        escaped = False
+        for ch in graph:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == "'":
+                quoted = not quoted
+            elif ch in ',;' and not quoted:
+                filters.append(''.join(current))
+                current = []
+                continue
+            current.append(ch)
+        filters.append(''.join(current))
+        return filters
+
+    @classmethod
+    def get_filter_names(cls, graph: str) -> set:
+        names = set()
+        for f in cls.split_filter_graph(graph):
+            f = cls.FILTER_LABEL_RE.sub('', f.split('=', 1)[0]).strip()
+            name = f.split('@', 1)[0]
+            if name:
+                names.add(name)
+        return names
+
+    @classmethod
+    def _add_args(cls, requirements: dict, parameters: list, is_input: bool) -> None:
+        for arg, value in zip(parameters, parameters[1:]):
+            if cls.CODEC_ARGS_RE.match(arg):
+                if value not in cls.NOT_ENCODERS:
+                    requirements[FFCapabilities.DECODERS if is_input else FFCapabilities.ENCODERS].add(value)
+            elif cls.FILTER_ARGS_RE.match(arg):
+                requirements[FFCapabilities.FILTERS].update(cls.get_filter_names(value))
+            elif arg == '-pix_fmt':
+                requirements[FFCapabilities.PIX_FMTS].add(value)
+            elif arg == '-f' and not is_input:
+                requirements[FFCapabilities.MUXERS].add(value)
+
+    @classmethod
+    def from_args(cls, input_parameters: list, output_parameters: list) -> dict:
+        requirements = {kind: set() for kind in FFCapabilities.KINDS}
+        for parameters in input_parameters:
+            cls._add_args(requirements, parameters, True)
+        for parameters in output_parameters:
+            cls._add_args(requirements, parameters, False)
+        return requirements
+
+    @classmethod
+    def from_profile(cls, profile: FFmpegProfile) -> dict:
+        return cls.from_args(
+            [i['parameters'] for i in profile.inputs], [o['parameters'] for o in profile.outputs]
+        )
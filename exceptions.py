@@ -70,3 +70,71 @@ class StreamIndexOutOfRange(ValueError):
 
 class MetadataCollectionException(Exception):
     pass
+
+
+class UnprojectedMetadataField(Exception):
+
+    def __init__(self, field: str):
+        super().__init__('Metadata field "{}" was not requested from ffprobe'.format(field))
+        self.field = field
+
+# FFmpegScheduler
+
+
+class FFmpegJobCancelledException(FFmpegProcessException):
+    pass
+
+
+class SchedulerShutdownException(RuntimeError):
+    pass
+
+# FFmpegProfile
+
+
+class ProfileInputMismatchException(ValueError):
+    pass
+
+# FFmpegProfileMerger
+
+
+class ProfileMergeException(ValueError):
+    pass
+
+# FFmpegSegmentedEncoder
+
+
+class SegmentedEncodingException(FFmpegProcessException):
+    pass
+
+# FFmpegResumableEncoder
+
+
+class ResumableEncodingException(FFmpegProcessException):
+    pass
+
+# CacheManager
+
+
+class CacheNamespaceConflictException(ValueError):
+    pass
+
+# FFCapabilities
+
+
+class CapabilityDiscoveryException(Exception):
+    pass
+
+
+class MissingCapabilityException(ValueError):
+
+    def __init__(self, missing: list):
+        super().__init__('Binary lacks required components: {}'.format(
+            ', '.join('{} {}'.format(kind.rstrip('s'), name) for kind, name in missing)
+        ))
+        self.missing = missing
+
+# WatchFolderPipeline
+
+
+class PipelineShutdownException(RuntimeError):
+    pass
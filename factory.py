@@ -1,5 +1,7 @@
 import logging
 
+from .capabilities import FFCapabilities
+
 
 ffmpeg_factory = None
 
@@ -25,24 +27,51 @@ class FFFactory:
 
 class FFmpegFactory(FFFactory):
 
-    def __init__(self, ffmpeg_path: str, temp_dir: str):
+    def __init__(self, ffmpeg_path: str, temp_dir: str, output_finalizer=None, capabilities_cache_dir: str = None,
+                 launcher=None, result_store=None):
         self._ffmpeg_path = ffmpeg_path
         self._temp_dir = temp_dir
+        self._output_finalizer = output_finalizer
+        self._capabilities_cache_dir = capabilities_cache_dir
+        self._launcher = launcher
+        self._result_store = result_store
         super().__init__()
 
+    @property
+    def result_store(self):
+        return self._result_store
+
+    def get_capabilities(self) -> FFCapabilities:
+        return FFCapabilities.discover(self._ffmpeg_path, self._capabilities_cache_dir)
+
     def get_ffmpeg_command(self, cmd_class):
-        return self._get_or_create_object(cmd_class, self._ffmpeg_path, self._temp_dir)
+        return self._get_or_create_object(
+            cmd_class, self._ffmpeg_path, self._temp_dir, self._output_finalizer, self._launcher, self._result_store
+        )
 
 
 class FFprobeFactory(FFFactory):
 
-    def __init__(self, ffprobe_path: str, probe_timeout: int = 5):
+    def __init__(self, ffprobe_path: str, probe_timeout: int = 5, persistent_cache=None,
+                 capabilities_cache_dir: str = None, launcher=None):
         self._ffprobe_path = ffprobe_path
         self._probe_timeout = probe_timeout
+        self._persistent_cache = persistent_cache
+        self._capabilities_cache_dir = capabilities_cache_dir
+        self._launcher = launcher
         super().__init__()
 
+    def get_capabilities(self) -> FFCapabilities:
+        return FFCapabilities.discover(self._ffprobe_path, self._capabilities_cache_dir)
+
+    @property
+    def persistent_cache(self):
+        return self._persistent_cache
+
     def get_ffprobe_command(self, cmd_class):
-        return self._get_or_create_object(cmd_class, self._ffprobe_path, self._probe_timeout)
+        return self._get_or_create_object(
+            cmd_class, self._ffprobe_path, self._probe_timeout, self._persistent_cache, self._launcher
+        )
 
     def get_ffprobe_field_mode_solver(self, cmd_class):
         return self._get_or_create_object(cmd_class)
@@ -1,12 +1,20 @@
 import os
+import re
 import logging
-import uuid
-import shutil
+import sqlite3
 import subprocess
+import asyncio
+import codecs
+import threading
+import time
 
 from collections import deque
 from datetime import datetime
 
+from .output_finalizer import OutputFinalizer, FinalizeReport
+from .metrics import get_registry
+from .launcher import ProcessLauncher, get_launcher
+from .result_store import TranscodeResultStore
 from .exceptions import FFmpegProcessException, FFmpegBinaryNotFound, FFmpegInputNotFoundException, \
     FFmpegOutputAlreadyExistsException
 
@@ -14,11 +22,107 @@ from .exceptions import FFmpegProcessException, FFmpegBinaryNotFound, FFmpegInpu
 logging.info('FFmpeg is a trademark of Fabrice Bellard <http://www.bellard.org/>, originator of the FFmpeg project.')
 
 
+class FFmpegProgress:
+
+    def __init__(self, frame: int=None, fps: float=None, out_time: float=None, bitrate: float=None,
+                 total_size: int=None, speed: float=None, finished: bool=False):
+        self.frame = frame
+        self.fps = fps
+        self.out_time = out_time
+        self.bitrate = bitrate
+        self.total_size = total_size
+        self.speed = speed
+        self.finished = finished
+
+    def get_eta(self, duration: float) -> float:
+        if duration is None or self.out_time is None or not self.speed:
+            return None
+        return max(duration - self.out_time, 0.0) / self.speed
+
+    def __repr__(self):
+        return 'FFmpegProgress(frame={}, fps={}, out_time={}, bitrate={}, total_size={}, speed={}, finished={})'.format(
+            self.frame, self.fps, self.out_time, self.bitrate, self.total_size, self.speed, self.finished
+        )
+
+
+class FFmpegProgressParser:
+
+    NOT_AVAILABLE = b'N/A'
+
+    def __init__(self, min_interval: float=0):
+        self._min_interval = min_interval
+        self._last_report = None
+        self._block = {}
+
+    @classmethod
+    def _parse_number(cls, value: bytes, value_type: type, suffix: bytes=b''):
+        if value is None or value == cls.NOT_AVAILABLE:
+            return None
+        if suffix and value.endswith(suffix):
+            value = value[:-len(suffix)]
+        try:
+            return value_type(value)
+        except ValueError:
+            return None
+
+    @classmethod
+    def _parse_out_time(cls, block: dict) -> float:
+        for key in (b'out_time_us', b'out_time_ms'):
+            value = cls._parse_number(block.get(key), int)
+            if value is not None:
+                return value / 1000000
+        value = block.get(b'out_time')
+        if value is None or value == cls.NOT_AVAILABLE:
+            return None
+        try:
+            h, m, s = value.split(b':')
+            return int(h) * 3600 + int(m) * 60 + float(s)
+        except ValueError:
+            return None
+
+    @classmethod
+    def build(cls, block: dict, finished: bool=False) -> FFmpegProgress:
+        return FFmpegProgress(
+            frame=cls._parse_number(block.get(b'frame'), int),
+            fps=cls._parse_number(block.get(b'fps'), float),
+            out_time=cls._parse_out_time(block),
+            bitrate=cls._parse_number(block.get(b'bitrate'), float, b'kbits/s'),
+            total_size=cls._parse_number(block.get(b'total_size'), int),
+            speed=cls._parse_number(block.get(b'speed'), float, b'x'),
+            finished=finished
+        )
+
+    def feed(self, line: bytes) -> FFmpegProgress:
+        key, sep, value = line.strip().partition(b'=')
+        if not sep:
+            return None
+        if key != b'progress':
+            self._block[key] = value.strip()
+            return None
+        block = self._block
+        self._block = {}
+        finished = value.strip() == b'end'
+        now = time.monotonic()
+        if not finished and self._last_report is not None and now - self._last_report < self._min_interval:
+            return None
+        self._last_report = now
+        return self.build(block, finished)
+
+
 class FFmpegBaseCommand:
 
     DEFAULT_GENERAL_ARGS = ['-hide_banner', '-n', '-nostdin', '-loglevel', 'warning', '-stats']
 
-    def __init__(self, bin_path: str, tmp_dir: str):
+    PROGRESS_ARGS = ['-nostats', '-progress', 'pipe:1']
+
+    USE_PROGRESS_PIPE = False
+
+    PROGRESS_MIN_INTERVAL = 0.5
+
+    STATS_LINE_SEPARATOR_RE = re.compile(r'\r\n|\r|\n')
+
+    def __init__(self, bin_path: str, tmp_dir: str, output_finalizer: OutputFinalizer=None,
+                 launcher: ProcessLauncher=None, result_store: TranscodeResultStore=None):
         bin_path = os.path.abspath(bin_path)
         if not (os.path.isfile(bin_path) and os.access(bin_path, os.X_OK)):
             msg = 'FFmpeg binary not found: "{}"'.format(bin_path)
@@ -26,48 +130,93 @@ class FFmpegBaseCommand:
             raise FFmpegBinaryNotFound(msg)
         self._bin_path = bin_path
         self._tmp_dir = os.path.abspath(tmp_dir)
+        self._output_finalizer = output_finalizer or OutputFinalizer(self._tmp_dir)
+        self._launcher = launcher
+        self._result_store = result_store
 
-    def _success_callback(self, output_mapping: list, simulate) -> None:
-        logging.info('Moving files from temporary directory...')
-        for tmp_path, out_path in output_mapping:
-            logging.debug('Temporary file: "{}"; output file: "{}"'.format(tmp_path, out_path))
-            if os.path.exists(out_path):
-                logging.warning('Output file "{}" already exists'.format(out_path))
-                head, tail = os.path.split(out_path)
-                name, ext = os.path.splitext(tail)
-                out_path = os.path.join(
-                    head,
-                    '{}.{}{}'.format(
-                        name,
-                        os.path.splitext(os.path.split(tmp_path)[1])[0][0:8],
-                        ext
-                    )
-                )
-                logging.warning('New output file name: "{}"'.format(out_path))
-            if not simulate:
-                shutil.move(tmp_path, out_path)
+    @property
+    def launcher(self) -> ProcessLauncher:
+        return self._launcher if self._launcher is not None else get_launcher()
+
+    @property
+    def result_store(self) -> TranscodeResultStore:
+        return self._result_store
+
+    def get_result_key(self, inputs: list, outputs: list, general_args: list=None) -> str:
+        if self._result_store is None:
+            return None
+        if general_args is None:
+            general_args = self.__class__.DEFAULT_GENERAL_ARGS
+        return self._result_store.get_key(self._bin_path, general_args, inputs, outputs)
+
+    def _load_result(self, key: str, output_mapping: list) -> list:
+        if key is None:
+            return None
+        try:
+            found = self._result_store.materialize(key, [t for t, o in output_mapping])
+        except sqlite3.Error as e:
+            logging.warning('Unable to query transcode result store: {}'.format(e))
+            found = False
+        get_registry().inc('ffmpeg_result_store_total', command=self.__class__.__name__,
+                           result='hit' if found else 'miss')
+        if not found:
+            return None
+        logging.info('Found stored result {} - skipping FFmpeg'.format(key))
+        return self._success_callback(output_mapping, False)
+
+    def load_result(self, key: str, out_paths: list) -> list:
+        return self._load_result(key, [(self._output_finalizer.get_tmp_path(o), o) for o in out_paths])
+
+    def save_result(self, key: str, reports: list) -> list:
+        if key is not None:
+            try:
+                self._result_store.store(key, [r.out_path for r in reports])
+            except (OSError, sqlite3.Error) as e:
+                logging.warning('Unable to store transcode result {}: {}'.format(key, e))
+        return reports
+
+    def _success_callback(self, output_mapping: list, simulate) -> list:
+        logging.info('Finalizing output files...')
+        with get_registry().timer('ffmpeg_finalize_seconds', command=self.__class__.__name__):
+            reports = [self._output_finalizer.finalize(t, o, simulate) for t, o in output_mapping]
+        for r in reports:
+            if r.renamed:
+                logging.warning('Output "{}" was written to "{}"'.format(r.requested_path, r.out_path))
         logging.info('Done')
+        return reports
 
     def _progress_callback(self, frame: int) -> None:
         logging.debug('Processed {} frames'.format(frame))
 
-    def _error_callback(self, return_code: int, proc_log: deque, proc_exception: Exception, tmp_paths: list) -> None:
+    def _progress_info_callback(self, progress: FFmpegProgress) -> None:
+        logging.debug(progress)
+        if progress.frame is not None:
+            self._progress_callback(progress.frame)
+
+    @staticmethod
+    def _remove_tmp_files(tmp_paths: list) -> None:
         logging.info('Removing temporary files...')
         for t in tmp_paths:
             if os.path.exists(t):
                 logging.debug('Found: "{}" - removing...'.format(t))
                 os.remove(t)
+
+    def _error_callback(self, return_code: int, proc_log: deque, proc_exception: Exception, tmp_paths: list) -> None:
+        self._remove_tmp_files(tmp_paths)
         raise FFmpegProcessException(
             'FFmpeg exit code {}.\r\nLast output: {}\r\nRaised exception: {}'.format(
                 return_code, ' '.join(proc_log), proc_exception
             )
         )
 
-    def exec(self, inputs: list, outputs: list, simulate: bool, general_args: list=None):
+    def _build_args(self, inputs: list, outputs: list, general_args: list=None, progress_pipe: bool=False,
+                    direct_output: bool=False) -> tuple:
         if general_args is None:
             general_args = self.__class__.DEFAULT_GENERAL_ARGS
         logging.debug('Building FFmpeg command...')
         args = [self._bin_path]
+        if progress_pipe:
+            general_args = [a for a in general_args if a != '-stats'] + self.__class__.PROGRESS_ARGS
         logging.debug('General args: {}'.format(general_args))
         args.extend(general_args)
 
@@ -91,40 +240,111 @@ class FFmpegBaseCommand:
                 msg = 'Output file "{}" already exists'.format(out_path)
                 logging.error(msg)
                 raise FFmpegOutputAlreadyExistsException(msg)
-            out_ext = os.path.splitext(os.path.split(out_path)[1])[1]
-            tmp_path = os.path.join(self._tmp_dir, '{}{}'.format(str(uuid.uuid4()), out_ext))
+            tmp_path = out_path if direct_output else self._output_finalizer.get_tmp_path(out_path)
             output_mapping.append((tmp_path, out_path))
             out_args.append(tmp_path)
             logging.debug('Extending args with {}'.format(out_args))
             args.extend(out_args)
         logging.debug('Output mapping (tmp_path, out_path): {}'.format(output_mapping))
+        return args, output_mapping
+
+    def _process_stats_line(self, line: str, ignoring_progress: bool) -> bool:
+        if not ignoring_progress and line.startswith('frame='):
+            p = line.find('fps=')
+            try:
+                frame = int(line[6:p].strip())
+            except ValueError:
+                logging.warning(line)
+                logging.warning('Unable to determine conversion progress - ignoring it')
+                return True
+            self._progress_callback(frame)
+        return ignoring_progress
+
+    @staticmethod
+    def _drain_log(stream, proc_log: deque) -> None:
+        for line in stream:
+            line = line.decode('utf-8', errors='replace').strip()
+            if line:
+                proc_log.append(line)
+        stream.close()
+
+    @staticmethod
+    async def _drain_log_async(stream, proc_log: deque) -> None:
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            line = line.decode('utf-8', errors='replace').strip()
+            if line:
+                proc_log.append(line)
+
+    def _finish(self, return_code: int, proc_start_time: datetime, proc_log: deque, proc_exception: Exception,
+                output_mapping: list, simulate: bool, direct_output: bool=False) -> list:
+        proc_end_time = datetime.now()
+        msg = 'FFmpeg process finished at {}. Elapsed time: {}. Exit code: {}'.format(
+            proc_end_time, proc_end_time - proc_start_time, return_code)
+        get_registry().observe(
+            'ffmpeg_run_seconds', (proc_end_time - proc_start_time).total_seconds(),
+            command=self.__class__.__name__, status='ok' if return_code == 0 else 'error'
+        )
+
+        if return_code != 0:
+            logging.warning(msg)
+            self._error_callback(
+                return_code, proc_log, proc_exception,
+                [] if direct_output else [t for t, o in output_mapping]
+            )
+        elif direct_output:
+            logging.info(msg)
+            return [FinalizeReport(t, o, o, FinalizeReport.METHOD_DIRECT) for t, o in output_mapping]
+        else:
+            logging.info(msg)
+            return self._success_callback(output_mapping, simulate)
+
+    def exec(self, inputs: list, outputs: list, simulate: bool, general_args: list=None,
+             progress_pipe: bool=None, proc_callback: callable=None,
+             direct_output: bool=False, use_store: bool=True):
+        if progress_pipe is None:
+            progress_pipe = self.__class__.USE_PROGRESS_PIPE
+        result_key = None
+        if use_store and not simulate and not direct_output:
+            result_key = self.get_result_key(inputs, outputs, general_args)
+        args, output_mapping = self._build_args(inputs, outputs, general_args, progress_pipe, direct_output)
 
         logging.info('Starting FFmpeg...')
         logging.debug(' '.join(args))
         if simulate:
-            self._success_callback(output_mapping, simulate)
-            return
+            return self._success_callback(output_mapping, simulate)
+        reports = self._load_result(result_key, output_mapping)
+        if reports is not None:
+            return reports
 
         proc_log = deque(maxlen=5)
         proc_exception = None
-        proc = subprocess.Popen(args, stderr=subprocess.PIPE, universal_newlines=True)
+        log_thread = None
+        if progress_pipe:
+            proc = self.launcher.popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            log_thread = threading.Thread(target=self._drain_log, args=(proc.stderr, proc_log), daemon=True)
+            log_thread.start()
+        else:
+            proc = self.launcher.popen(args, stderr=subprocess.PIPE, universal_newlines=True)
         proc_start_time = datetime.now()
         logging.info('FFmpeg process started at {}'.format(proc_start_time))
 
         ignoring_progress = False
         try:
-            for line in proc.stderr:
-                proc_log.append(line)
-                if not ignoring_progress and line.startswith('frame='):
-                    p = line.find('fps=')
-                    try:
-                        frame = int(line[6:p].strip())
-                    except ValueError:
-                        logging.warning(line)
-                        logging.warning('Unable to determine conversion progress - ignoring it')
-                        ignoring_progress = True
-                    else:
-                        self._progress_callback(frame)
+            if proc_callback is not None:
+                proc_callback(proc)
+            if progress_pipe:
+                parser = FFmpegProgressParser(self.PROGRESS_MIN_INTERVAL)
+                for line in proc.stdout:
+                    progress = parser.feed(line)
+                    if progress is not None:
+                        self._progress_info_callback(progress)
+            else:
+                for line in proc.stderr:
+                    proc_log.append(line)
+                    ignoring_progress = self._process_stats_line(line, ignoring_progress)
         except FFmpegProcessException as e:
             proc.terminate()
             proc_exception = e
@@ -132,18 +352,95 @@ class FFmpegBaseCommand:
             proc.terminate()
             logging.error(str(e))
         finally:
+            if progress_pipe:
+                proc.stdout.close()
             proc.wait()
-            proc_end_time = datetime.now()
-            return_code = proc.returncode
-            msg = 'FFmpeg process finished at {}. Elapsed time: {}. Exit code: {}'.format(
-                proc_end_time, proc_end_time - proc_start_time, return_code)
-
-            if return_code != 0:
-                logging.warning(msg)
-                self._error_callback(
-                    return_code, proc_log, proc_exception,
-                    [t for t, o in output_mapping]
-                )
+            if log_thread is not None:
+                log_thread.join()
+            reports = self._finish(
+                proc.returncode, proc_start_time, proc_log, proc_exception, output_mapping, simulate, direct_output
+            )
+        return self.save_result(result_key, reports)
+
+    async def exec_async(self, inputs: list, outputs: list, simulate: bool, general_args: list=None,
+                         progress_pipe: bool=None, proc_callback: callable=None,
+                         direct_output: bool=False, use_store: bool=True):
+        if progress_pipe is None:
+            progress_pipe = self.__class__.USE_PROGRESS_PIPE
+        result_key = None
+        if use_store and not simulate and not direct_output:
+            result_key = self.get_result_key(inputs, outputs, general_args)
+        args, output_mapping = self._build_args(inputs, outputs, general_args, progress_pipe, direct_output)
+        loop = asyncio.get_running_loop()
+
+        logging.info('Starting FFmpeg...')
+        logging.debug(' '.join(args))
+        if simulate:
+            return self._success_callback(output_mapping, simulate)
+        reports = await loop.run_in_executor(None, self._load_result, result_key, output_mapping)
+        if reports is not None:
+            return reports
+
+        proc_log = deque(maxlen=5)
+        proc_exception = None
+        log_task = None
+        proc = await self.launcher.create_subprocess_exec(
+            args, stdin=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE if progress_pipe else None
+        )
+        proc_start_time = datetime.now()
+        logging.info('FFmpeg process started at {}'.format(proc_start_time))
+
+        ignoring_progress = False
+        try:
+            if proc_callback is not None:
+                proc_callback(proc)
+            if progress_pipe:
+                log_task = asyncio.ensure_future(self._drain_log_async(proc.stderr, proc_log))
+                parser = FFmpegProgressParser(self.PROGRESS_MIN_INTERVAL)
+                while True:
+                    line = await proc.stdout.readline()
+                    if not line:
+                        break
+                    progress = parser.feed(line)
+                    if progress is not None:
+                        self._progress_info_callback(progress)
             else:
-                logging.info(msg)
-                self._success_callback(output_mapping, simulate)
+                buffer = ''
+                decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+                while True:
+                    chunk = await proc.stderr.read(4096)
+                    buffer += decoder.decode(chunk, final=not chunk)
+                    lines = self.STATS_LINE_SEPARATOR_RE.split(buffer)
+                    buffer = '' if not chunk else lines.pop()
+                    for line in lines:
+                        if line:
+                            proc_log.append(line)
+                            ignoring_progress = self._process_stats_line(line, ignoring_progress)
+                    if not chunk:
+                        break
+        except asyncio.CancelledError:
+            logging.warning('FFmpeg job cancelled - killing process')
+            if proc.returncode is None:
+                proc.kill()
+            if log_task is not None:
+                log_task.cancel()
+            await asyncio.shield(proc.wait())
+            await asyncio.shield(loop.run_in_executor(
+                None, self._remove_tmp_files, [] if direct_output else [t for t, o in output_mapping]
+            ))
+            raise
+        except FFmpegProcessException as e:
+            proc.terminate()
+            proc_exception = e
+        except Exception as e:
+            proc.terminate()
+            logging.error(str(e))
+        await proc.wait()
+        if log_task is not None:
+            await log_task
+        reports = await loop.run_in_executor(
+            None, self._finish, proc.returncode, proc_start_time, proc_log, proc_exception, output_mapping, simulate,
+            direct_output
+        )
+        return await loop.run_in_executor(None, self.save_result, result_key, reports)
@@ -2,16 +2,25 @@ import os
 import logging
 import subprocess
 import json
+import asyncio
+import tempfile
+import threading
+import time
 
 from .exceptions import FFprobeTerminatedException, FFprobeProcessException, FFprobeBinaryNotFound
-from .cache import HashCache, CacheMissException
+from .cache import CacheNamespace, PersistentCache, CacheMissException, get_cache_manager
+from .metrics import get_registry
+from .launcher import ProcessLauncher, get_launcher
 
 
 class FFprobeBaseCommand:
 
     DEFAULT_ARGS = ['-hide_banner', '-of', 'json']
 
-    def __init__(self, bin_path: str, timeout: int=5):
+    CACHE_NAMESPACE = 'ffprobe'
+
+    def __init__(self, bin_path: str, timeout: int=5, persistent_cache: PersistentCache=None,
+                 launcher: ProcessLauncher=None):
         bin_path = os.path.abspath(bin_path)
         if not (os.path.isfile(bin_path) and os.access(bin_path, os.X_OK)):
             msg = 'FFprobe binary not found: "{}"'.format(bin_path)
@@ -19,52 +28,157 @@ class FFprobeBaseCommand:
             raise FFprobeBinaryNotFound(msg)
         self._bin_path = bin_path
         self._timeout = timeout
-        self._cache = HashCache(10, logging.debug)
+        self._persistent_cache = persistent_cache
+        self._launcher = launcher
+        self._cache = get_cache_manager().get_namespace(self.__class__.CACHE_NAMESPACE, logging_func=logging.debug)
 
-    def _exec(self, args: list) -> dict:
-        cache_id = ''.join(args)
-        logging.debug('Trying to get ffprobe result from cache...')
-        try:
-            cached_value = self._cache.from_cache(cache_id)
-        except CacheMissException:
-            pass
-        else:
-            return cached_value
-        logging.debug('Starting {}'.format(' '.join(args)))
-        try:
-            proc = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=self._timeout)
-        except subprocess.TimeoutExpired as e:
-            logging.error('FFprobe timeout - terminating')
-            raise FFprobeProcessException from e
-        if proc.returncode == 0:
+    @property
+    def launcher(self) -> ProcessLauncher:
+        return self._launcher if self._launcher is not None else get_launcher()
+
+    @property
+    def cache(self) -> CacheNamespace:
+        return self._cache
+
+    def _from_persistent_cache(self, args: list, in_url: str=None) -> dict:
+        if self._persistent_cache is None or in_url is None:
+            raise CacheMissException
+        logging.debug('Trying to get ffprobe result from persistent cache...')
+        return self._persistent_cache.from_cache('\0'.join(args), in_url)
+
+    def _to_persistent_cache(self, args: list, in_url: str, result: dict) -> None:
+        if self._persistent_cache is not None and in_url is not None:
+            self._persistent_cache.to_cache('\0'.join(args), in_url, result)
+
+    @staticmethod
+    def _process_result(return_code: int, stdout: bytes, stderr: bytes) -> dict:
+        if return_code == 0:
             logging.debug('FFprobe done')
-            stdout = proc.stdout.decode('utf-8')
+            stdout = stdout.decode('utf-8')
             try:
-                result = json.loads(stdout)
-                self._cache.to_cache(cache_id, result)
-                return result
+                with get_registry().timer('ffprobe_json_parse_seconds'):
+                    return json.loads(stdout)
             except ValueError as e:
                 logging.error('FFprobe\'s stdout decoding error: {}'.format(str(e)))
                 logging.debug('Dumping stdout: {}'.format(stdout))
                 raise FFprobeProcessException from e
-        elif proc.returncode < 0:
-            msg = 'FFprobe terminated with signal {}'.format(abs(proc.returncode))
+        elif return_code < 0:
+            msg = 'FFprobe terminated with signal {}'.format(abs(return_code))
             raise FFprobeTerminatedException(msg)
         else:
-            log_err = 'Ffprobe exited with code {}'.format(proc.returncode)
-            log_debug = 'Dumping stderr: {}'.format(proc.stderr.decode('utf-8'))
+            log_err = 'Ffprobe exited with code {}'.format(return_code)
+            log_debug = 'Dumping stderr: {}'.format(stderr.decode('utf-8'))
             logging.error(log_err)
             logging.debug(log_debug)
             raise FFprobeProcessException('{}. {}'.format(log_err, log_debug))
 
+    def _exec(self, args: list, in_url: str=None, use_cache: bool=True) -> dict:
+        if not use_cache:
+            return self._probe(args, in_url)
+        logging.debug('Trying to get ffprobe result from cache...')
+        return self.cache.get_or_compute(tuple(args), lambda: self._probe(args, in_url))
+
+    def _probe(self, args: list, in_url: str=None) -> dict:
+        try:
+            return self._from_persistent_cache(args, in_url)
+        except CacheMissException:
+            pass
+        logging.debug('Starting {}'.format(' '.join(args)))
+        try:
+            with get_registry().timer('ffprobe_seconds', command=self.__class__.__name__):
+                proc = self.launcher.run(args, timeout=self._timeout)
+        except subprocess.TimeoutExpired as e:
+            logging.error('FFprobe timeout - terminating')
+            raise FFprobeProcessException from e
+        result = self._process_result(proc.returncode, proc.stdout, proc.stderr)
+        self._to_persistent_cache(args, in_url, result)
+        return result
+
+    async def _exec_async(self, args: list, in_url: str=None, use_cache: bool=True) -> dict:
+        if not use_cache:
+            return await self._probe_async(args, in_url)
+        logging.debug('Trying to get ffprobe result from cache...')
+        return await self.cache.get_or_compute_async(tuple(args), lambda: self._probe_async(args, in_url))
+
+    async def _probe_async(self, args: list, in_url: str=None) -> dict:
+        try:
+            return self._from_persistent_cache(args, in_url)
+        except CacheMissException:
+            pass
+        logging.debug('Starting {}'.format(' '.join(args)))
+        proc_start_time = time.perf_counter()
+        proc = await self.launcher.create_subprocess_exec(
+            args, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), self._timeout)
+        except asyncio.TimeoutError as e:
+            logging.error('FFprobe timeout - terminating')
+            proc.kill()
+            await proc.wait()
+            raise FFprobeProcessException from e
+        except asyncio.CancelledError:
+            logging.debug('FFprobe cancelled - killing')
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+        get_registry().observe('ffprobe_seconds', time.perf_counter() - proc_start_time,
+                               command=self.__class__.__name__)
+        result = self._process_result(proc.returncode, stdout, stderr)
+        self._to_persistent_cache(args, in_url, result)
+        return result
+
 
 class FFprobeFrameCommand(FFprobeBaseCommand):
 
     DEFAULT_ARGS = FFprobeBaseCommand.DEFAULT_ARGS + ['-show_frames']
 
+    def _build_args(self, in_url: str, select_streams: str=None, read_intervals: str=None) -> list:
+        logging.debug('Building FFprobe command...')
+        args = [self._bin_path] + self.__class__.DEFAULT_ARGS
+        if select_streams is not None:
+            args.append('-select_streams')
+            args.append(select_streams)
+        if read_intervals is not None:
+            args.append('-read_intervals')
+            args.append(read_intervals)
+        args.append(in_url)
+        return args
+
     def exec(self, in_url: str, select_streams: str=None, read_intervals: str=None) -> dict:
+        return self._exec(self._build_args(in_url, select_streams, read_intervals), in_url)
+
+    async def exec_async(self, in_url: str, select_streams: str=None, read_intervals: str=None) -> dict:
+        return await self._exec_async(self._build_args(in_url, select_streams, read_intervals), in_url)
+
+
+class FFprobeFrameStreamCommand(FFprobeBaseCommand):
+
+    DEFAULT_ARGS = ['-hide_banner', '-of', 'compact=p=0']
+
+    SECTION = 'frame'
+
+    @staticmethod
+    def _parse_line(line: bytes) -> dict:
+        entries = {}
+        for pair in line.rstrip(b'\r\n').split(b'|'):
+            key, sep, value = pair.partition(b'=')
+            if not sep:
+                continue
+            value = value.decode('utf-8', errors='replace')
+            try:
+                value = int(value)
+            except ValueError:
+                pass
+            entries[key.decode('utf-8')] = value
+        return entries
+
+    def _build_args(self, in_url: str, entries: list, select_streams: str=None, read_intervals: str=None) -> list:
         logging.debug('Building FFprobe command...')
         args = [self._bin_path] + self.__class__.DEFAULT_ARGS
+        args.append('-show_entries')
+        args.append('{}={}'.format(self.__class__.SECTION, ','.join(entries)))
         if select_streams is not None:
             args.append('-select_streams')
             args.append(select_streams)
@@ -72,22 +186,128 @@ class FFprobeFrameCommand(FFprobeBaseCommand):
             args.append('-read_intervals')
             args.append(read_intervals)
         args.append(in_url)
+        return args
 
-        return self._exec(args)
+    def exec(self, in_url: str, entries: list, select_streams: str=None, read_intervals: str=None):
+        args = self._build_args(in_url, entries, select_streams, read_intervals)
+        logging.debug('Starting {}'.format(' '.join(args)))
+        with tempfile.TemporaryFile() as stderr:
+            proc_start_time = time.perf_counter()
+            proc = self.launcher.popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=stderr)
+            timer = threading.Timer(self._timeout, proc.kill)
+            timer.start()
+            stopped = False
+            try:
+                for line in proc.stdout:
+                    frame = self._parse_line(line)
+                    if frame:
+                        yield frame
+            except GeneratorExit:
+                logging.debug('Frame stream closed by consumer - stopping FFprobe')
+                stopped = True
+                raise
+            finally:
+                if proc.poll() is None:
+                    proc.kill()
+                proc.stdout.close()
+                proc.wait()
+                get_registry().observe('ffprobe_seconds', time.perf_counter() - proc_start_time,
+                                       command=self.__class__.__name__)
+                timed_out = not timer.is_alive() and not stopped and proc.returncode != 0
+                timer.cancel()
+            if timed_out:
+                logging.error('FFprobe timeout - terminating')
+                raise FFprobeProcessException('FFprobe timeout')
+            stderr.seek(0)
+            if proc.returncode != 0:
+                self._process_result(proc.returncode, b'', stderr.read())
+            logging.debug('FFprobe done')
+
+    async def exec_async(self, in_url: str, entries: list, select_streams: str=None, read_intervals: str=None):
+        args = self._build_args(in_url, entries, select_streams, read_intervals)
+        logging.debug('Starting {}'.format(' '.join(args)))
+        with tempfile.TemporaryFile() as stderr:
+            proc_start_time = time.perf_counter()
+            proc = await self.launcher.create_subprocess_exec(
+                args, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=stderr
+            )
+            deadline = proc_start_time + self._timeout
+            finished = False
+            try:
+                while True:
+                    try:
+                        line = await asyncio.wait_for(
+                            proc.stdout.readline(), max(0.0, deadline - time.perf_counter())
+                        )
+                    except asyncio.TimeoutError as e:
+                        logging.error('FFprobe timeout - terminating')
+                        raise FFprobeProcessException('FFprobe timeout') from e
+                    if not line:
+                        break
+                    frame = self._parse_line(line)
+                    if frame:
+                        yield frame
+                finished = True
+            except GeneratorExit:
+                logging.debug('Frame stream closed by consumer - stopping FFprobe')
+                raise
+            except asyncio.CancelledError:
+                logging.debug('FFprobe cancelled - killing')
+                raise
+            finally:
+                if not finished and proc.returncode is None:
+                    proc.kill()
+                await proc.wait()
+                get_registry().observe('ffprobe_seconds', time.perf_counter() - proc_start_time,
+                                       command=self.__class__.__name__)
+            stderr.seek(0)
+            if proc.returncode != 0:
+                self._process_result(proc.returncode, b'', stderr.read())
+            logging.debug('FFprobe done')
+
+
+class FFprobePacketStreamCommand(FFprobeFrameStreamCommand):
+
+    SECTION = 'packet'
 
 
 class FFprobeInfoCommand(FFprobeBaseCommand):
 
-    def exec(self, in_url: str, show_format: bool=True, show_streams: bool=True, show_programs: bool=True) -> dict:
+    def _build_args(self, in_url: str, show_format: bool=True, show_streams: bool=True,
+                    show_programs: bool=True, show_entries: str=None, frame_entries: list=None,
+                    read_intervals: str=None) -> list:
         logging.debug('Building FFprobe command...')
         args = [self._bin_path] + self.__class__.DEFAULT_ARGS
         logging.debug('Appending -show* arguments...')
-        if show_format:
-            args.append('-show_format')
-        if show_streams:
-            args.append('-show_streams')
+        if show_entries is None:
+            if show_format:
+                args.append('-show_format')
+            if show_streams:
+                args.append('-show_streams')
+        if frame_entries:
+            frame_section = 'frame={}'.format(','.join(frame_entries))
+            show_entries = frame_section if show_entries is None else '{}:{}'.format(show_entries, frame_section)
+        if show_entries is not None:
+            args.append('-show_entries')
+            args.append(show_entries)
         if show_programs:
             args.append('-show_programs')
+        if read_intervals is not None:
+            args.append('-read_intervals')
+            args.append(read_intervals)
         args.append(in_url)
+        return args
+
+    def exec(self, in_url: str, show_format: bool=True, show_streams: bool=True, show_programs: bool=True,
+             show_entries: str=None, frame_entries: list=None, read_intervals: str=None,
+             use_cache: bool=True) -> dict:
+        return self._exec(self._build_args(
+            in_url, show_format, show_streams, show_programs, show_entries, frame_entries, read_intervals
+        ), in_url, use_cache)
 
-        return self._exec(args)
+    async def exec_async(self, in_url: str, show_format: bool=True, show_streams: bool=True,
+                         show_programs: bool=True, show_entries: str=None, frame_entries: list=None,
+                         read_intervals: str=None, use_cache: bool=True) -> dict:
+        return await self._exec_async(self._build_args(
+            in_url, show_format, show_streams, show_programs, show_entries, frame_entries, read_intervals
+        ), in_url, use_cache)
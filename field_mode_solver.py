@@ -1,7 +1,10 @@
 import logging
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 
-from .ffprobe import FFprobeFrameCommand
-from .cache import HashCache, CacheMissException
+from .ffprobe import FFprobeFrameCommand, FFprobeFrameStreamCommand
+from .cache import CacheNamespace, get_cache_manager
 from .factory import ffprobe_factory
 
 
@@ -19,7 +22,10 @@ class AbstractFieldModeSolver:
         IS_PROGRESSIVE: 'PROGRESSIVE'
     }
 
-    def solve(self, input_url: str, video_stream_number: int) -> int:
+    def solve(self, input_url: str, video_stream_number: int, duration: float=None) -> int:
+        raise NotImplementedError
+
+    async def solve_async(self, input_url: str, video_stream_number: int, duration: float=None) -> int:
         raise NotImplementedError
 
 
@@ -27,9 +33,28 @@ class FFprobeFieldModeSolver(AbstractFieldModeSolver):
 
     READ_INTERVALS = '%+#10'
 
+    STREAMING = True
+
+    FRAME_ENTRIES = ['interlaced_frame', 'top_field_first']
+
+    SAMPLE_WINDOWS = 1
+
+    SAMPLE_FRAMES = 10
+
+    SAMPLE_MIN_CONFIDENCE = 0.75
+
+    SEED_FRAME_ENTRIES = ['media_type', 'stream_index'] + FRAME_ENTRIES
+
+    SEED_READ_INTERVALS = '%+1'
+
+    SEED_FRAMES = 10
+
+    CACHE_NAMESPACE = 'field_mode'
+
     def __init__(self):
         self._ffprobe_frame_cmd = ffprobe_factory.get_ffprobe_command(FFprobeFrameCommand)
-        self._cache = HashCache(10, logging.debug)
+        self._ffprobe_frame_stream_cmd = ffprobe_factory.get_ffprobe_command(FFprobeFrameStreamCommand)
+        self._cache = get_cache_manager().get_namespace(self.CACHE_NAMESPACE, logging_func=logging.debug)
 
     def _solve(self, total_count: int, tff_counf: int, bff_count: int, progressive_count: int) -> int:
         if tff_counf == total_count:
@@ -40,45 +65,229 @@ class FFprobeFieldModeSolver(AbstractFieldModeSolver):
             return self.IS_PROGRESSIVE
         return self.IS_MIXED_OR_UNKNOWN
 
-    @staticmethod
-    def _collect(v_frame_list: list) -> tuple:
-        tff_count = 0
-        bff_count = 0
-        progressive_count = 0
-        total_count = len(v_frame_list)
-        for f in v_frame_list:
-            if f['interlaced_frame'] == 1:
-                if f['top_field_first'] == 1:
-                    tff_count += 1
-                else:
-                    bff_count += 1
+    @classmethod
+    def _classify(cls, frame: dict) -> int:
+        if frame['interlaced_frame'] == 1:
+            if frame['top_field_first'] == 1:
+                return cls.IS_INTERLACED_TFF
             else:
-                if f['top_field_first'] == 1:
-                    tff_count += 1
-                else:
-                    progressive_count += 1
-        return total_count, tff_count, bff_count, progressive_count
-
-    def solve(self, input_url: str, video_stream_number: int) -> int:
-        cache_id = '{}{}'.format(input_url, video_stream_number)
-        logging.debug('Trying to get field mode from cache...')
-        try:
-            result = self._cache.from_cache(cache_id)
-        except CacheMissException:
-            pass
+                return cls.IS_INTERLACED_BFF
         else:
-            return result
-        logging.info('Decoding some frames to determine video stream field mode...')
-        v_frame_list = self._ffprobe_frame_cmd.exec(
-            input_url,
-            'v:{}'.format(video_stream_number),
-            self.READ_INTERVALS
-        )['frames']
-        collected = self._collect(v_frame_list)
+            if frame['top_field_first'] == 1:
+                return cls.IS_INTERLACED_TFF
+            else:
+                return cls.IS_PROGRESSIVE
+
+    @classmethod
+    def _collect(cls, v_frame_list, stop_on_mixed: bool=False) -> tuple:
+        counts = {
+            cls.IS_INTERLACED_TFF: 0,
+            cls.IS_INTERLACED_BFF: 0,
+            cls.IS_PROGRESSIVE: 0,
+        }
+        total_count = 0
+        for f in v_frame_list:
+            decision = cls._classify(f)
+            counts[decision] += 1
+            total_count += 1
+            if stop_on_mixed and counts[decision] != total_count:
+                logging.debug('Frame {} disagrees with previous ones - stream is mixed'.format(total_count))
+                break
+        return total_count, counts[cls.IS_INTERLACED_TFF], counts[cls.IS_INTERLACED_BFF], \
+            counts[cls.IS_PROGRESSIVE]
+
+    @classmethod
+    async def _collect_async(cls, v_frames, stop_on_mixed: bool=False) -> tuple:
+        counts = {
+            cls.IS_INTERLACED_TFF: 0,
+            cls.IS_INTERLACED_BFF: 0,
+            cls.IS_PROGRESSIVE: 0,
+        }
+        total_count = 0
+        try:
+            async for f in v_frames:
+                decision = cls._classify(f)
+                counts[decision] += 1
+                total_count += 1
+                if stop_on_mixed and counts[decision] != total_count:
+                    logging.debug('Frame {} disagrees with previous ones - stream is mixed'.format(total_count))
+                    break
+        finally:
+            await v_frames.aclose()
+        return total_count, counts[cls.IS_INTERLACED_TFF], counts[cls.IS_INTERLACED_BFF], \
+            counts[cls.IS_PROGRESSIVE]
+
+    def _decide(self, v_frame_list, stop_on_mixed: bool=False) -> int:
+        return self._report(self._collect(v_frame_list, stop_on_mixed))
+
+    def _report(self, collected: tuple) -> int:
         logging.debug('FFprobe result: total - {}, tff count - {}, bff count - {}, progressive count - {}'.format(
             *collected
         ))
         decision = self._solve(*collected)
         logging.info('Stream determined as {}'.format(self.DECISIONS[decision]))
-        self._cache.to_cache(cache_id, decision)
         return decision
+
+    def _get_sample_intervals(self, duration: float) -> list:
+        return [
+            '{:.3f}%+#{}'.format(duration * (n + 0.5) / self.SAMPLE_WINDOWS, self.SAMPLE_FRAMES)
+            for n in range(self.SAMPLE_WINDOWS)
+        ]
+
+    def _use_sampling(self, duration: float) -> bool:
+        return self.SAMPLE_WINDOWS > 1 and duration is not None and duration > 0
+
+    def _combine(self, collected_list: list) -> tuple:
+        total_count = sum(c[0] for c in collected_list)
+        if total_count == 0:
+            return self.IS_MIXED_OR_UNKNOWN, 0.0
+        scores = {
+            self.IS_INTERLACED_TFF: sum(c[1] for c in collected_list) / total_count,
+            self.IS_INTERLACED_BFF: sum(c[2] for c in collected_list) / total_count,
+            self.IS_PROGRESSIVE: sum(c[3] for c in collected_list) / total_count,
+        }
+        logging.debug('Sampled decision scores: {}'.format(
+            ', '.join('{} - {:.2f}'.format(self.DECISIONS[d], c) for d, c in scores.items())
+        ))
+        decision = max(scores, key=scores.get)
+        confidence = scores[decision]
+        if confidence < self.SAMPLE_MIN_CONFIDENCE:
+            return self.IS_MIXED_OR_UNKNOWN, 1.0 - confidence
+        return decision, confidence
+
+    def _collect_window(self, input_url: str, video_stream_number: int, read_intervals: str) -> tuple:
+        with closing(self._ffprobe_frame_stream_cmd.exec(
+            input_url,
+            self.FRAME_ENTRIES,
+            'v:{}'.format(video_stream_number),
+            read_intervals
+        )) as v_frames:
+            collected = self._collect(v_frames)
+        logging.debug('Window {}: total - {}, tff count - {}, bff count - {}, progressive count - {}'.format(
+            read_intervals, *collected
+        ))
+        return collected
+
+    async def _collect_window_async(self, input_url: str, video_stream_number: int, read_intervals: str) -> tuple:
+        collected = await self._collect_async(self._ffprobe_frame_stream_cmd.exec_async(
+            input_url,
+            self.FRAME_ENTRIES,
+            'v:{}'.format(video_stream_number),
+            read_intervals
+        ))
+        logging.debug('Window {}: total - {}, tff count - {}, bff count - {}, progressive count - {}'.format(
+            read_intervals, *collected
+        ))
+        return collected
+
+    def _solve_sampled(self, input_url: str, video_stream_number: int, duration: float) -> tuple:
+        logging.info('Decoding {} sample windows to determine video stream field mode...'.format(
+            self.SAMPLE_WINDOWS))
+        intervals = self._get_sample_intervals(duration)
+        with ThreadPoolExecutor(len(intervals)) as executor:
+            collected_list = list(executor.map(
+                lambda i: self._collect_window(input_url, video_stream_number, i), intervals
+            ))
+        decision, confidence = self._combine(collected_list)
+        logging.info('Stream determined as {} with confidence {:.2f}'.format(self.DECISIONS[decision], confidence))
+        return decision, confidence
+
+    async def _solve_sampled_async(self, input_url: str, video_stream_number: int, duration: float) -> tuple:
+        logging.info('Decoding {} sample windows to determine video stream field mode...'.format(
+            self.SAMPLE_WINDOWS))
+        collected_list = await asyncio.gather(*[
+            self._collect_window_async(input_url, video_stream_number, i)
+            for i in self._get_sample_intervals(duration)
+        ])
+        decision, confidence = self._combine(collected_list)
+        logging.info('Stream determined as {} with confidence {:.2f}'.format(self.DECISIONS[decision], confidence))
+        return decision, confidence
+
+    def solve_with_confidence(self, input_url: str, video_stream_number: int, duration: float=None) -> tuple:
+        if not self._use_sampling(duration):
+            return self.solve(input_url, video_stream_number), 1.0
+        return self._solve_sampled(input_url, video_stream_number, duration)
+
+    @staticmethod
+    def _get_cache_id(input_url: str, video_stream_number: int) -> tuple:
+        return input_url, video_stream_number
+
+    @property
+    def cache(self) -> CacheNamespace:
+        return self._cache
+
+    def can_seed(self) -> bool:
+        return self.SAMPLE_WINDOWS <= 1
+
+    def seed(self, input_url: str, stream_indexes: list, frames: list) -> dict:
+        v_frames = {i: [] for i in stream_indexes}
+        for f in frames:
+            if f.get('media_type') == 'video':
+                stream_frames = v_frames.get(f.get('stream_index'))
+                if stream_frames is not None and len(stream_frames) < self.SEED_FRAMES:
+                    stream_frames.append(f)
+        decisions = {}
+        for video_stream_number, stream_index in enumerate(stream_indexes):
+            if not v_frames[stream_index]:
+                continue
+            logging.debug('Seeding field mode of stream {} from combined probe'.format(stream_index))
+            decision = self._decide(v_frames[stream_index])
+            self.cache.to_cache(self._get_cache_id(input_url, video_stream_number), decision)
+            decisions[video_stream_number] = decision
+        return decisions
+
+    def solve(self, input_url: str, video_stream_number: int, duration: float=None) -> int:
+        logging.debug('Trying to get field mode from cache...')
+        return self.cache.get_or_compute(
+            self._get_cache_id(input_url, video_stream_number),
+            lambda: self._solve_uncached(input_url, video_stream_number, duration)
+        )
+
+    def _solve_uncached(self, input_url: str, video_stream_number: int, duration: float=None) -> int:
+        if self._use_sampling(duration):
+            return self._solve_sampled(input_url, video_stream_number, duration)[0]
+        logging.info('Decoding some frames to determine video stream field mode...')
+        if self.STREAMING:
+            decision = self._solve_streaming(input_url, video_stream_number)
+        else:
+            v_frame_list = self._ffprobe_frame_cmd.exec(
+                input_url,
+                'v:{}'.format(video_stream_number),
+                self.READ_INTERVALS
+            )['frames']
+            decision = self._decide(v_frame_list)
+        return decision
+
+    def _solve_streaming(self, input_url: str, video_stream_number: int) -> int:
+        with closing(self._ffprobe_frame_stream_cmd.exec(
+            input_url,
+            self.FRAME_ENTRIES,
+            'v:{}'.format(video_stream_number),
+            self.READ_INTERVALS
+        )) as v_frames:
+            return self._decide(v_frames, stop_on_mixed=True)
+
+    async def solve_async(self, input_url: str, video_stream_number: int, duration: float=None) -> int:
+        logging.debug('Trying to get field mode from cache...')
+        return await self.cache.get_or_compute_async(
+            self._get_cache_id(input_url, video_stream_number),
+            lambda: self._solve_uncached_async(input_url, video_stream_number, duration)
+        )
+
+    async def _solve_uncached_async(self, input_url: str, video_stream_number: int, duration: float=None) -> int:
+        if self._use_sampling(duration):
+            return (await self._solve_sampled_async(input_url, video_stream_number, duration))[0]
+        logging.info('Decoding some frames to determine video stream field mode...')
+        if self.STREAMING:
+            return self._report(await self._collect_async(self._ffprobe_frame_stream_cmd.exec_async(
+                input_url,
+                self.FRAME_ENTRIES,
+                'v:{}'.format(video_stream_number),
+                self.READ_INTERVALS
+            ), stop_on_mixed=True))
+        v_frame_list = (await self._ffprobe_frame_cmd.exec_async(
+            input_url,
+            'v:{}'.format(video_stream_number),
+            self.READ_INTERVALS
+        ))['frames']
+        return self._decide(v_frame_list)
@@ -0,0 +1,179 @@
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import logging
+import os
+import selectors
+import struct
+import time
+
+
+class FolderWatcher:
+
+    def __init__(self, path: str, patterns: list=None):
+        self._path = os.path.abspath(path)
+        if not os.path.isdir(self._path):
+            raise NotADirectoryError('Watch folder not found: "{}"'.format(self._path))
+        self._patterns = list(patterns) if patterns else None
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def _accepts(self, name: str) -> bool:
+        if name.startswith('.'):
+            return False
+        if self._patterns is None:
+            return True
+        return any(fnmatch.fnmatch(name, p) for p in self._patterns)
+
+    def scan(self) -> dict:
+        files = {}
+        try:
+            entries = os.scandir(self._path)
+        except OSError as e:
+            logging.error('Unable to scan "{}": {}'.format(self._path, e))
+            return files
+        with entries:
+            for entry in entries:
+                if not self._accepts(entry.name):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                files[entry.path] = (st.st_size, st.st_mtime_ns)
+        return files
+
+    def get_changes(self, timeout: float) -> set:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class PollingFolderWatcher(FolderWatcher):
+
+    def __init__(self, path: str, patterns: list=None, interval: float=1.0):
+        super().__init__(path, patterns)
+        self._interval = interval
+        self._snapshot = {}
+        self._next_scan = 0.0
+
+    def get_changes(self, timeout: float) -> set:
+        delay = self._next_scan - time.monotonic()
+        if delay > timeout:
+            time.sleep(timeout)
+            return set()
+        if delay > 0:
+            time.sleep(delay)
+        self._next_scan = time.monotonic() + self._interval
+        snapshot = self.scan()
+        changes = {p for p, signature in snapshot.items() if self._snapshot.get(p) != signature}
+        changes.update(p for p in self._snapshot if p not in snapshot)
+        self._snapshot = snapshot
+        return changes
+
+
+class InotifyFolderWatcher(FolderWatcher):
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+
+    WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    EVENT_HEADER = struct.Struct('iIII')
+
+    READ_SIZE = 64 * 1024
+
+    _libc = None
+
+    @classmethod
+    def _get_libc(cls):
+        if cls._libc is None:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init1.argtypes = (ctypes.c_int, )
+            libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+            cls._libc = libc
+        return cls._libc
+
+    def __init__(self, path: str, patterns: list=None):
+        super().__init__(path, patterns)
+        try:
+            libc = self._get_libc()
+            init = libc.inotify_init1
+        except (OSError, AttributeError) as e:
+            raise OSError(errno.ENOSYS, 'inotify is not available') from e
+        self._fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        if libc.inotify_add_watch(self._fd, os.fsencode(self._path), self.WATCH_MASK) < 0:
+            e = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(e, '{}: "{}"'.format(os.strerror(e), self._path))
+        try:
+            self._selector = selectors.DefaultSelector()
+            self._selector.register(self._fd, selectors.EVENT_READ)
+        except OSError:
+            os.close(self._fd)
+            raise
+        self._started = False
+
+    def _read_events(self) -> tuple:
+        names = set()
+        overflow = False
+        while True:
+            try:
+                data = os.read(self._fd, self.READ_SIZE)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + self.EVENT_HEADER.size <= len(data):
+                wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+                offset += self.EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & self.IN_Q_OVERFLOW:
+                    overflow = True
+                elif name and not mask & self.IN_ISDIR:
+                    names.add(os.fsdecode(name))
+        return names, overflow
+
+    def get_changes(self, timeout: float) -> set:
+        if not self._started:
+            self._started = True
+            return set(self.scan())
+        if not self._selector.select(timeout):
+            return set()
+        names, overflow = self._read_events()
+        if overflow:
+            logging.warning('Inotify queue overflow on "{}" - rescanning'.format(self._path))
+            return set(self.scan())
+        return {os.path.join(self._path, n) for n in names if self._accepts(n)}
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            self._selector.close()
+            os.close(self._fd)
+            self._fd = -1
+
+
+def create_folder_watcher(path: str, patterns: list=None, poll_interval: float=1.0,
+                          use_inotify: bool=True) -> FolderWatcher:
+    if use_inotify:
+        try:
+            return InotifyFolderWatcher(path, patterns)
+        except OSError as e:
+            logging.info('Inotify unavailable for "{}" ({}) - falling back to polling'.format(path, e))
+    return PollingFolderWatcher(path, patterns, poll_interval)
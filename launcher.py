@@ -0,0 +1,315 @@
+import asyncio
+import io
+import itertools
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+
+class ProcessLauncher:
+
+    def popen(self, args: list, stdin=None, stdout=None, stderr=None, universal_newlines: bool=False):
+        raise NotImplementedError
+
+    async def create_subprocess_exec(self, args: list, stdin=None, stdout=None, stderr=None):
+        return await _AsyncProcess.create(self.popen(args, stdin, stdout, stderr))
+
+    def run(self, args: list, timeout: float=None, stdin=None) -> subprocess.CompletedProcess:
+        proc = self.popen(args, stdin, subprocess.PIPE, subprocess.PIPE)
+        try:
+            stdout, stderr = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+        return subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+
+    def close(self) -> None:
+        pass
+
+
+class SubprocessLauncher(ProcessLauncher):
+
+    CLOSE_FDS = True
+
+    def popen(self, args: list, stdin=None, stdout=None, stderr=None, universal_newlines: bool=False):
+        return subprocess.Popen(args, stdin=stdin, stdout=stdout, stderr=stderr, close_fds=self.CLOSE_FDS,
+                                universal_newlines=universal_newlines)
+
+    async def create_subprocess_exec(self, args: list, stdin=None, stdout=None, stderr=None):
+        return await asyncio.create_subprocess_exec(
+            *args, stdin=stdin, stdout=stdout, stderr=stderr, close_fds=self.CLOSE_FDS
+        )
+
+
+class PosixSpawnLauncher(SubprocessLauncher):
+
+    CLOSE_FDS = False
+
+
+class _ForkServerProcess:
+
+    def __init__(self, launcher, args: list, pid: int, exit_future: Future, stdin=None, stdout=None, stderr=None):
+        self.args = args
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self._launcher = launcher
+        self._exit_future = exit_future
+
+    @property
+    def returncode(self) -> int:
+        if not self._exit_future.done():
+            return None
+        return self._exit_future.result()
+
+    @property
+    def exit_future(self) -> Future:
+        return self._exit_future
+
+    def poll(self) -> int:
+        return self.returncode
+
+    def wait(self, timeout: float=None) -> int:
+        try:
+            return self._exit_future.result(timeout)
+        except FutureTimeoutError:
+            raise subprocess.TimeoutExpired(self.args, timeout) from None
+
+    def send_signal(self, sig: int) -> None:
+        if self.returncode is None:
+            self._launcher.send_signal(self.pid, sig)
+
+    def terminate(self) -> None:
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self) -> None:
+        self.send_signal(signal.SIGKILL)
+
+    def communicate(self, input=None, timeout: float=None) -> tuple:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self.stdin is not None:
+            if input:
+                self.stdin.write(input)
+            self.stdin.close()
+        chunks = {f: [] for f in (self.stdout, self.stderr) if f is not None and not f.closed}
+        with selectors.DefaultSelector() as selector:
+            for f in chunks:
+                selector.register(f, selectors.EVENT_READ)
+            while selector.get_map():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise subprocess.TimeoutExpired(self.args, timeout)
+                for key, events in selector.select(remaining):
+                    data = os.read(key.fd, 32768)
+                    if data:
+                        chunks[key.fileobj].append(data)
+                    else:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+        self.wait(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        return tuple(b''.join(chunks[f]) if f in chunks else None for f in (self.stdout, self.stderr))
+
+
+class _AsyncProcess:
+
+    def __init__(self, proc):
+        self._proc = proc
+        self.pid = proc.pid
+        self.stdin = None
+        self.stdout = None
+        self.stderr = None
+
+    @classmethod
+    async def create(cls, proc) -> '_AsyncProcess':
+        loop = asyncio.get_running_loop()
+        async_proc = cls(proc)
+        for name in ('stdout', 'stderr'):
+            f = getattr(proc, name)
+            if f is None:
+                continue
+            reader = asyncio.StreamReader()
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), f)
+            setattr(async_proc, name, reader)
+        return async_proc
+
+    @property
+    def returncode(self) -> int:
+        return self._proc.returncode
+
+    async def wait(self) -> int:
+        return await asyncio.shield(asyncio.wrap_future(self._proc.exit_future))
+
+    async def communicate(self) -> tuple:
+        async def _read(stream):
+            return None if stream is None else await stream.read()
+
+        stdout, stderr = await asyncio.gather(_read(self.stdout), _read(self.stderr))
+        await self.wait()
+        return stdout, stderr
+
+    def send_signal(self, sig: int) -> None:
+        self._proc.send_signal(sig)
+
+    def terminate(self) -> None:
+        self._proc.terminate()
+
+    def kill(self) -> None:
+        self._proc.kill()
+
+
+class ForkServerLauncher(ProcessLauncher):
+
+    SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'launcher_server.py')
+
+    MAX_MESSAGE_SIZE = 64 * 1024
+
+    def __init__(self, python_path: str=None):
+        parent_sock, server_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        logging.debug('Starting launcher server...')
+        try:
+            self._server = subprocess.Popen(
+                [python_path or sys.executable, self.SERVER_SCRIPT, str(server_sock.fileno())],
+                stdin=subprocess.DEVNULL, pass_fds=(server_sock.fileno(), )
+            )
+        finally:
+            server_sock.close()
+        self._sock = parent_sock
+        self._send_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._request_ids = itertools.count()
+        self._pending = {}
+        self._exits = {}
+        self._closed = False
+        self._reader = threading.Thread(target=self._read_replies, daemon=True)
+        self._reader.start()
+
+    def _send(self, message: dict, fds: list=()) -> None:
+        data = json.dumps(message).encode('utf-8')
+        with self._send_lock:
+            if self._closed:
+                raise OSError('Launcher server is closed')
+            socket.send_fds(self._sock, [data], list(fds))
+
+    def _read_replies(self) -> None:
+        while True:
+            try:
+                data = self._sock.recv(self.MAX_MESSAGE_SIZE)
+            except OSError:
+                data = b''
+            if not data:
+                break
+            message = json.loads(data.decode('utf-8'))
+            with self._state_lock:
+                if 'spawned' in message:
+                    future = self._pending.pop(message['spawned'], None)
+                    if future is None:
+                        if 'pid' in message:
+                            self._exits[message['pid']] = Future()
+                    elif 'pid' in message:
+                        exit_future = self._exits[message['pid']] = Future()
+                        future.set_result((message['pid'], exit_future))
+                    else:
+                        future.set_exception(OSError(message['errno'], message['error']))
+                elif 'exit' in message:
+                    exit_future = self._exits.pop(message['exit'], None)
+                    if exit_future is not None:
+                        exit_future.set_result(message['returncode'])
+        logging.debug('Launcher server connection closed')
+        with self._state_lock:
+            self._closed = True
+            for future in self._pending.values():
+                future.set_exception(OSError('Launcher server exited'))
+            for future in self._exits.values():
+                future.set_exception(ChildProcessError('Launcher server exited before the process'))
+            self._pending.clear()
+            self._exits.clear()
+
+    @staticmethod
+    def _prepare_stdio(spec, is_input: bool) -> tuple:
+        if spec is None:
+            return 'inherit', None, None
+        if spec == subprocess.DEVNULL:
+            return 'devnull', None, None
+        if spec == subprocess.PIPE:
+            read_fd, write_fd = os.pipe()
+            if is_input:
+                return 'fd', read_fd, write_fd
+            return 'fd', write_fd, read_fd
+        fd = spec if isinstance(spec, int) else spec.fileno()
+        return 'fd', os.dup(fd), None
+
+    def popen(self, args: list, stdin=None, stdout=None, stderr=None, universal_newlines: bool=False):
+        stdio = [self._prepare_stdio(stdin, True), self._prepare_stdio(stdout, False),
+                 self._prepare_stdio(stderr, False)]
+        request_id = next(self._request_ids)
+        future = Future()
+        try:
+            with self._state_lock:
+                self._pending[request_id] = future
+            self._send(
+                {'spawn': request_id, 'args': [str(a) for a in args], 'stdio': [s[0] for s in stdio]},
+                [s[1] for s in stdio if s[1] is not None]
+            )
+            pid, exit_future = future.result()
+        except BaseException:
+            with self._state_lock:
+                self._pending.pop(request_id, None)
+            for mode, child_fd, parent_fd in stdio:
+                if parent_fd is not None:
+                    os.close(parent_fd)
+            raise
+        finally:
+            for mode, child_fd, parent_fd in stdio:
+                if child_fd is not None:
+                    os.close(child_fd)
+        files = [None, None, None]
+        for n, (mode, child_fd, parent_fd) in enumerate(stdio):
+            if parent_fd is None:
+                continue
+            f = io.open(parent_fd, 'wb' if n == 0 else 'rb')
+            if universal_newlines:
+                f = io.TextIOWrapper(f, write_through=n == 0)
+            files[n] = f
+        return _ForkServerProcess(self, args, pid, exit_future, *files)
+
+    def send_signal(self, pid: int, sig: int) -> None:
+        try:
+            self._send({'signal': int(sig), 'pid': pid})
+        except OSError as e:
+            logging.debug('Unable to deliver signal {} to {}: {}'.format(sig, pid, e))
+
+    def close(self) -> None:
+        with self._send_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._sock.shutdown(socket.SHUT_RDWR)
+        self._server.wait()
+        self._reader.join()
+        self._sock.close()
+
+
+_launcher = SubprocessLauncher()
+
+
+def get_launcher() -> ProcessLauncher:
+    return _launcher
+
+
+def set_launcher(launcher: ProcessLauncher) -> None:
+    global _launcher
+    _launcher = launcher if launcher is not None else SubprocessLauncher()
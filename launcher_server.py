@@ -0,0 +1,80 @@
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+
+
+MAX_MESSAGE_SIZE = 1024 * 1024
+
+MAX_FDS = 3
+
+
+def main():
+    sock = socket.socket(fileno=int(sys.argv[1]))
+    send_lock = threading.Lock()
+    processes = {}
+    processes_lock = threading.Lock()
+
+    def send(message: dict) -> None:
+        with send_lock:
+            sock.send(json.dumps(message).encode('utf-8'))
+
+    def reap(proc: subprocess.Popen) -> None:
+        proc.wait()
+        with processes_lock:
+            processes.pop(proc.pid, None)
+        send({'exit': proc.pid, 'returncode': proc.returncode})
+
+    def spawn(request: dict, fds: list) -> None:
+        fds = list(fds)
+        stdio = []
+        for mode in request['stdio']:
+            if mode == 'fd':
+                stdio.append(fds.pop(0))
+            elif mode == 'devnull':
+                stdio.append(subprocess.DEVNULL)
+            else:
+                stdio.append(None)
+        try:
+            proc = subprocess.Popen(request['args'], stdin=stdio[0], stdout=stdio[1], stderr=stdio[2])
+        except OSError as e:
+            send({'spawned': request['spawn'], 'errno': e.errno, 'error': str(e)})
+            return
+        finally:
+            for fd in stdio:
+                if isinstance(fd, int) and fd >= 0:
+                    os.close(fd)
+        with processes_lock:
+            processes[proc.pid] = proc
+        send({'spawned': request['spawn'], 'pid': proc.pid})
+        threading.Thread(target=reap, args=(proc, ), daemon=True).start()
+
+    while True:
+        try:
+            data, fds, flags, address = socket.recv_fds(sock, MAX_MESSAGE_SIZE, MAX_FDS)
+        except OSError:
+            break
+        if not data:
+            for fd in fds:
+                os.close(fd)
+            break
+        request = json.loads(data.decode('utf-8'))
+        if 'spawn' in request:
+            spawn(request, fds)
+        elif 'signal' in request:
+            with processes_lock:
+                proc = processes.get(request['pid'])
+            if proc is not None:
+                proc.send_signal(request['signal'])
+
+    with processes_lock:
+        remaining = list(processes.values())
+    for proc in remaining:
+        proc.send_signal(signal.SIGKILL)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,53 +1,65 @@
 import logging
 import os
+import sys
+from collections.abc import Mapping
+from types import MappingProxyType
 
-from .cache import HashCache, CacheMissException
+from .cache import CacheNamespace, estimate_size, get_cache_manager
 from .ffprobe import FFprobeInfoCommand
 from .field_mode_solver import FFprobeFieldModeSolver
+from .metadata_model import FormatRecord, StreamRecord
+from .metadata_projection import MetadataProjection
 from .factory import ffprobe_factory
+from .parallel import bounded_imap_unordered
 from .exceptions import FFprobeProcessException, MetadataCollectionException
 
 
 class FFprobeMetadataResult:
 
-    def __init__(self, input_url: str, info: dict, int_prog_solver: FFprobeFieldModeSolver):
+    __slots__ = ('_input_url', '_format', '_streams', '_int_prog_solver', 'v_stream_list', 'a_stream_list',
+                 '_v_streams', '_a_streams', '_field_mode', '_filename', '_filename_ext', '_projection')
+
+    def __init__(self, input_url: str, info: dict, int_prog_solver: FFprobeFieldModeSolver,
+                 projection: MetadataProjection=None):
         self._input_url = input_url
-        self._info = info
+        self._projection = projection
+        if projection is None:
+            self._format = FormatRecord(info.get('format', {}))
+            self._streams = tuple(StreamRecord(s) for s in info.get('streams', ()))
+        else:
+            self._format = FormatRecord(info.get('format', {}), projection.format_fields)
+            self._streams = tuple(StreamRecord(s, projection.stream_fields) for s in info.get('streams', ()))
         self._int_prog_solver = int_prog_solver
-        self._av_streams_found = False
-        self._v_streams_numbers = []
-        self._a_streams_numbers = []
-        self._field_mode = {}
+        self.v_stream_list = tuple(s for s in self._streams if s.get('codec_type') == 'video')
+        self.a_stream_list = tuple(s for s in self._streams if s.get('codec_type') == 'audio')
+        logging.debug('Found {} video stream(s) and {} audio stream(s)'.format(
+            len(self.v_stream_list), len(self.a_stream_list)
+        ))
+        self._v_streams = MappingProxyType({s['index']: s for s in self.v_stream_list})
+        self._a_streams = MappingProxyType({s['index']: s for s in self.a_stream_list})
+        self._field_mode = None
         self._filename = ''
         self._filename_ext = ''
 
-    def _find_av_streams(self):
-        logging.debug('Searching for video and audio streams...')
-        for n, s in enumerate(self._info['streams']):
-            if s['codec_type'] == 'video':
-                self._v_streams_numbers.append(n)
-            elif s['codec_type'] == 'audio':
-                self._a_streams_numbers.append(n)
-        logging.debug('Found {} video stream(s) and {} audio stream(s)'.format(
-            len(self._v_streams_numbers), len(self._a_streams_numbers)
-        ))
-        self._av_streams_found = True
+    @property
+    def projection(self) -> MetadataProjection:
+        return self._projection
+
+    @property
+    def streams(self) -> tuple:
+        return self._streams
 
     @property
-    def v_streams(self) -> dict:
-        if not self._av_streams_found:
-            self._find_av_streams()
-        return {self._info['streams'][n]['index']: self._info['streams'][n] for n in self._v_streams_numbers}
+    def v_streams(self) -> Mapping:
+        return self._v_streams
 
     @property
-    def a_streams(self) -> dict:
-        if not self._av_streams_found:
-            self._find_av_streams()
-        return {self._info['streams'][n]['index']: self._info['streams'][n] for n in self._a_streams_numbers}
+    def a_streams(self) -> Mapping:
+        return self._a_streams
 
     @property
-    def format(self) -> dict:
-        return self._info['format']
+    def format(self) -> FormatRecord:
+        return self._format
 
     @property
     def filename(self) -> str:
@@ -61,45 +73,123 @@ class FFprobeMetadataResult:
             self._filename_ext = os.path.split(self._input_url)[1]
         return self._filename_ext
 
+    @property
+    def duration(self) -> float:
+        return self._format.num_duration
+
+    def seed_field_modes(self, decisions: dict) -> None:
+        if self._field_mode is None:
+            self._field_mode = {}
+        self._field_mode.update(decisions)
+
     def get_field_mode(self, stream_number: int) -> int:
+        if self._field_mode is None:
+            self._field_mode = {}
         if stream_number not in self._field_mode:
-            self._field_mode[stream_number] = self._int_prog_solver.solve(self._input_url, stream_number)
+            self._field_mode[stream_number] = self._int_prog_solver.solve(
+                self._input_url, stream_number, self.duration
+            )
+        return self._field_mode[stream_number]
+
+    async def get_field_mode_async(self, stream_number: int) -> int:
+        if self._field_mode is None:
+            self._field_mode = {}
+        if stream_number not in self._field_mode:
+            self._field_mode[stream_number] = await self._int_prog_solver.solve_async(
+                self._input_url, stream_number, self.duration
+            )
         return self._field_mode[stream_number]
 
     def __str__(self):
         return str({
-            'a_streams': self.a_streams,
+            'a_streams': dict(self.a_streams),
             'filename': self.filename,
             'filename_ext': self.filename_ext,
             'format': self.format,
-            'v_streams': self.v_streams,
+            'v_streams': dict(self.v_streams),
         })
 
 
 class FFprobeMetadataCollector:
 
+    CACHE_NAMESPACE = 'metadata'
+
     def __init__(self):
         logging.debug('Fetching FFprobeInfoCommand object...')
         self._ffprobe_info = ffprobe_factory.get_ffprobe_command(FFprobeInfoCommand)
         logging.debug('Fetching FFprobeFieldModeSolver object...')
         self._int_prog_solver = ffprobe_factory.get_ffprobe_field_mode_solver(FFprobeFieldModeSolver)
-        self._cache = HashCache(10, logging.debug)
+        self._cache = get_cache_manager().get_namespace(
+            self.CACHE_NAMESPACE, sizer=self._get_result_size, logging_func=logging.debug
+        )
 
-    def get_metadata(self, input_url: str) -> FFprobeMetadataResult:
-        logging.debug('Trying to get file metadata from cache...')
+    @property
+    def cache(self) -> CacheNamespace:
+        return self._cache
+
+    @staticmethod
+    def _get_result_size(result: FFprobeMetadataResult) -> int:
+        return sys.getsizeof(result) + estimate_size((result.format, result.streams))
+
+    @staticmethod
+    def _get_cache_id(input_url: str, projection: MetadataProjection=None) -> tuple:
+        return input_url, projection.show_entries if projection is not None else None
+
+    def _get_probe_args(self, projection: MetadataProjection=None, with_field_mode: bool=False) -> dict:
+        args = {
+            'use_cache': False,
+            'show_programs': False,
+            'show_entries': projection.show_entries if projection is not None else None,
+        }
+        if with_field_mode and self._int_prog_solver.can_seed():
+            args['frame_entries'] = self._int_prog_solver.SEED_FRAME_ENTRIES
+            args['read_intervals'] = self._int_prog_solver.SEED_READ_INTERVALS
+        return args
+
+    def _build_result(self, input_url: str, info: dict, projection: MetadataProjection=None) -> FFprobeMetadataResult:
+        result = FFprobeMetadataResult(input_url, info, self._int_prog_solver, projection)
+        if 'frames' in info:
+            result.seed_field_modes(self._int_prog_solver.seed(
+                input_url, [s['index'] for s in result.v_stream_list], info['frames']
+            ))
+        return result
+
+    def _collect(self, input_url: str, projection: MetadataProjection=None,
+                 with_field_mode: bool=False) -> FFprobeMetadataResult:
         try:
-            cached_value = self._cache.from_cache(input_url)
-        except CacheMissException:
-            pass
-        else:
-            return cached_value
+            info = self._ffprobe_info.exec(input_url, **self._get_probe_args(projection, with_field_mode))
+        except FFprobeProcessException as e:
+            raise MetadataCollectionException from e
+        return self._build_result(input_url, info, projection)
+
+    async def _collect_async(self, input_url: str, projection: MetadataProjection=None,
+                             with_field_mode: bool=False) -> FFprobeMetadataResult:
         try:
-            result = FFprobeMetadataResult(
-                input_url,
-                self._ffprobe_info.exec(input_url, show_programs=False),
-                self._int_prog_solver
-            )
+            info = await self._ffprobe_info.exec_async(input_url, **self._get_probe_args(projection, with_field_mode))
         except FFprobeProcessException as e:
             raise MetadataCollectionException from e
-        self._cache.to_cache(input_url, result)
-        return result
+        return self._build_result(input_url, info, projection)
+
+    def get_metadata(self, input_url: str, projection: MetadataProjection=None,
+                     with_field_mode: bool=False) -> FFprobeMetadataResult:
+        logging.debug('Trying to get file metadata from cache...')
+        return self.cache.get_or_compute(
+            self._get_cache_id(input_url, projection), lambda: self._collect(input_url, projection, with_field_mode)
+        )
+
+    def get_metadata_many(self, input_urls, max_workers: int = 8, max_pending: int = None,
+                          projection: MetadataProjection = None, with_field_mode: bool = False):
+        logging.debug('Collecting metadata with {} workers...'.format(max_workers))
+        for input_url, result, exception in bounded_imap_unordered(
+                lambda u: self.get_metadata(u, projection, with_field_mode), input_urls, max_workers, max_pending):
+            if exception is not None:
+                logging.warning('Metadata collection for "{}" failed: {}'.format(input_url, exception))
+            yield input_url, result, exception
+
+    async def get_metadata_async(self, input_url: str, projection: MetadataProjection=None,
+                                 with_field_mode: bool=False) -> FFprobeMetadataResult:
+        logging.debug('Trying to get file metadata from cache...')
+        return await self.cache.get_or_compute_async(
+            self._get_cache_id(input_url, projection),
+            lambda: self._collect_async(input_url, projection, with_field_mode)
+        )
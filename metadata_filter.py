@@ -1,147 +1,305 @@
 import logging
+import operator
 import re
 
 from .metadata_collector import FFprobeMetadataCollector, FFprobeMetadataResult
+from .metadata_projection import MetadataProjection
 from .exceptions import UnknownFilterSelector, UnknownMetadataParameter, WrongConditionType, UnknownOperator,\
     ConditionPairProcessingException, UnknownStreamType, StreamIndexOutOfRange, MetadataCollectionException
 from .factory import ffprobe_factory
+from .parallel import bounded_imap_unordered
 
 
-class FFprobeMetadataFilter:
+class FilterCondition:
+
+    COST_CHEAP = 0
+    COST_EXPENSIVE = 1
+
+    COST = COST_CHEAP
+
+    def __init__(self, predicates: tuple):
+        self._predicates = predicates
+
+    @property
+    def predicates(self) -> tuple:
+        return self._predicates
+
+    def get_value(self, input_meta: FFprobeMetadataResult):
+        raise NotImplementedError
+
+    async def get_value_async(self, input_meta: FFprobeMetadataResult):
+        return self.get_value(input_meta)
+
+    def test(self, value) -> bool:
+        for operator_name, operator_func, value_right, value_type in self._predicates:
+            try:
+                value_left_typed = value_type(value)
+            except ValueError as e:
+                raise ConditionPairProcessingException(value, operator_name, value_right) from e
+            try:
+                if not operator_func(value_left_typed, value_right):
+                    return False
+            except Exception as e:
+                raise ConditionPairProcessingException(value_left_typed, operator_name, value_right) from e
+        return True
+
+    def evaluate(self, input_meta: FFprobeMetadataResult) -> bool:
+        return self.test(self.get_value(input_meta))
+
+    async def evaluate_async(self, input_meta: FFprobeMetadataResult) -> bool:
+        return self.test(await self.get_value_async(input_meta))
+
+
+class FormatParameterCondition(FilterCondition):
+
+    def __init__(self, param: str, predicates: tuple):
+        super().__init__(predicates)
+        self.param = param
+
+    def get_value(self, input_meta: FFprobeMetadataResult):
+        try:
+            return input_meta.format[self.param]
+        except KeyError as e:
+            raise UnknownMetadataParameter(self.param) from e
+
+    def __str__(self):
+        return 'format:{}'.format(self.param)
+
+
+class StreamCondition(FilterCondition):
+
+    def __init__(self, s_type: str, s_index: int, predicates: tuple):
+        super().__init__(predicates)
+        self.s_type = s_type
+        self.s_index = s_index
+        self._streams_attr = '{}_streams'.format(s_type)
+
+    def get_stream(self, input_meta: FFprobeMetadataResult):
+        all_streams_data = getattr(input_meta, self._streams_attr)
+        try:
+            return all_streams_data[self.s_index]
+        except KeyError as e:
+            raise StreamIndexOutOfRange(self.s_index) from e
+
+
+class StreamParameterCondition(StreamCondition):
+
+    def __init__(self, s_type: str, s_index: int, param: str, predicates: tuple):
+        super().__init__(s_type, s_index, predicates)
+        self.param = param
+
+    def get_value(self, input_meta: FFprobeMetadataResult):
+        try:
+            return self.get_stream(input_meta)[self.param]
+        except KeyError as e:
+            raise UnknownMetadataParameter(self.param) from e
+
+    def __str__(self):
+        return 'stream:{}:{}:{}'.format(self.s_type, self.s_index, self.param)
+
+
+class StreamFieldModeCondition(StreamCondition):
+
+    COST = FilterCondition.COST_EXPENSIVE
+
+    def get_value(self, input_meta: FFprobeMetadataResult):
+        self.get_stream(input_meta)
+        return input_meta.get_field_mode(self.s_index)
+
+    async def get_value_async(self, input_meta: FFprobeMetadataResult):
+        self.get_stream(input_meta)
+        return await input_meta.get_field_mode_async(self.s_index)
+
+    def __str__(self):
+        return 'stream:{}:{}:field_mode'.format(self.s_type, self.s_index)
+
+
+class StreamCountCondition(FilterCondition):
+
+    def __init__(self, s_type: str, predicates: tuple):
+        super().__init__(predicates)
+        self.s_type = s_type
+        self._streams_attr = '{}_streams'.format(s_type)
+
+    def get_value(self, input_meta: FFprobeMetadataResult):
+        return len(getattr(input_meta, self._streams_attr))
+
+    def __str__(self):
+        return 'count:{}'.format(self.s_type)
+
+
+class CompiledMetadataFilter:
+
+    def __init__(self, conditions: list):
+        self._conditions = tuple(sorted(conditions, key=lambda c: c.COST))
+        self._projection = MetadataProjection(
+            [c.param for c in self._conditions if isinstance(c, FormatParameterCondition)],
+            [c.param for c in self._conditions if isinstance(c, StreamParameterCondition)]
+        )
+
+    @property
+    def conditions(self) -> tuple:
+        return self._conditions
+
+    @property
+    def projection(self) -> MetadataProjection:
+        return self._projection
+
+    @property
+    def needs_field_mode(self) -> bool:
+        return any(c.COST == FilterCondition.COST_EXPENSIVE for c in self._conditions)
+
+    def __call__(self, input_meta: FFprobeMetadataResult) -> bool:
+        for c in self._conditions:
+            if not c.evaluate(input_meta):
+                logging.debug('Failed on {}'.format(c))
+                return False
+        return True
+
+    async def evaluate_async(self, input_meta: FFprobeMetadataResult) -> bool:
+        for c in self._conditions:
+            if not await c.evaluate_async(input_meta):
+                logging.debug('Failed on {}'.format(c))
+                return False
+        return True
+
+
+class MetadataFilterCompiler:
 
     STREAM_SELECTOR_RE = r'^stream:(v|a):(\d+)$'
     COUNT_SELECTOR_RE = r'^count:(v|a)$'
 
+    OPERATORS = {
+        'eq': operator.eq,
+        'neq': operator.ne,
+        'gt': operator.gt,
+        'gte': operator.ge,
+        'lt': operator.lt,
+        'lte': operator.le,
+    }
+
+    STREAM_TYPES = ('v', 'a')
+
     def __init__(self):
-        logging.debug('Fetching FFprobeMetadataCollector object...')
-        self._ff_metadata_collector = ffprobe_factory.get_ffprobe_metadata_collector(FFprobeMetadataCollector)
         self._stream_selector_re = re.compile(self.STREAM_SELECTOR_RE, re.IGNORECASE)
         self._count_selector_re = re.compile(self.COUNT_SELECTOR_RE, re.IGNORECASE)
 
-    def filter(self, input_url: str, filter_params: dict) -> bool:
-        logging.debug('Filtering started with parameters: {}'.format(filter_params))
-        try:
-            input_meta = self._ff_metadata_collector.get_metadata(input_url)
-        except MetadataCollectionException:
-            logging.warning('Metadata collection error - filter failed')
-            return False
+    def compile(self, filter_params: dict) -> CompiledMetadataFilter:
+        logging.debug('Compiling filter parameters: {}'.format(filter_params))
+        conditions = []
         for selector, selector_data in filter_params.items():
-            logging.debug('Processing selector "{}"...'.format(selector))
-            result = False
             if selector.lower() == 'format':
-                logging.debug('This is a format selector')
-                result = self._filter_format(input_meta, selector_data)
-            else:
-                matched = False
-
-                match = self._stream_selector_re.match(selector)
-                if match:
-                    logging.debug('This is a stream selector')
-                    matched = True
-                    result = self._filter_stream(*match.groups(), input_meta, selector_data)
-
-                match = self._count_selector_re.match(selector)
-                if match:
-                    logging.debug('This is a count selector')
-                    matched = True
-                    result = self._filter_count(*match.groups(), input_meta, selector_data)
-
-                if not matched:
-                    raise UnknownFilterSelector(selector)
-            if result:
-                logging.debug('Passed')
-            else:
-                logging.debug('Failed')
-                return False
-        logging.debug('Filter passed')
-        return True
+                for param, condition in selector_data.items():
+                    conditions.append(FormatParameterCondition(param, self._compile_condition(condition)))
+                continue
 
-    def _filter_format(self, input_meta: FFprobeMetadataResult, selector_data: dict) -> bool:
-        format_data = input_meta.format
-        for param, condition in selector_data.items():
-            try:
-                param_value = format_data[param]
-                logging.debug('Format parameter name: {}, value: {}, condition: {}'.format(
-                    param, param_value, condition))
-            except KeyError as e:
-                raise UnknownMetadataParameter(param) from e
-            if not self._process_condition(param_value, condition):
-                return False
-        return True
+            match = self._stream_selector_re.match(selector)
+            if match:
+                s_type, s_index = match.groups()
+                self._check_stream_type(s_type)
+                for param, condition in selector_data.items():
+                    if param == 'field_mode':
+                        conditions.append(StreamFieldModeCondition(
+                            s_type, int(s_index), self._compile_condition(condition)
+                        ))
+                    else:
+                        conditions.append(StreamParameterCondition(
+                            s_type, int(s_index), param, self._compile_condition(condition)
+                        ))
+                continue
 
-    def _filter_stream(self, s_type: str, s_index: str, input_meta: FFprobeMetadataResult, selector_data) -> bool:
-        s_index = int(s_index)
-        try:
-            all_streams_data = getattr(input_meta, '{}_streams'.format(s_type))
-        except AttributeError as e:
-            raise UnknownStreamType(s_type) from e
-        if len(all_streams_data) < s_index:
-            raise StreamIndexOutOfRange(s_index)
-        stream_data = all_streams_data[s_index]
-        for param, condition in selector_data.items():
-            try:
-                param_value = stream_data[param]
-                logging.debug('Stream parameter name: {}, value: {}, condition: {}'.format(
-                    param, param_value, condition))
-            except KeyError as e:
-                if param == 'field_mode':
-                    param_value = input_meta.get_field_mode(s_index)
-                    logging.debug('Stream field mode is {}, condition: {}'.format(param_value, condition))
-                else:
-                    raise UnknownMetadataParameter(param) from e
-            if not self._process_condition(param_value, condition):
-                return False
-        return True
+            match = self._count_selector_re.match(selector)
+            if match:
+                s_type = match.group(1)
+                self._check_stream_type(s_type)
+                conditions.append(StreamCountCondition(s_type, self._compile_condition(selector_data)))
+                continue
 
-    def _filter_count(self, s_type: str, input_meta: FFprobeMetadataResult, selector_data) -> bool:
-        if s_type == 'v':
-            vs_count = len(input_meta.v_streams)
-            logging.debug('Video streams count: {}, condition: {}'.format(vs_count, selector_data))
-            return self._process_condition(vs_count, selector_data)
-        elif s_type == 'a':
-            as_count = len(input_meta.a_streams)
-            logging.debug('Audio streams count: {}, condition: {}'.format(as_count, selector_data))
-            return self._process_condition(as_count, selector_data)
-        else:
+            raise UnknownFilterSelector(selector)
+        return CompiledMetadataFilter(conditions)
+
+    def _check_stream_type(self, s_type: str) -> None:
+        if s_type not in self.STREAM_TYPES:
             raise UnknownStreamType(s_type)
 
-    def _process_condition(self, value, condition) -> bool:
+    def _compile_condition(self, condition) -> tuple:
         t = type(condition)
         if t in [int, float, str]:
-            logging.debug('Condition is a simple value')
-            return self._process_cond_pair(value, 'eq', condition)
-        elif t == list:
+            return self._compile_cond_pair('eq', condition),
+        elif t == list and condition:
             if type(condition[0]) == str:
-                logging.debug('Condition is a [operator, value] list')
-                return self._process_cond_pair(value, *condition)
+                return self._compile_cond_pair(*self._check_cond_pair(condition)),
             elif type(condition[0]) == list:
-                logging.debug('Condition is a list of [operator, value] lists')
-                return all(map(lambda x: self._process_cond_pair(value, *x), condition))
-        else:
+                return tuple(self._compile_cond_pair(*self._check_cond_pair(c)) for c in condition)
+        raise WrongConditionType(t)
+
+    @staticmethod
+    def _check_cond_pair(condition) -> list:
+        if type(condition) != list or len(condition) != 2:
             raise WrongConditionType(type(condition))
+        return condition
 
-    def _process_cond_pair(self, value_left, operator: str, value_right) -> bool:
-        operator = operator.lower()
+    def _compile_cond_pair(self, operator_name: str, value_right) -> tuple:
+        operator_name = operator_name.lower()
         try:
-            value_left_typed = type(value_right)(value_left)
-        except ValueError as e:
-            raise ConditionPairProcessingException(value_left, operator, value_right) from e
+            operator_func = self.OPERATORS[operator_name]
+        except KeyError as e:
+            raise UnknownOperator(operator_name) from e
+        return operator_name, operator_func, value_right, type(value_right)
+
+
+class FFprobeMetadataFilter:
+
+    def __init__(self, use_projection: bool=False, seed_field_mode: bool=False):
+        logging.debug('Fetching FFprobeMetadataCollector object...')
+        self._ff_metadata_collector = ffprobe_factory.get_ffprobe_metadata_collector(FFprobeMetadataCollector)
+        self._compiler = MetadataFilterCompiler()
+        self._use_projection = use_projection
+        self._seed_field_mode = seed_field_mode
+
+    def compile(self, filter_params: dict) -> CompiledMetadataFilter:
+        return self._compiler.compile(filter_params)
+
+    def _get_compiled(self, filter_params) -> CompiledMetadataFilter:
+        if isinstance(filter_params, CompiledMetadataFilter):
+            return filter_params
+        return self.compile(filter_params)
+
+    def filter(self, input_url: str, filter_params) -> bool:
+        compiled = self._get_compiled(filter_params)
         try:
-            if operator == 'eq':
-                return value_left_typed == value_right
-            elif operator == 'neq':
-                return value_left_typed != value_right
-            elif operator == 'gt':
-                return value_left_typed > value_right
-            elif operator == 'gte':
-                return value_left_typed >= value_right
-            elif operator == 'lt':
-                return value_left_typed < value_right
-            elif operator == 'lte':
-                return value_left_typed <= value_right
-            else:
-                raise UnknownOperator(operator)
-        except UnknownOperator as e:
-            raise e
-        except Exception as e:
-            raise ConditionPairProcessingException(value_left_typed, operator, value_right) from e
+            input_meta = self._ff_metadata_collector.get_metadata(
+                input_url, compiled.projection if self._use_projection else None,
+                self._seed_field_mode and compiled.needs_field_mode
+            )
+        except MetadataCollectionException:
+            logging.warning('Metadata collection error - filter failed')
+            return False
+        if compiled(input_meta):
+            logging.debug('Filter passed')
+            return True
+        return False
+
+    def filter_many(self, input_urls, filter_params, max_workers: int = 8, max_pending: int = None):
+        compiled = self._get_compiled(filter_params)
+        for input_url, result, exception in bounded_imap_unordered(
+                lambda u: self.filter(u, compiled), input_urls, max_workers, max_pending):
+            if exception is not None:
+                logging.warning('Filtering of "{}" failed: {}'.format(input_url, exception))
+                result = False
+            yield input_url, result, exception
+
+    async def filter_async(self, input_url: str, filter_params) -> bool:
+        compiled = self._get_compiled(filter_params)
+        try:
+            input_meta = await self._ff_metadata_collector.get_metadata_async(
+                input_url, compiled.projection if self._use_projection else None,
+                self._seed_field_mode and compiled.needs_field_mode
+            )
+        except MetadataCollectionException:
+            logging.warning('Metadata collection error - filter failed')
+            return False
+        if await compiled.evaluate_async(input_meta):
+            logging.debug('Filter passed')
+            return True
+        return False
@@ -0,0 +1,150 @@
+import sys
+from collections.abc import Mapping
+
+from .exceptions import UnprojectedMetadataField
+
+
+class _Shape:
+
+    __slots__ = ('keys', 'index', 'fields', 'interned', 'numeric')
+
+    MAX_SHAPES = 1024
+
+    _shapes = {}
+
+    def __init__(self, record_class: type, keys: tuple, fields: frozenset=None):
+        self.keys = tuple(sys.intern(k) for k in keys)
+        self.index = {k: n for n, k in enumerate(self.keys)}
+        self.fields = fields
+        self.interned = tuple(n for n, k in enumerate(keys) if k in record_class.INTERNED_FIELDS)
+        self.numeric = tuple((attr, self.index.get(key), parser) for attr, key, parser in record_class.NUMERIC_FIELDS)
+
+    @classmethod
+    def get(cls, record_class: type, keys: tuple, fields: frozenset=None) -> '_Shape':
+        shape_key = (record_class, keys, fields)
+        shape = cls._shapes.get(shape_key)
+        if shape is None:
+            shape = cls(record_class, keys, fields)
+            if len(cls._shapes) < cls.MAX_SHAPES:
+                shape = cls._shapes.setdefault(shape_key, shape)
+        return shape
+
+
+class CompactRecord(Mapping):
+
+    __slots__ = ('_shape', '_values')
+
+    INTERNED_FIELDS = frozenset()
+
+    NUMERIC_FIELDS = ()
+
+    def __init__(self, data: dict, fields: frozenset=None):
+        shape = self._shape = _Shape.get(type(self), tuple(data), fields)
+        values = list(data.values())
+        for n in shape.interned:
+            if type(values[n]) is str:
+                values[n] = sys.intern(values[n])
+        for attr, n, parser in shape.numeric:
+            setattr(self, attr, None if n is None else parser(values[n]))
+        self._values = tuple(values)
+
+    def __getitem__(self, key):
+        try:
+            return self._values[self._shape.index[key]]
+        except KeyError:
+            fields = self._shape.fields
+            if fields is not None and key not in fields:
+                raise UnprojectedMetadataField(key) from None
+            raise
+
+    @property
+    def fields(self) -> frozenset:
+        return self._shape.fields
+
+    def __contains__(self, key):
+        if key in self._shape.index:
+            return True
+        fields = self._shape.fields
+        if fields is not None and key not in fields:
+            raise UnprojectedMetadataField(key)
+        return False
+
+    def __iter__(self):
+        return iter(self._shape.keys)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def to_dict(self) -> dict:
+        return dict(zip(self._shape.keys, self._values))
+
+    def __getstate__(self):
+        return self.to_dict(), self._shape.fields
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+def parse_int(value) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_rational(value) -> float:
+    try:
+        num, _, den = value.partition('/')
+        rational = float(num) / float(den) if den else float(num)
+    except (AttributeError, ValueError, ZeroDivisionError):
+        return None
+    return rational or None
+
+
+class FormatRecord(CompactRecord):
+
+    __slots__ = ('num_duration', 'num_start_time', 'num_size', 'num_bit_rate', 'num_nb_streams')
+
+    INTERNED_FIELDS = frozenset(('format_name', 'format_long_name'))
+
+    NUMERIC_FIELDS = (
+        ('num_duration', 'duration', parse_float),
+        ('num_start_time', 'start_time', parse_float),
+        ('num_size', 'size', parse_int),
+        ('num_bit_rate', 'bit_rate', parse_int),
+        ('num_nb_streams', 'nb_streams', parse_int),
+    )
+
+
+class StreamRecord(CompactRecord):
+
+    __slots__ = ('num_index', 'num_width', 'num_height', 'num_frame_rate', 'num_sample_rate', 'num_channels',
+                 'num_duration', 'num_bit_rate')
+
+    INTERNED_FIELDS = frozenset((
+        'codec_name', 'codec_long_name', 'profile', 'codec_type', 'codec_tag_string', 'codec_tag', 'pix_fmt',
+        'color_range', 'color_space', 'color_transfer', 'color_primaries', 'chroma_location', 'field_order',
+        'sample_fmt', 'channel_layout', 'r_frame_rate', 'avg_frame_rate', 'time_base', 'sample_aspect_ratio',
+        'display_aspect_ratio', 'sample_rate', 'is_avc', 'nal_length_size',
+    ))
+
+    NUMERIC_FIELDS = (
+        ('num_index', 'index', parse_int),
+        ('num_width', 'width', parse_int),
+        ('num_height', 'height', parse_int),
+        ('num_frame_rate', 'r_frame_rate', parse_rational),
+        ('num_sample_rate', 'sample_rate', parse_int),
+        ('num_channels', 'channels', parse_int),
+        ('num_duration', 'duration', parse_float),
+        ('num_bit_rate', 'bit_rate', parse_int),
+    )
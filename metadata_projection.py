@@ -0,0 +1,52 @@
+class MetadataProjection:
+
+    BASE_FORMAT_FIELDS = frozenset(('duration', 'start_time'))
+
+    BASE_STREAM_FIELDS = frozenset(('index', 'codec_type'))
+
+    NESTED_SECTIONS = {
+        'format': ('tags', ),
+        'stream': ('tags', 'disposition'),
+    }
+
+    def __init__(self, format_fields=(), stream_fields=()):
+        self._format_fields = self.BASE_FORMAT_FIELDS.union(format_fields)
+        self._stream_fields = self.BASE_STREAM_FIELDS.union(stream_fields)
+        sections = []
+        for section, fields in (('format', self._format_fields), ('stream', self._stream_fields)):
+            nested = self.NESTED_SECTIONS[section]
+            sections.append('{}={}'.format(section, ','.join(sorted(f for f in fields if f not in nested))))
+            sections.extend('{}_{}'.format(section, f) for f in nested if f in fields)
+        self._show_entries = ':'.join(sections)
+
+    @property
+    def format_fields(self) -> frozenset:
+        return self._format_fields
+
+    @property
+    def stream_fields(self) -> frozenset:
+        return self._stream_fields
+
+    @property
+    def show_entries(self) -> str:
+        return self._show_entries
+
+    @classmethod
+    def merge(cls, *projections) -> 'MetadataProjection':
+        if not projections or any(p is None for p in projections):
+            return None
+        return cls(
+            frozenset().union(*(p.format_fields for p in projections)),
+            frozenset().union(*(p.stream_fields for p in projections))
+        )
+
+    def __eq__(self, other):
+        if not isinstance(other, MetadataProjection):
+            return NotImplemented
+        return self._show_entries == other._show_entries
+
+    def __hash__(self):
+        return hash(self._show_entries)
+
+    def __repr__(self):
+        return 'MetadataProjection({})'.format(self._show_entries)
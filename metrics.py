@@ -0,0 +1,219 @@
+import bisect
+import json
+import threading
+import time
+import weakref
+
+
+class Histogram:
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+    def __init__(self, buckets: tuple=None):
+        self._buckets = tuple(sorted(buckets or self.DEFAULT_BUCKETS))
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value: float) -> None:
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._sum += value
+        self._count += 1
+
+    def snapshot(self) -> dict:
+        cumulative = []
+        total = 0
+        for bound, count in zip(self._buckets + (float('inf'), ), self._counts):
+            total += count
+            cumulative.append((bound, total))
+        return {'count': self._count, 'sum': self._sum, 'buckets': cumulative}
+
+
+class _Timer:
+
+    def __init__(self, registry, name: str, labels: dict):
+        self._registry = registry
+        self._name = name
+        self._labels = labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._registry.observe(self._name, time.perf_counter() - self._start, **self._labels)
+        return False
+
+
+class _NullTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_tracked_caches = weakref.WeakKeyDictionary()
+_tracked_caches_lock = threading.Lock()
+
+
+def track_cache(name: str, cache) -> None:
+    with _tracked_caches_lock:
+        _tracked_caches[cache] = name
+
+
+def get_cache_stats() -> dict:
+    with _tracked_caches_lock:
+        caches = list(_tracked_caches.items())
+    stats = {}
+    for cache, name in caches:
+        hits, misses, total, ratio = cache.get_stats()
+        evictions = cache.get_evictions() if hasattr(cache, 'get_evictions') else 0
+        coalesced = cache.get_coalesced() if hasattr(cache, 'get_coalesced') else 0
+        expirations = cache.get_expirations() if hasattr(cache, 'get_expirations') else 0
+        size = cache.get_size() if hasattr(cache, 'get_size') else 0
+        s = stats.setdefault(name, {'hits': 0, 'misses': 0, 'evictions': 0, 'coalesced': 0, 'expirations': 0,
+                                    'size': 0, 'instances': 0})
+        s['hits'] += hits
+        s['misses'] += misses
+        s['evictions'] += evictions
+        s['coalesced'] += coalesced
+        s['expirations'] += expirations
+        s['size'] += size
+        s['instances'] += 1
+    for s in stats.values():
+        total = s['hits'] + s['misses']
+        s['ratio'] = s['hits'] / total if total else 0.0
+    return stats
+
+
+class MetricsRegistry:
+
+    PREFIX = 'pyffwrapper_'
+
+    enabled = True
+
+    def __init__(self, buckets: tuple=None):
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float=1, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self._buckets)
+            histogram.observe(value)
+
+    def timer(self, name: str, **labels):
+        return _Timer(self, name, labels)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            histograms = [
+                dict({'name': name, 'labels': dict(labels)}, **h.snapshot())
+                for (name, labels), h in sorted(self._histograms.items())
+            ]
+        return {
+            'timestamp': time.time(),
+            'counters': counters,
+            'histograms': histograms,
+            'caches': get_cache_stats(),
+        }
+
+    def to_json(self) -> str:
+        snapshot = self.snapshot()
+        for h in snapshot['histograms']:
+            h['buckets'] = [['+Inf' if b == float('inf') else b, c] for b, c in h['buckets']]
+        return json.dumps(snapshot)
+
+    @staticmethod
+    def _format_labels(labels: dict, extra: dict=None) -> str:
+        labels = dict(labels, **(extra or {}))
+        if not labels:
+            return ''
+        return '{{{}}}'.format(','.join(
+            '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for k, v in sorted(labels.items())
+        ))
+
+    @staticmethod
+    def _format_value(value: float) -> str:
+        if value == float('inf'):
+            return '+Inf'
+        return repr(float(value)) if isinstance(value, float) else str(value)
+
+    def to_prometheus(self) -> str:
+        snapshot = self.snapshot()
+        lines = []
+        declared = set()
+
+        def _declare(name, metric_type):
+            if name not in declared:
+                declared.add(name)
+                lines.append('# TYPE {} {}'.format(name, metric_type))
+
+        for c in snapshot['counters']:
+            name = self.PREFIX + c['name']
+            _declare(name, 'counter')
+            lines.append('{}{} {}'.format(name, self._format_labels(c['labels']), self._format_value(c['value'])))
+        for h in snapshot['histograms']:
+            name = self.PREFIX + h['name']
+            _declare(name, 'histogram')
+            for bound, count in h['buckets']:
+                lines.append('{}_bucket{} {}'.format(
+                    name, self._format_labels(h['labels'], {'le': self._format_value(bound)}), count
+                ))
+            lines.append('{}_sum{} {}'.format(name, self._format_labels(h['labels']), self._format_value(h['sum'])))
+            lines.append('{}_count{} {}'.format(name, self._format_labels(h['labels']), h['count']))
+        for field in ('hits', 'misses', 'evictions', 'coalesced'):
+            name = '{}cache_{}_total'.format(self.PREFIX, field)
+            for cache_name, s in sorted(snapshot['caches'].items()):
+                _declare(name, 'counter')
+                lines.append('{}{} {}'.format(name, self._format_labels({'cache': cache_name}), s[field]))
+        return '\n'.join(lines) + '\n'
+
+
+class NullMetricsRegistry(MetricsRegistry):
+
+    enabled = False
+
+    _NULL_TIMER = _NullTimer()
+
+    def inc(self, name: str, value: float=1, **labels) -> None:
+        pass
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        pass
+
+    def timer(self, name: str, **labels):
+        return self._NULL_TIMER
+
+
+_registry = NullMetricsRegistry()
+
+
+def get_registry() -> MetricsRegistry:
+    return _registry
+
+
+def set_registry(registry: MetricsRegistry) -> None:
+    global _registry
+    _registry = registry if registry is not None else NullMetricsRegistry()
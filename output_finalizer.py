@@ -0,0 +1,253 @@
+import os
+import ctypes
+import ctypes.util
+import errno
+import logging
+import shutil
+import uuid
+
+from .metrics import get_registry
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class FinalizeReport:
+
+    METHOD_RENAME = 'rename'
+    METHOD_REFLINK = 'reflink'
+    METHOD_COPY = 'copy'
+    METHOD_SIMULATED = 'simulated'
+    METHOD_DIRECT = 'direct'
+
+    def __init__(self, tmp_path: str, requested_path: str, out_path: str, method: str):
+        self.tmp_path = tmp_path
+        self.requested_path = requested_path
+        self.out_path = out_path
+        self.method = method
+
+    @property
+    def renamed(self) -> bool:
+        return self.out_path != self.requested_path
+
+    def __repr__(self):
+        return 'FinalizeReport(out_path={!r}, method={!r}, renamed={})'.format(
+            self.out_path, self.method, self.renamed
+        )
+
+
+class OutputFinalizer:
+
+    PLACEMENT_TMP_DIR = 'tmp_dir'
+    PLACEMENT_SIBLING = 'sibling'
+    PLACEMENT_MOUNT_MAP = 'mount_map'
+    PLACEMENT_AUTO = 'auto'
+
+    FSYNC_NONE = 'none'
+    FSYNC_FILE = 'file'
+    FSYNC_FULL = 'full'
+
+    FICLONE = 0x40049409
+
+    COPY_CHUNK_SIZE = 16 * 1024 * 1024
+
+    SIBLING_TMP_NAME = '.{}'
+
+    AT_FDCWD = -100
+
+    RENAME_NOREPLACE = 1
+
+    _renameat2 = None
+
+    def __init__(self, tmp_dir: str, placement: str=PLACEMENT_TMP_DIR, mount_map: dict=None,
+                 fsync_policy: str=FSYNC_NONE):
+        if placement not in (self.PLACEMENT_TMP_DIR, self.PLACEMENT_SIBLING, self.PLACEMENT_MOUNT_MAP,
+                             self.PLACEMENT_AUTO):
+            raise ValueError('Unknown temporary file placement: {}'.format(placement))
+        if fsync_policy not in (self.FSYNC_NONE, self.FSYNC_FILE, self.FSYNC_FULL):
+            raise ValueError('Unknown fsync policy: {}'.format(fsync_policy))
+        self._tmp_dir = os.path.abspath(tmp_dir)
+        self._placement = placement
+        self._mount_map = {os.path.abspath(k): os.path.abspath(v) for k, v in (mount_map or {}).items()}
+        self._fsync_policy = fsync_policy
+
+    @property
+    def tmp_dir(self) -> str:
+        return self._tmp_dir
+
+    @staticmethod
+    def get_mount_point(path: str) -> str:
+        path = os.path.abspath(path)
+        while not os.path.ismount(path):
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+        return path
+
+    def _same_device(self, out_dir: str) -> bool:
+        try:
+            return os.stat(self._tmp_dir).st_dev == os.stat(out_dir).st_dev
+        except OSError:
+            return False
+
+    def get_tmp_path(self, out_path: str) -> str:
+        out_dir, out_name = os.path.split(os.path.abspath(out_path))
+        out_ext = os.path.splitext(out_name)[1]
+        tmp_name = '{}{}'.format(str(uuid.uuid4()), out_ext)
+        if self._placement == self.PLACEMENT_SIBLING:
+            return os.path.join(out_dir, self.SIBLING_TMP_NAME.format(tmp_name))
+        if self._placement == self.PLACEMENT_MOUNT_MAP:
+            tmp_dir = self._mount_map.get(self.get_mount_point(out_dir), self._tmp_dir)
+            return os.path.join(tmp_dir, tmp_name)
+        if self._placement == self.PLACEMENT_AUTO and not self._same_device(out_dir):
+            return os.path.join(out_dir, self.SIBLING_TMP_NAME.format(tmp_name))
+        return os.path.join(self._tmp_dir, tmp_name)
+
+    @staticmethod
+    def get_collision_path(tmp_path: str, out_path: str) -> str:
+        head, tail = os.path.split(out_path)
+        name, ext = os.path.splitext(tail)
+        return os.path.join(head, '{}.{}{}'.format(
+            name, os.path.splitext(os.path.split(tmp_path)[1])[0].lstrip('.')[0:8], ext
+        ))
+
+    @staticmethod
+    def _fsync_path(path: str) -> None:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _fsync_dir(self, path: str) -> None:
+        if self._fsync_policy != self.FSYNC_FULL:
+            return
+        try:
+            self._fsync_path(os.path.dirname(path) or '.')
+        except OSError as e:
+            logging.debug('Unable to fsync directory of "{}": {}'.format(path, e))
+
+    @classmethod
+    def _get_renameat2(cls):
+        if cls._renameat2 is None:
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+                renameat2 = libc.renameat2
+                renameat2.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint)
+                cls._renameat2 = renameat2
+            except (OSError, AttributeError):
+                cls._renameat2 = False
+        return cls._renameat2 or None
+
+    @classmethod
+    def _rename_noreplace(cls, tmp_path: str, out_path: str) -> bool:
+        renameat2 = cls._get_renameat2()
+        if renameat2 is None:
+            return False
+        if renameat2(cls.AT_FDCWD, os.fsencode(tmp_path), cls.AT_FDCWD, os.fsencode(out_path),
+                     cls.RENAME_NOREPLACE) == 0:
+            return True
+        e = ctypes.get_errno()
+        if e in (errno.EINVAL, errno.ENOSYS, errno.ENOTSUP):
+            logging.debug('RENAME_NOREPLACE is not supported ({})'.format(os.strerror(e)))
+            return False
+        raise OSError(e, os.strerror(e), out_path)
+
+    @classmethod
+    def _rename(cls, tmp_path: str, out_path: str) -> bool:
+        try:
+            os.link(tmp_path, out_path)
+        except FileExistsError:
+            raise
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                raise
+            logging.debug('Hardlink is not possible ({}) - renaming without replace'.format(e))
+            return cls._rename_noreplace(tmp_path, out_path)
+        os.unlink(tmp_path)
+        return True
+
+    @classmethod
+    def clone_file(cls, src_path: str, dst_path: str, fsync: bool=False) -> str:
+        fd_out = os.open(dst_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            with open(src_path, 'rb') as f_in, os.fdopen(fd_out, 'wb', closefd=False) as f_out:
+                method = FinalizeReport.METHOD_COPY
+                try:
+                    if fcntl is None:
+                        raise OSError(errno.ENOTSUP, 'fcntl is not available')
+                    fcntl.ioctl(fd_out, cls.FICLONE, f_in.fileno())
+                    method = FinalizeReport.METHOD_REFLINK
+                except OSError as e:
+                    logging.debug('Reflink is not possible ({}) - copying'.format(e))
+                    cls._copy(f_in, f_out)
+                f_out.flush()
+                if fsync:
+                    os.fsync(fd_out)
+        except BaseException:
+            os.close(fd_out)
+            os.unlink(dst_path)
+            raise
+        os.close(fd_out)
+        return method
+
+    def _transfer(self, tmp_path: str, out_path: str) -> str:
+        method = self.clone_file(tmp_path, out_path, self._fsync_policy != self.FSYNC_NONE)
+        shutil.copystat(tmp_path, out_path)
+        os.unlink(tmp_path)
+        return method
+
+    @classmethod
+    def _copy(cls, f_in, f_out) -> None:
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while os.copy_file_range(f_in.fileno(), f_out.fileno(), cls.COPY_CHUNK_SIZE):
+                    pass
+                return
+            except OSError as e:
+                logging.debug('copy_file_range failed ({}) - falling back to buffered copy'.format(e))
+                f_in.seek(0)
+                f_out.seek(0)
+                f_out.truncate()
+        shutil.copyfileobj(f_in, f_out, cls.COPY_CHUNK_SIZE)
+
+    def _publish(self, tmp_path: str, out_path: str) -> str:
+        if self._fsync_policy != self.FSYNC_NONE:
+            self._fsync_path(tmp_path)
+        try:
+            if self._rename(tmp_path, out_path):
+                return FinalizeReport.METHOD_RENAME
+            logging.debug('No atomic no-replace rename for "{}" - copying'.format(out_path))
+        except OSError as e:
+            if isinstance(e, FileExistsError) or e.errno != errno.EXDEV:
+                raise
+            logging.debug('"{}" and "{}" are on different file systems'.format(tmp_path, out_path))
+        return self._transfer(tmp_path, out_path)
+
+    def finalize(self, tmp_path: str, out_path: str, simulate: bool=False) -> FinalizeReport:
+        logging.debug('Temporary file: "{}"; output file: "{}"'.format(tmp_path, out_path))
+        requested_path = out_path
+        if simulate:
+            if os.path.exists(out_path):
+                out_path = self.get_collision_path(tmp_path, out_path)
+            return FinalizeReport(tmp_path, requested_path, out_path, FinalizeReport.METHOD_SIMULATED)
+        while True:
+            try:
+                method = self._publish(tmp_path, out_path)
+                break
+            except FileExistsError:
+                logging.warning('Output file "{}" already exists'.format(out_path))
+                if out_path != requested_path:
+                    raise
+                out_path = self.get_collision_path(tmp_path, out_path)
+                logging.warning('New output file name: "{}"'.format(out_path))
+        self._fsync_dir(out_path)
+        registry = get_registry()
+        if registry.enabled:
+            registry.inc('ffmpeg_output_bytes_total', os.path.getsize(out_path), method=method)
+        report = FinalizeReport(tmp_path, requested_path, out_path, method)
+        logging.debug(report)
+        return report
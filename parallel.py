@@ -0,0 +1,25 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def bounded_imap_unordered(func: callable, items, max_workers: int, max_pending: int = None):
+    if max_pending is None:
+        max_pending = max_workers * 2
+    max_pending = max(max_pending, max_workers)
+    with ThreadPoolExecutor(max_workers) as executor:
+        pending = {}
+
+        def _drain(return_when):
+            done, not_done = wait(pending, return_when=return_when)
+            for future in done:
+                item = pending.pop(future)
+                try:
+                    yield item, future.result(), None
+                except Exception as e:
+                    yield item, None, e
+
+        for item in items:
+            if len(pending) >= max_pending:
+                yield from _drain(FIRST_COMPLETED)
+            pending[executor.submit(func, item)] = item
+        while pending:
+            yield from _drain(FIRST_COMPLETED)
@@ -0,0 +1,385 @@
+import os
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from .ffmpeg import FFmpegBaseCommand
+from .factory import ffmpeg_factory, ffprobe_factory
+from .folder_watcher import create_folder_watcher
+from .metadata_collector import FFprobeMetadataCollector
+from .metadata_filter import FFprobeMetadataFilter
+from .metadata_projection import MetadataProjection
+from .metrics import get_registry
+from .profile_loader import ProfileLoader
+from .scheduler import FFmpegScheduler, FFmpegJob
+from .exceptions import PipelineShutdownException
+
+
+class PipelineRoute:
+
+    def __init__(self, profile_name: str, filter_params=None, output_dir: str=None, profile_vars: dict=None,
+                 priority: int=FFmpegJob.PRIORITY_NORMAL):
+        self.profile_name = profile_name
+        self.filter_params = filter_params
+        self.output_dir = output_dir
+        self.profile_vars = profile_vars or {}
+        self.priority = priority
+
+    def __repr__(self):
+        return 'PipelineRoute(profile_name={!r}, output_dir={!r})'.format(self.profile_name, self.output_dir)
+
+
+class PipelineItem:
+
+    STATE_QUEUED = 'queued'
+    STATE_DONE = 'done'
+    STATE_FAILED = 'failed'
+    STATE_UNROUTED = 'unrouted'
+    STATE_CANCELLED = 'cancelled'
+
+    def __init__(self, path: str, signature: tuple):
+        self.path = path
+        self.signature = signature
+        self.state = self.STATE_QUEUED
+        self.stage = None
+        self.metadata = None
+        self.route = None
+        self.profile = None
+        self.exec_args = None
+        self.reports = None
+        self.exception = None
+        self.discovered_at = time.monotonic()
+        self.finished_at = None
+
+    @property
+    def latency(self) -> float:
+        if self.finished_at is None:
+            return None
+        return self.finished_at - self.discovered_at
+
+    def __repr__(self):
+        return 'PipelineItem(path={!r}, state={}, stage={})'.format(self.path, self.state, self.stage)
+
+
+class _PipelineStage:
+
+    _STOP = object()
+
+    def __init__(self, pipeline, name: str, func: callable, workers: int, queue_size: int):
+        self.name = name
+        self.queue = queue.Queue(queue_size)
+        self.next_stage = None
+        self._pipeline = pipeline
+        self._func = func
+        self._workers = workers
+        self._alive = workers
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._processed = 0
+        self._failed = 0
+        self._dropped = 0
+        self._seconds_total = 0.0
+        self._threads = [
+            threading.Thread(target=self._work_loop, name='Pipeline-{}'.format(name), daemon=True)
+            for _ in range(workers)
+        ]
+
+    def start(self) -> None:
+        for t in self._threads:
+            t.start()
+
+    def join(self) -> None:
+        for t in self._threads:
+            t.join()
+
+    def stop(self) -> None:
+        for _ in range(self._workers):
+            self.queue.put(self._STOP)
+
+    def get_stats(self, elapsed: float) -> dict:
+        with self._lock:
+            return {
+                'workers': self._workers,
+                'busy': self._busy,
+                'queue_depth': self.queue.qsize(),
+                'queue_size': self.queue.maxsize,
+                'processed': self._processed,
+                'failed': self._failed,
+                'dropped': self._dropped,
+                'mean_seconds': self._seconds_total / self._processed if self._processed else 0.0,
+                'throughput': self._processed / elapsed if elapsed else 0.0,
+            }
+
+    def _run(self, item: PipelineItem) -> bool:
+        item.stage = self.name
+        with self._lock:
+            self._busy += 1
+        start_time = time.perf_counter()
+        try:
+            passed = self._func(item)
+        except Exception as e:
+            logging.error('Pipeline {} stage failed for "{}": {}'.format(self.name, item.path, e))
+            item.exception = e
+            item.state = PipelineItem.STATE_FAILED
+            passed = False
+        seconds = time.perf_counter() - start_time
+        with self._lock:
+            self._busy -= 1
+            self._processed += 1
+            self._seconds_total += seconds
+            if item.state == PipelineItem.STATE_FAILED:
+                self._failed += 1
+            elif not passed:
+                self._dropped += 1
+        registry = get_registry()
+        registry.observe('pipeline_stage_seconds', seconds, stage=self.name)
+        registry.inc('pipeline_items_total', stage=self.name, outcome=item.state if not passed else 'passed')
+        return passed
+
+    def _work_loop(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is self._STOP:
+                break
+            if self._pipeline.cancelled:
+                item.state = PipelineItem.STATE_CANCELLED
+                self._pipeline.finish(item)
+                continue
+            if not self._run(item):
+                self._pipeline.finish(item)
+            elif self.next_stage is None:
+                item.state = PipelineItem.STATE_DONE
+                self._pipeline.finish(item)
+            else:
+                self.next_stage.queue.put(item)
+        with self._lock:
+            self._alive -= 1
+            last = self._alive == 0
+        if last and self.next_stage is not None:
+            self.next_stage.stop()
+
+
+class WatchFolderPipeline:
+
+    STAGE_PROBE = 'probe'
+    STAGE_FILTER = 'filter'
+    STAGE_RENDER = 'render'
+    STAGE_ENCODE = 'encode'
+
+    STAGES = (STAGE_PROBE, STAGE_FILTER, STAGE_RENDER, STAGE_ENCODE)
+
+    DEFAULT_WORKERS = {
+        STAGE_PROBE: 4,
+        STAGE_FILTER: 1,
+        STAGE_RENDER: 1,
+        STAGE_ENCODE: 1,
+    }
+
+    QUEUE_SIZE_PER_WORKER = 2
+
+    SETTLE_TIME = 2.0
+
+    POLL_INTERVAL = 0.5
+
+    DONE_HISTORY = 4096
+
+    def __init__(self, watch_dir: str, routes: list, output_dir: str, loader: ProfileLoader,
+                 scheduler: FFmpegScheduler=None, ffmpeg_cmd_class=FFmpegBaseCommand, workers: dict=None,
+                 queue_sizes: dict=None, settle_time: float=None, poll_interval: float=None, patterns: list=None,
+                 use_inotify: bool=True, use_projection: bool=False, simulate: bool=False,
+                 callback: callable=None, seed_field_mode: bool=False):
+        self._routes = list(routes)
+        self._output_dir = output_dir
+        self._loader = loader
+        self._scheduler = scheduler
+        self._simulate = simulate
+        self._callback = callback
+        self._settle_time = self.SETTLE_TIME if settle_time is None else settle_time
+        self._poll_interval = poll_interval or self.POLL_INTERVAL
+        logging.debug('Fetching FFprobeMetadataCollector and FFmpeg command objects...')
+        self._ff_metadata_collector = ffprobe_factory.get_ffprobe_metadata_collector(FFprobeMetadataCollector)
+        self._ffmpeg_cmd = ffmpeg_factory.get_ffmpeg_command(ffmpeg_cmd_class) if scheduler is None else None
+        metadata_filter = FFprobeMetadataFilter()
+        self._compiled = [
+            None if r.filter_params is None else metadata_filter.compile(r.filter_params) for r in self._routes
+        ]
+        self._with_field_mode = seed_field_mode and any(c is not None and c.needs_field_mode for c in self._compiled)
+        self._projection = self._get_projection() if use_projection else None
+        self._watcher = create_folder_watcher(watch_dir, patterns, self._poll_interval, use_inotify)
+
+        workers = dict(self.DEFAULT_WORKERS, **(workers or {}))
+        queue_sizes = queue_sizes or {}
+        funcs = {
+            self.STAGE_PROBE: self._probe,
+            self.STAGE_FILTER: self._filter,
+            self.STAGE_RENDER: self._render,
+            self.STAGE_ENCODE: self._encode,
+        }
+        self._stages = []
+        for name in self.STAGES:
+            count = max(1, workers[name])
+            size = queue_sizes.get(name) or count * self.QUEUE_SIZE_PER_WORKER
+            self._stages.append(_PipelineStage(self, name, funcs[name], count, size))
+        for stage, next_stage in zip(self._stages, self._stages[1:]):
+            stage.next_stage = next_stage
+
+        self._lock = threading.Lock()
+        self._seen = {}
+        self._done = OrderedDict()
+        self._watching = 0
+        self._discovered = 0
+        self._finished = {}
+        self._shutdown = False
+        self._cancelled = False
+        self._stop_watching = threading.Event()
+        self._started_at = time.monotonic()
+        for stage in self._stages:
+            stage.start()
+        self._watch_thread = threading.Thread(target=self._watch_loop, name='PipelineWatcher', daemon=True)
+        self._watch_thread.start()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def _get_projection(self) -> MetadataProjection:
+        projections = [c.projection for c in self._compiled if c is not None]
+        projections.extend(self._loader.get_projection(r.profile_name) for r in self._routes)
+        return MetadataProjection.merge(*projections)
+
+    def _probe(self, item: PipelineItem) -> bool:
+        item.metadata = self._ff_metadata_collector.get_metadata(item.path, self._projection, self._with_field_mode)
+        return True
+
+    def _filter(self, item: PipelineItem) -> bool:
+        for route, compiled in zip(self._routes, self._compiled):
+            if compiled is None or compiled(item.metadata):
+                logging.debug('"{}" routed to {}'.format(item.path, route))
+                item.route = route
+                return True
+        logging.info('No route for "{}"'.format(item.path))
+        item.state = PipelineItem.STATE_UNROUTED
+        return False
+
+    def _render(self, item: PipelineItem) -> bool:
+        route = item.route
+        item.profile = self._loader.get_profile(
+            route.profile_name, context={'input': item.metadata, 'vars': route.profile_vars}
+        )
+        item.exec_args = item.profile.get_exec_args([item.path], route.output_dir or self._output_dir)
+        return True
+
+    def _encode(self, item: PipelineItem) -> bool:
+        inputs, outputs = item.exec_args
+        if self._scheduler is not None and not self._simulate:
+            item.reports = self._scheduler.submit(inputs, outputs, item.route.priority).result()
+        else:
+            item.reports = self._ffmpeg_cmd.exec(inputs, outputs, self._simulate)
+        return True
+
+    def finish(self, item: PipelineItem) -> None:
+        item.finished_at = time.monotonic()
+        with self._lock:
+            self._finished[item.state] = self._finished.get(item.state, 0) + 1
+            if self._seen.get(item.path) == item.signature:
+                del self._seen[item.path]
+                if item.state == PipelineItem.STATE_DONE:
+                    self._done[item.path] = item.signature
+                    self._done.move_to_end(item.path)
+                    if len(self._done) > self.DONE_HISTORY:
+                        self._done.popitem(last=False)
+        get_registry().observe('pipeline_latency_seconds', item.latency, state=item.state)
+        if self._callback is not None:
+            try:
+                self._callback(item)
+            except Exception as e:
+                logging.error('Pipeline callback failed for "{}": {}'.format(item.path, e))
+
+    def _enqueue(self, item: PipelineItem) -> bool:
+        first = self._stages[0].queue
+        while not self._cancelled:
+            try:
+                first.put(item, timeout=self._poll_interval)
+            except queue.Full:
+                continue
+            with self._lock:
+                self._discovered += 1
+            return True
+        return False
+
+    def submit(self, path: str) -> PipelineItem:
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        item = PipelineItem(path, (st.st_size, st.st_mtime_ns))
+        with self._lock:
+            if self._shutdown:
+                raise PipelineShutdownException('Pipeline is shut down')
+            self._seen[path] = item.signature
+        self._enqueue(item)
+        return item
+
+    def _check_pending(self, pending: dict, now: float) -> None:
+        for path, entry in list(pending.items()):
+            if self._stop_watching.is_set():
+                return
+            try:
+                st = os.stat(path)
+            except OSError:
+                del pending[path]
+                with self._lock:
+                    self._seen.pop(path, None)
+                    self._done.pop(path, None)
+                continue
+            signature = (st.st_size, st.st_mtime_ns)
+            if signature != entry[0]:
+                entry[0] = signature
+                entry[1] = now
+                continue
+            if now - entry[1] < self._settle_time:
+                continue
+            del pending[path]
+            with self._lock:
+                if self._seen.get(path) == signature or self._done.get(path) == signature:
+                    continue
+                self._done.pop(path, None)
+                self._seen[path] = signature
+            logging.debug('"{}" is stable - queueing'.format(path))
+            self._enqueue(PipelineItem(path, signature))
+
+    def _watch_loop(self) -> None:
+        pending = {}
+        try:
+            while not self._stop_watching.is_set():
+                for path in self._watcher.get_changes(self._poll_interval):
+                    pending.setdefault(path, [None, 0.0])
+                self._check_pending(pending, time.monotonic())
+                self._watching = len(pending)
+        finally:
+            self._watcher.close()
+        logging.debug('Pipeline watcher stopped')
+
+    def get_stats(self) -> dict:
+        elapsed = time.monotonic() - self._started_at
+        with self._lock:
+            stats = {
+                'watching': self._watching,
+                'discovered': self._discovered,
+                'finished': dict(self._finished),
+            }
+        stats['stages'] = {stage.name: stage.get_stats(elapsed) for stage in self._stages}
+        return stats
+
+    def shutdown(self, wait: bool=True, cancel_pending: bool=False) -> None:
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+        self._cancelled = cancel_pending
+        self._stop_watching.set()
+        self._watch_thread.join()
+        self._stages[0].stop()
+        if wait:
+            for stage in self._stages:
+                stage.join()
@@ -1,3 +1,7 @@
+import copy
+import os
+
+from .exceptions import ProfileInputMismatchException
 
 
 class FFmpegProfile:
@@ -12,3 +16,12 @@ class FFmpegProfile:
     @property
     def outputs(self):
         return self._profile_dict['outputs']
+
+    def get_exec_args(self, input_urls: list, output_dir: str) -> tuple:
+        if len(input_urls) != len(self.inputs):
+            raise ProfileInputMismatchException('Profile expects {} input(s), got {}'.format(
+                len(self.inputs), len(input_urls)
+            ))
+        inputs = [(copy.copy(i['parameters']), url) for i, url in zip(self.inputs, input_urls)]
+        outputs = [(copy.copy(o['parameters']), os.path.join(output_dir, o['filename'])) for o in self.outputs]
+        return inputs, outputs
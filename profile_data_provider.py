@@ -1,20 +1,220 @@
-from jinja2 import Environment, FileSystemLoader, BaseLoader
+from jinja2 import Environment, FileSystemLoader, BaseLoader, FileSystemBytecodeCache, nodes
 import logging
 import os
 
+from .metadata_model import FormatRecord, StreamRecord
+from .metadata_projection import MetadataProjection
+
 
 class AbstractProfileDataProvider:
 
     def get_profile_data(self, profile_name: str, **kwargs):
         raise NotImplementedError
 
+    def get_projection(self, profile_name: str) -> MetadataProjection:
+        return None
+
+
+class _UnprojectableTemplate(Exception):
+    pass
+
+
+class JinjaProjectionExtractor:
+
+    ROOT, VALUE, FORMAT, STREAM, STREAM_MAP, STREAM_LIST, STREAM_ITEMS = range(7)
+
+    RECORD_KINDS = (FORMAT, STREAM, STREAM_MAP, STREAM_LIST, STREAM_ITEMS)
+
+    STREAM_MAP_ATTRS = ('v_streams', 'a_streams')
+
+    STREAM_LIST_ATTRS = ('streams', 'v_stream_list', 'a_stream_list')
+
+    UNSUPPORTED_NODES = (nodes.Extends, nodes.Include, nodes.Import, nodes.FromImport)
+
+    ATTRIBUTE_FILTERS = {
+        'map': VALUE,
+        'sum': VALUE,
+        'join': VALUE,
+        'min': STREAM,
+        'max': STREAM,
+        'sort': STREAM_LIST,
+        'unique': STREAM_LIST,
+        'selectattr': STREAM_LIST,
+        'rejectattr': STREAM_LIST,
+    }
+
+    def __init__(self):
+        self._format_fields = set()
+        self._stream_fields = set()
+
+    def extract(self, ast: nodes.Template) -> MetadataProjection:
+        try:
+            self._visit(ast, {})
+        except _UnprojectableTemplate as e:
+            logging.debug('Unable to derive metadata projection: {}'.format(e))
+            return None
+        return MetadataProjection(self._format_fields, self._stream_fields)
+
+    def _visit(self, node: nodes.Node, aliases: dict) -> None:
+        if isinstance(node, self.UNSUPPORTED_NODES):
+            raise _UnprojectableTemplate('{} is not supported'.format(type(node).__name__))
+        if isinstance(node, nodes.For):
+            kind = self._expr(node.iter, aliases)
+            body_aliases = dict(aliases)
+            self._bind(node.target, kind, body_aliases)
+            if node.test is not None:
+                self._check(node.test, body_aliases)
+            for child in node.body:
+                self._visit(child, body_aliases)
+            for child in node.else_:
+                self._visit(child, aliases)
+        elif isinstance(node, nodes.Assign):
+            kind = self._expr(node.node, aliases)
+            if isinstance(node.target, nodes.Name):
+                aliases[node.target.name] = kind
+            else:
+                self._bind(node.target, kind, aliases)
+        elif isinstance(node, nodes.Expr):
+            self._check(node, aliases)
+        else:
+            for child in node.iter_child_nodes():
+                self._visit(child, aliases)
+
+    def _bind(self, target: nodes.Node, kind: int, aliases: dict) -> None:
+        if isinstance(target, nodes.Name):
+            if kind == self.STREAM_LIST:
+                aliases[target.name] = self.STREAM
+            elif kind in (self.FORMAT, self.STREAM, self.STREAM_ITEMS):
+                raise _UnprojectableTemplate('iteration over metadata record')
+            else:
+                aliases[target.name] = self.VALUE
+        elif isinstance(target, nodes.Tuple) and kind == self.STREAM_ITEMS and len(target.items) == 2:
+            self._bind(target.items[0], self.VALUE, aliases)
+            self._bind(target.items[1], self.STREAM_LIST, aliases)
+        elif kind in self.RECORD_KINDS:
+            raise _UnprojectableTemplate('unsupported loop target')
+        else:
+            for name in target.find_all(nodes.Name):
+                aliases[name.name] = self.VALUE
+
+    def _check(self, node: nodes.Node, aliases: dict) -> int:
+        kind = self._expr(node, aliases)
+        if kind in self.RECORD_KINDS:
+            raise _UnprojectableTemplate('metadata record is used as a whole')
+        return kind
+
+    def _field(self, kind: int, name) -> int:
+        if not isinstance(name, str):
+            raise _UnprojectableTemplate('non-constant metadata field name')
+        record_class, fields = (FormatRecord, self._format_fields) if kind == self.FORMAT \
+            else (StreamRecord, self._stream_fields)
+        for attr, key, parser in record_class.NUMERIC_FIELDS:
+            if name == attr:
+                name = key
+                break
+        else:
+            if name in ('get', 'keys', 'values', 'items', 'to_dict', 'fields'):
+                raise _UnprojectableTemplate('metadata record method "{}" is used'.format(name))
+        fields.add(name)
+        return self.VALUE
+
+    def _access(self, kind: int, name) -> int:
+        if kind == self.ROOT:
+            if name == 'format':
+                return self.FORMAT
+            if name in self.STREAM_MAP_ATTRS:
+                return self.STREAM_MAP
+            if name in self.STREAM_LIST_ATTRS:
+                return self.STREAM_LIST
+            return self.ROOT
+        if kind in (self.FORMAT, self.STREAM):
+            return self._field(kind, name)
+        if kind == self.STREAM_ITEMS:
+            raise _UnprojectableTemplate('unsupported stream collection access')
+        return self.VALUE
+
+    def _expr(self, node: nodes.Node, aliases: dict) -> int:
+        if isinstance(node, nodes.Name):
+            return aliases.get(node.name, self.ROOT)
+        if isinstance(node, nodes.Getattr):
+            return self._access(self._expr(node.node, aliases), node.attr)
+        if isinstance(node, nodes.Getitem):
+            kind = self._expr(node.node, aliases)
+            if kind in (self.STREAM_MAP, self.STREAM_LIST):
+                self._check(node.arg, aliases)
+                return self.STREAM
+            if isinstance(node.arg, nodes.Const):
+                return self._access(kind, node.arg.value)
+            if kind in (self.FORMAT, self.STREAM):
+                raise _UnprojectableTemplate('non-constant metadata field name')
+            self._check(node.arg, aliases)
+            return self.VALUE
+        if isinstance(node, nodes.Call):
+            return self._call(node, aliases)
+        if isinstance(node, nodes.Filter):
+            return self._filter(node, aliases)
+        kinds = [self._check(child, aliases) for child in node.iter_child_nodes()]
+        return self.ROOT if self.ROOT in kinds else self.VALUE
+
+    def _check_args(self, node: nodes.Node, aliases: dict) -> None:
+        for arg in node.args + [k.value for k in node.kwargs]:
+            self._check(arg, aliases)
+        for arg in (node.dyn_args, node.dyn_kwargs):
+            if arg is not None:
+                self._check(arg, aliases)
+
+    def _call(self, node: nodes.Call, aliases: dict) -> int:
+        if isinstance(node.node, nodes.Getattr):
+            kind = self._expr(node.node.node, aliases)
+            method = node.node.attr
+            if kind == self.STREAM_MAP and method in ('values', 'items', 'keys'):
+                self._check_args(node, aliases)
+                return {'values': self.STREAM_LIST, 'items': self.STREAM_ITEMS}.get(method, self.VALUE)
+            if kind in (self.FORMAT, self.STREAM) and method == 'get' and node.args \
+                    and isinstance(node.args[0], nodes.Const):
+                self._field(kind, node.args[0].value)
+                self._check_args(node, aliases)
+                return self.VALUE
+            self._access(kind, method)
+        else:
+            self._check(node.node, aliases)
+        self._check_args(node, aliases)
+        return self.VALUE
+
+    def _filter(self, node: nodes.Filter, aliases: dict) -> int:
+        kind = self._expr(node.node, aliases) if node.node is not None else self.VALUE
+        if kind not in self.RECORD_KINDS or node.name in ('length', 'count'):
+            result = self.VALUE
+        elif kind == self.STREAM_MAP and node.name in ('first', 'last', 'list'):
+            result = self.VALUE
+        elif kind == self.STREAM_LIST and node.name in ('first', 'last', 'random', 'list'):
+            result = self.STREAM_LIST if node.name == 'list' else self.STREAM
+        elif kind == self.STREAM_LIST and node.name in self.ATTRIBUTE_FILTERS:
+            if node.name in ('selectattr', 'rejectattr'):
+                attribute = node.args[0] if node.args else None
+            else:
+                attribute = next((k.value for k in node.kwargs if k.key == 'attribute'), None)
+            if not isinstance(attribute, nodes.Const):
+                raise _UnprojectableTemplate('filter "{}" without constant attribute'.format(node.name))
+            self._field(self.STREAM, str(attribute.value).split('.')[0])
+            result = self.ATTRIBUTE_FILTERS[node.name]
+        else:
+            raise _UnprojectableTemplate('filter "{}" is applied to metadata record'.format(node.name))
+        self._check_args(node, aliases)
+        return result
+
 
 class JinjaProfileDataProvider(AbstractProfileDataProvider):
 
-    def __init__(self, template_loader: BaseLoader = None):
+    def __init__(self, template_loader: BaseLoader = None, bytecode_cache_dir: str = None):
         if template_loader is None:
             template_loader = FileSystemLoader(os.path.join(os.path.dirname(__file__), 'ff_profiles'))
-        self._jinja_env = Environment(loader=template_loader, autoescape=False)
+        bytecode_cache = None
+        if bytecode_cache_dir is not None:
+            os.makedirs(bytecode_cache_dir, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+        self._jinja_env = Environment(loader=template_loader, autoescape=False, bytecode_cache=bytecode_cache)
+        self._projections = {}
 
     def get_profile_data(self, profile_name: str, **kwargs):
         logging.debug('Loading profile template {}'.format(profile_name))
@@ -23,3 +223,13 @@ class JinjaProfileDataProvider(AbstractProfileDataProvider):
         logging.debug('Rendered profile:\r\n{}'.format(profile_data))
 
         return profile_data
+
+    def get_projection(self, profile_name: str) -> MetadataProjection:
+        cached = self._projections.get(profile_name)
+        if cached is not None and cached[0] is not None and cached[0]():
+            return cached[1]
+        source, filename, uptodate = self._jinja_env.loader.get_source(self._jinja_env, profile_name)
+        projection = JinjaProjectionExtractor().extract(self._jinja_env.parse(source, profile_name, filename))
+        logging.debug('Metadata projection for profile {}: {}'.format(profile_name, projection))
+        self._projections[profile_name] = (uptodate, projection)
+        return projection
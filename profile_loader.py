@@ -1,8 +1,13 @@
+import copy
 import logging
 import jsonschema
 
+from .cache import CacheMissException
 from .profile_data_parser import AbstractProfileDataParser
 from .profile_data_provider import AbstractProfileDataProvider
+from .profile_memo import ContextRecorder, RenderMemo
+from .metadata_projection import MetadataProjection
+from .metrics import get_registry
 from .profile import FFmpegProfile
 
 
@@ -63,18 +68,75 @@ class ProfileLoader:
         'required': ['inputs', 'outputs']
     }
 
+    _validator = None
+
     def __init__(self, data_provider: AbstractProfileDataProvider,
-                 data_parser: AbstractProfileDataParser):
+                 data_parser: AbstractProfileDataParser, memo_size: int = 64):
         self._data_provider = data_provider
         self._data_parser = data_parser
+        self._memo = RenderMemo(memo_size) if memo_size > 0 else None
+        self._unparametrizable = set()
+        self._verified = set()
+
+    def _load_profile_dict(self, profile_name: str, **kwargs) -> dict:
+        registry = get_registry()
+        with registry.timer('profile_render_seconds', profile=profile_name):
+            profile_data = self._data_provider.get_profile_data(profile_name, **kwargs)
+            profile_dict = self._data_parser.parse_profile_data(profile_data)
+        with registry.timer('profile_validate_seconds', profile=profile_name):
+            self._validate_profile(profile_dict)
+        return profile_dict
 
     def get_profile(self, profile_name: str, **kwargs) -> FFmpegProfile:
-        profile_data = self._data_provider.get_profile_data(profile_name, **kwargs)
-        profile_dict = self._data_parser.parse_profile_data(profile_data)
-        self._validate_profile(profile_dict)
+        context = kwargs.get('context')
+        if self._memo is None or not isinstance(context, dict):
+            return FFmpegProfile(self._load_profile_dict(profile_name, **kwargs))
+        logging.debug('Trying to get rendered profile from memo...')
+        try:
+            return FFmpegProfile(self._memo.lookup(profile_name, context))
+        except CacheMissException:
+            pass
+        parametrize = profile_name not in self._unparametrizable
+        recorder = ContextRecorder(parametrize)
+        traced_kwargs = dict(kwargs, context=recorder.wrap(context))
+        try:
+            traced_dict = self._load_profile_dict(profile_name, **traced_kwargs)
+        except Exception as e:
+            logging.debug('Traced profile rendering failed ({}) - loading without memo'.format(e))
+            return FFmpegProfile(self._load_profile_dict(profile_name, **kwargs))
+        if not parametrize:
+            self._memo.store(profile_name, recorder, traced_dict)
+            return FFmpegProfile(copy.deepcopy(traced_dict))
+        values = tuple(RenderMemo.resolve(context, path) for path in recorder.parameters)
+        profile_dict = ContextRecorder.substitute(traced_dict, recorder.nonce, values)
+        if profile_name not in self._verified:
+            plain_dict = self._load_profile_dict(profile_name, **kwargs)
+            if profile_dict != plain_dict:
+                logging.warning('Profile "{}" does not render the same with parametrized values - '
+                                'memoizing it by exact values only'.format(profile_name))
+                self._unparametrizable.add(profile_name)
+                return FFmpegProfile(plain_dict)
+            self._verified.add(profile_name)
+        self._memo.store(profile_name, recorder, traced_dict)
         return FFmpegProfile(profile_dict)
 
+    def get_projection(self, profile_name: str) -> MetadataProjection:
+        return self._data_provider.get_projection(profile_name)
+
+    def get_memo_stats(self):
+        if self._memo is None:
+            return 0, 0, 0, 0.0
+        return self._memo.get_stats()
+
+    @classmethod
+    def _get_validator(cls):
+        if cls._validator is None or cls._validator.schema is not cls.PROFILE_SCHEMA:
+            validator_class = jsonschema.validators.validator_for(cls.PROFILE_SCHEMA)
+            validator_class.check_schema(cls.PROFILE_SCHEMA)
+            cls._validator = validator_class(cls.PROFILE_SCHEMA)
+        return cls._validator
+
     @classmethod
     def _validate_profile(cls, profile_dict):
         logging.debug('Validating profile...')
-        jsonschema.validate(profile_dict, cls.PROFILE_SCHEMA)
+        cls._get_validator().validate(profile_dict)
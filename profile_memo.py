@@ -0,0 +1,319 @@
+import logging
+import re
+import threading
+import uuid
+from collections import OrderedDict
+
+from .cache import CacheMissException
+from .metrics import track_cache
+
+
+class ContextRecorder:
+
+    LEAF_TYPES = (str, bytes, int, float, bool, type(None))
+
+    PARAMETER_TOKEN = '__pyffwrapper_{}_{}__'
+    UNSAFE_PARAMETER_RE = re.compile(r'["\\\x00-\x1f]')
+
+    def __init__(self, parametrize: bool = True):
+        self._parametrize = parametrize
+        self._nonce = uuid.uuid4().hex
+        self._dependencies = OrderedDict()
+        self._parameters = []
+
+    @property
+    def nonce(self) -> str:
+        return self._nonce
+
+    @property
+    def dependencies(self) -> tuple:
+        return tuple(self._dependencies.items())
+
+    @property
+    def parameters(self) -> tuple:
+        return tuple(self._parameters)
+
+    @classmethod
+    def is_parametrizable(cls, value) -> bool:
+        return isinstance(value, str) and cls.UNSAFE_PARAMETER_RE.search(value) is None
+
+    def record(self, path: tuple, value) -> None:
+        if path not in self._dependencies:
+            self._dependencies[path] = value
+
+    def wrap_value(self, path: tuple, value):
+        if self._parametrize and type(value) == str and self.is_parametrizable(value):
+            token = self.PARAMETER_TOKEN.format(self._nonce, len(self._parameters))
+            self._parameters.append(path)
+            return _TracedStr(token, self, path, value)
+        if isinstance(value, self.LEAF_TYPES):
+            self.record(path, value)
+            return value
+        return _RecordingProxy(self, path, value)
+
+    def wrap(self, context: dict) -> dict:
+        return {k: self.wrap_value((('var', k), ), v) for k, v in context.items()}
+
+    @classmethod
+    def substitute(cls, item, nonce: str, values: tuple):
+        prefix = cls.PARAMETER_TOKEN.format(nonce, '')[:-2]
+        token_re = re.compile(re.escape(prefix) + r'(\d+)__')
+
+        def _substitute(i):
+            if isinstance(i, str):
+                if prefix not in i:
+                    return i
+                return token_re.sub(lambda m: values[int(m.group(1))], i)
+            if isinstance(i, dict):
+                return {_substitute(k): _substitute(v) for k, v in i.items()}
+            if isinstance(i, list):
+                return [_substitute(v) for v in i]
+            return i
+
+        return _substitute(item)
+
+
+class _TracedStr(str):
+
+    def __new__(cls, token: str, recorder: ContextRecorder, path: tuple, value: str):
+        obj = super().__new__(cls, token)
+        obj.__dict__['_tr_recorder'] = recorder
+        obj.__dict__['_tr_path'] = path
+        obj.__dict__['_tr_value'] = value
+        return obj
+
+    def _tr_used(self) -> str:
+        d = object.__getattribute__(self, '__dict__')
+        d['_tr_recorder'].record(d['_tr_path'], d['_tr_value'])
+        return d['_tr_value']
+
+    def __getattribute__(self, name: str):
+        if name.startswith('_tr_') or name == '__dict__':
+            return object.__getattribute__(self, name)
+        return getattr(_TracedStr._tr_used(self), name)
+
+    def __format__(self, format_spec: str) -> str:
+        if not format_spec:
+            return str.__str__(self)
+        return format(_TracedStr._tr_used(self), format_spec)
+
+    def __repr__(self):
+        return repr(_TracedStr._tr_used(self))
+
+    def __eq__(self, other):
+        return _TracedStr._tr_used(self) == other
+
+    def __ne__(self, other):
+        return _TracedStr._tr_used(self) != other
+
+    def __lt__(self, other):
+        return _TracedStr._tr_used(self) < other
+
+    def __le__(self, other):
+        return _TracedStr._tr_used(self) <= other
+
+    def __gt__(self, other):
+        return _TracedStr._tr_used(self) > other
+
+    def __ge__(self, other):
+        return _TracedStr._tr_used(self) >= other
+
+    def __hash__(self):
+        return hash(_TracedStr._tr_used(self))
+
+    def __len__(self):
+        return len(_TracedStr._tr_used(self))
+
+    def __contains__(self, item):
+        return item in _TracedStr._tr_used(self)
+
+    def __getitem__(self, key):
+        return _TracedStr._tr_used(self)[key]
+
+    def __iter__(self):
+        return iter(_TracedStr._tr_used(self))
+
+    def __add__(self, other):
+        return _TracedStr._tr_used(self) + other
+
+    def __radd__(self, other):
+        return other + _TracedStr._tr_used(self)
+
+    def __mul__(self, other):
+        return _TracedStr._tr_used(self) * other
+
+    __rmul__ = __mul__
+
+    def __mod__(self, other):
+        return _TracedStr._tr_used(self) % other
+
+    def __rmod__(self, other):
+        return other % _TracedStr._tr_used(self)
+
+    def __int__(self):
+        return int(_TracedStr._tr_used(self))
+
+    def __float__(self):
+        return float(_TracedStr._tr_used(self))
+
+
+class _RecordingProxy:
+
+    __slots__ = ('_recorder', '_path', '_target')
+
+    def __init__(self, recorder: ContextRecorder, path: tuple, target):
+        object.__setattr__(self, '_recorder', recorder)
+        object.__setattr__(self, '_path', path)
+        object.__setattr__(self, '_target', target)
+
+    def _step(self, step: tuple, value):
+        return self._recorder.wrap_value(self._path + (step, ), value)
+
+    def _leaf(self, step: tuple, value):
+        self._recorder.record(self._path + (step, ), value)
+        return value
+
+    def __getattr__(self, name: str):
+        return self._step(('attr', name), getattr(self._target, name))
+
+    def __getitem__(self, key):
+        return self._step(('item', key), self._target[key])
+
+    def __call__(self, *args, **kwargs):
+        return self._step(('call', args, tuple(sorted(kwargs.items()))), self._target(*args, **kwargs))
+
+    def __len__(self):
+        return self._leaf(('len', ), len(self._target))
+
+    def __contains__(self, item):
+        return self._leaf(('contains', item), item in self._target)
+
+    def __bool__(self):
+        return self._leaf(('bool', ), bool(self._target))
+
+    def __iter__(self):
+        return iter(self._leaf(('list', ), list(self._target)))
+
+    def __str__(self):
+        return self._leaf(('str', ), str(self._target))
+
+    def __eq__(self, other):
+        return self._leaf(('eq', other), self._target == other)
+
+    def __ne__(self, other):
+        return self._leaf(('ne', other), self._target != other)
+
+    __hash__ = None
+
+
+class RenderMemo:
+
+    def __init__(self, size: int, variants_per_profile: int = 16):
+        self._size = size
+        self._variants_per_profile = variants_per_profile
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        track_cache('profile_render', self)
+
+    @staticmethod
+    def resolve(context: dict, path: tuple):
+        value = context
+        for step in path:
+            kind = step[0]
+            if kind == 'var':
+                value = value[step[1]]
+            elif kind == 'attr':
+                value = getattr(value, step[1])
+            elif kind == 'item':
+                value = value[step[1]]
+            elif kind == 'call':
+                value = value(*step[1], **dict(step[2]))
+            elif kind == 'len':
+                value = len(value)
+            elif kind == 'contains':
+                value = step[1] in value
+            elif kind == 'bool':
+                value = bool(value)
+            elif kind == 'list':
+                value = list(value)
+            elif kind == 'str':
+                value = str(value)
+            elif kind == 'eq':
+                value = value == step[1]
+            elif kind == 'ne':
+                value = value != step[1]
+            else:
+                raise ValueError(kind)
+        return value
+
+    def _matches(self, context: dict, dependencies: tuple) -> bool:
+        for path, value in dependencies:
+            try:
+                if self.resolve(context, path) != value:
+                    return False
+            except Exception:
+                return False
+        return True
+
+    def _resolve_parameters(self, context: dict, parameters: tuple):
+        values = []
+        for path in parameters:
+            try:
+                value = self.resolve(context, path)
+            except Exception:
+                return None
+            if type(value) != str or not ContextRecorder.is_parametrizable(value):
+                return None
+            values.append(value)
+        return tuple(values)
+
+    def lookup(self, profile_name: str, context: dict):
+        with self._lock:
+            variants = list(self._memo.get(profile_name, ()))
+        for variant in variants:
+            dependencies, nonce, parameters, item = variant
+            if not self._matches(context, dependencies):
+                continue
+            values = self._resolve_parameters(context, parameters)
+            if values is None:
+                continue
+            logging.debug('Rendered profile memo hit')
+            with self._lock:
+                self._hits += 1
+                current = self._memo.get(profile_name)
+                if current is not None:
+                    self._memo.move_to_end(profile_name)
+                    for n, v in enumerate(current):
+                        if v is variant:
+                            if n:
+                                current.insert(0, current.pop(n))
+                            break
+            return ContextRecorder.substitute(item, nonce, values)
+        logging.debug('Rendered profile memo miss')
+        with self._lock:
+            self._misses += 1
+        raise CacheMissException
+
+    def store(self, profile_name: str, recorder: ContextRecorder, item) -> None:
+        with self._lock:
+            variants = self._memo.setdefault(profile_name, [])
+            variants.insert(0, (recorder.dependencies, recorder.nonce, recorder.parameters, item))
+            del variants[self._variants_per_profile:]
+            self._memo.move_to_end(profile_name)
+            while len(self._memo) > self._size:
+                self._memo.popitem(last=False)
+                self._evictions += 1
+
+    def get_stats(self):
+        total_requests = self._hits + self._misses
+        try:
+            ratio = self._hits / total_requests
+        except ZeroDivisionError:
+            ratio = 0.0
+        return self._hits, self._misses, total_requests, ratio
+
+    def get_evictions(self) -> int:
+        return self._evictions
@@ -0,0 +1,181 @@
+import copy
+import logging
+import re
+
+from .profile import FFmpegProfile
+from .exceptions import ProfileMergeException
+
+
+class FFmpegProfileMerger:
+
+    FILTER_COMPLEX_ARGS = ('-filter_complex', '-lavfi')
+
+    LABEL_RE = re.compile(r'\[([^\[\]]+)\]')
+    INPUT_REF_RE = re.compile(r'^\d+(:.+)?$')
+    SPLITTABLE_REF_RE = re.compile(r'^(\d+):([va]):(\d+)$')
+    MULTI_INPUT_RE = re.compile(r'\[(\d+):a\](amix|amerge)=inputs=(\d+)')
+    CHAIN_INPUT_TYPE_RE = re.compile(r'^\s*\[\d+:([va])')
+    FILTER_RE = re.compile(r'^\s*(?:\[[^\[\]]*\])*\s*([\w-]+)(?:=(.*))?$')
+
+    LABEL_PREFIX = 'o{}_'
+    SPLIT_LABEL = 's{}_{}_{}_{}'
+    UNLABELLED_LABEL = 'o{}_u{}'
+
+    CHANNEL_LAYOUT_SIZES = {
+        'mono': 1, 'stereo': 2, '2.1': 3, '3.0': 3, '4.0': 4, 'quad': 4, '5.0': 5, '5.1': 6, '6.1': 7, '7.1': 8,
+    }
+    SPLIT_FILTERS = ('split', 'asplit')
+    AUDIO_FILTERS = ('channelsplit', 'amerge', 'amix', 'pan', 'join')
+    AUTO_MAPS = (('v', '-vn', '0:v:0?'), ('a', '-an', '0:a:0?'))
+
+    def _normalize_graph(self, graph: str) -> str:
+        def _explicit(m):
+            file_index, filter_name, count = m.group(1), m.group(2), int(m.group(3))
+            refs = ''.join('[{}:a:{}]'.format(file_index, n) for n in range(count))
+            return '{}{}=inputs={}'.format(refs, filter_name, count)
+        return self.MULTI_INPUT_RE.sub(_explicit, graph)
+
+    def _prefix_labels(self, graph: str, prefix: str) -> str:
+        def _prefix(m):
+            label = m.group(1)
+            if self.INPUT_REF_RE.match(label):
+                return m.group(0)
+            return '[{}{}]'.format(prefix, label)
+        return self.LABEL_RE.sub(_prefix, graph)
+
+    def _count_chain_outputs(self, chain: str) -> int:
+        m = self.FILTER_RE.match(chain.split(',')[-1])
+        if m is None:
+            return 1
+        name, options = m.group(1), m.group(2) or ''
+        if name in self.SPLIT_FILTERS:
+            return int(options) if options.isdigit() else 2
+        if name == 'channelsplit':
+            layout = 'stereo'
+            for k, option in enumerate(options.split(':')):
+                key, sep, value = option.partition('=')
+                if sep and key == 'channel_layout':
+                    layout = value
+                elif not sep and k == 0 and key:
+                    layout = key
+            return self.CHANNEL_LAYOUT_SIZES.get(layout, 1)
+        return 1
+
+    def _get_chain_type(self, chain: str) -> str:
+        m = self.CHAIN_INPUT_TYPE_RE.match(chain)
+        if m is not None:
+            return m.group(1)
+        m = self.FILTER_RE.match(chain.split(',')[-1])
+        name = m.group(1) if m is not None else ''
+        return 'a' if name.startswith('a') or name in self.AUDIO_FILTERS else 'v'
+
+    def _label_unlabelled_outputs(self, n: int, graph: str, labels: list, types: set) -> str:
+        chains = []
+        for chain in graph.split(';'):
+            if chain.strip() and not chain.strip().endswith(']'):
+                new_labels = [self.UNLABELLED_LABEL.format(n, len(labels) + k)
+                              for k in range(self._count_chain_outputs(chain))]
+                labels.extend(new_labels)
+                types.add(self._get_chain_type(chain))
+                chain = chain.rstrip() + ''.join('[{}]'.format(l) for l in new_labels)
+            chains.append(chain)
+        return ';'.join(chains)
+
+    def _split_output(self, n: int, parameters: list) -> tuple:
+        prefix = self.LABEL_PREFIX.format(n)
+        graphs = []
+        rest = []
+        unlabelled = []
+        unlabelled_types = set()
+        i = 0
+        while i < len(parameters):
+            arg = parameters[i]
+            if arg in self.FILTER_COMPLEX_ARGS:
+                if i + 1 >= len(parameters):
+                    raise ProfileMergeException('Output {}: {} without a filter graph'.format(n, arg))
+                graph = self._prefix_labels(self._normalize_graph(parameters[i + 1]), prefix)
+                graphs.append(self._label_unlabelled_outputs(n, graph, unlabelled, unlabelled_types))
+                i += 2
+                continue
+            if arg == '-map' and i + 1 < len(parameters):
+                rest.extend([arg, self._prefix_labels(parameters[i + 1], prefix)])
+                i += 2
+                continue
+            rest.append(arg)
+            i += 1
+        if unlabelled:
+            maps = []
+            for label in unlabelled:
+                maps.extend(['-map', '[{}]'.format(label)])
+            if '-map' not in parameters:
+                for stream_type, disable_arg, ref in self.AUTO_MAPS:
+                    if stream_type not in unlabelled_types and disable_arg not in parameters:
+                        logging.debug('Output {}: mapping {} explicitly instead of automatic selection'.format(n, ref))
+                        maps.extend(['-map', ref])
+            rest = maps + rest
+        return graphs, rest
+
+    def _share_input_refs(self, graphs: list) -> tuple:
+        counts = {}
+        for graph in graphs:
+            for label in self.LABEL_RE.findall(graph):
+                if self.SPLITTABLE_REF_RE.match(label):
+                    counts[label] = counts.get(label, 0) + 1
+        shared = {ref: count for ref, count in counts.items() if count > 1}
+        if not shared:
+            return [], graphs
+
+        split_chains = []
+        split_labels = {}
+        for ref, count in shared.items():
+            file_index, s_type, s_index = self.SPLITTABLE_REF_RE.match(ref).groups()
+            labels = [self.SPLIT_LABEL.format(file_index, s_type, s_index, n) for n in range(count)]
+            split_labels[ref] = iter(labels)
+            split_chains.append('[{}]{}={}{}'.format(
+                ref, 'split' if s_type == 'v' else 'asplit', count, ''.join('[{}]'.format(l) for l in labels)
+            ))
+            logging.debug('Sharing decoded {} between {} filter inputs'.format(ref, count))
+
+        def _replace(m):
+            label = m.group(1)
+            if label in split_labels:
+                return '[{}]'.format(next(split_labels[label]))
+            return m.group(0)
+        return split_chains, [self.LABEL_RE.sub(_replace, graph) for graph in graphs]
+
+    @staticmethod
+    def _check_inputs(profiles: list) -> list:
+        inputs = profiles[0].inputs
+        for p in profiles[1:]:
+            if p.inputs != inputs:
+                raise ProfileMergeException('Profiles with different inputs can not be merged')
+        return copy.deepcopy(inputs)
+
+    def merge(self, profiles: list) -> FFmpegProfile:
+        if not profiles:
+            raise ProfileMergeException('Nothing to merge')
+        if len(profiles) == 1:
+            return profiles[0]
+        inputs = self._check_inputs(profiles)
+
+        outputs = []
+        graphs = []
+        n = 0
+        for p in profiles:
+            for o in p.outputs:
+                output_graphs, parameters = self._split_output(n, o['parameters'])
+                graphs.extend(output_graphs)
+                outputs.append(dict(o, parameters=parameters))
+                n += 1
+
+        filenames = [o['filename'] for o in outputs]
+        if len(set(filenames)) != len(filenames):
+            logging.warning('Merged profiles share output file names - later outputs will be renamed')
+
+        split_chains, graphs = self._share_input_refs(graphs)
+        if graphs:
+            merged_graph = ';'.join(split_chains + graphs)
+            logging.debug('Merged filter graph: {}'.format(merged_graph))
+            outputs[0]['parameters'] = ['-filter_complex', merged_graph] + outputs[0]['parameters']
+
+        return FFmpegProfile({'inputs': inputs, 'outputs': outputs})
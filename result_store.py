@@ -0,0 +1,233 @@
+import errno
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from .capabilities import FFCapabilities
+from .output_finalizer import OutputFinalizer
+from .metrics import get_registry, track_cache
+
+
+class TranscodeResultStore:
+
+    DB_FILENAME = 'results.sqlite3'
+
+    OBJECTS_DIR = 'objects'
+
+    OBJECT_NAME = '{}_{}'
+
+    KEY_VERSION = 1
+
+    SAMPLE_SIZE = 64 * 1024
+
+    SAMPLE_COUNT = 8
+
+    USE_HARDLINKS = False
+
+    OBJECT_MODE = 0o444
+
+    def __init__(self, store_dir: str, max_size: int, sample_size: int=None, logging_func: callable=None):
+        self._store_dir = os.path.abspath(store_dir)
+        self._objects_dir = os.path.join(self._store_dir, self.OBJECTS_DIR)
+        os.makedirs(self._objects_dir, exist_ok=True)
+        self._max_size = max_size
+        self._sample_size = self.SAMPLE_SIZE if sample_size is None else sample_size
+        self._logging_func = logging_func
+        self._binary_keys = {}
+        self._lock = threading.Lock()
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._cache_evictions = 0
+        track_cache('transcode_results', self)
+        self._db = sqlite3.connect(
+            os.path.join(self._store_dir, self.DB_FILENAME), timeout=30, check_same_thread=False, isolation_level=None
+        )
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'key TEXT PRIMARY KEY, sizes TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL, mtimes TEXT)'
+        )
+        if 'mtimes' not in [r[1] for r in self._db.execute('PRAGMA table_info(results)')]:
+            self._db.execute('ALTER TABLE results ADD COLUMN mtimes TEXT')
+        self._db.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+
+    def _log(self, msg: str) -> None:
+        if self._logging_func:
+            self._logging_func(msg)
+
+    @property
+    def store_dir(self) -> str:
+        return self._store_dir
+
+    def _get_fingerprint(self, file_path: str, file_size: int) -> str:
+        h = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            if file_size <= self._sample_size * self.SAMPLE_COUNT:
+                h.update(f.read())
+            else:
+                step = (file_size - self._sample_size) // (self.SAMPLE_COUNT - 1)
+                for n in range(self.SAMPLE_COUNT):
+                    f.seek(n * step)
+                    h.update(f.read(self._sample_size))
+        return h.hexdigest()
+
+    def get_file_identity(self, file_path: str):
+        try:
+            st = os.stat(file_path)
+            return [st.st_size, st.st_mtime_ns, self._get_fingerprint(file_path, st.st_size)]
+        except (OSError, ValueError):
+            return None
+
+    def _get_binary_key(self, bin_path: str) -> str:
+        key = self._binary_keys.get(bin_path)
+        if key is None:
+            key = self._binary_keys[bin_path] = FFCapabilities.get_binary_key(bin_path)
+        return key
+
+    def get_key(self, bin_path: str, general_args: list, inputs: list, outputs: list):
+        try:
+            parts = [self.KEY_VERSION, self._get_binary_key(bin_path), list(general_args)]
+        except OSError:
+            return None
+        for in_args, in_url in inputs:
+            identity = self.get_file_identity(in_url)
+            if identity is None:
+                return None
+            parts.append([list(in_args), identity])
+        for out_args, out_path in outputs:
+            parts.append([list(out_args), os.path.splitext(out_path)[1].lower()])
+        return hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+
+    def _get_object_path(self, key: str, n: int) -> str:
+        return os.path.join(self._objects_dir, key[:2], self.OBJECT_NAME.format(key, n))
+
+    @staticmethod
+    def _clone(src_path: str, dst_path: str, link: bool) -> None:
+        if link:
+            try:
+                os.link(src_path, dst_path)
+                return
+            except FileExistsError:
+                raise
+            except OSError as e:
+                logging.debug('Hardlink is not possible ({}) - cloning'.format(e))
+        OutputFinalizer.clone_file(src_path, dst_path)
+
+    def materialize(self, key: str, paths: list) -> bool:
+        with self._lock:
+            row = self._db.execute('SELECT sizes, mtimes FROM results WHERE key = ?', (key, )).fetchone()
+        sizes = json.loads(row[0]) if row is not None else None
+        if sizes is not None and len(sizes) == len(paths):
+            mtimes = json.loads(row[1]) if row[1] is not None else [None] * len(sizes)
+            created = []
+            try:
+                for n, path in enumerate(paths):
+                    object_path = self._get_object_path(key, n)
+                    st = os.stat(object_path)
+                    if st.st_size != sizes[n] or st.st_mtime_ns != mtimes[n]:
+                        raise OSError(errno.ESTALE, 'Stored result was modified', object_path)
+                    self._clone(object_path, path, self.USE_HARDLINKS)
+                    created.append(path)
+            except OSError as e:
+                logging.warning('Unable to materialize stored result {}: {} - discarding it'.format(key, e))
+                for path in created:
+                    os.unlink(path)
+                self._discard(key)
+            else:
+                with self._lock:
+                    self._db.execute('UPDATE results SET accessed = ? WHERE key = ?', (time.time(), key))
+                    self._cache_hits += 1
+                self._log('Transcode result store hit')
+                get_registry().inc('ffmpeg_result_store_bytes_total', sum(sizes), result='hit')
+                return True
+        with self._lock:
+            self._cache_misses += 1
+        self._log('Transcode result store miss')
+        return False
+
+    def store(self, key: str, paths: list) -> None:
+        sizes = []
+        mtimes = []
+        for n, path in enumerate(paths):
+            object_path = self._get_object_path(key, n)
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            tmp_path = os.path.join(os.path.dirname(object_path), '.{}.tmp'.format(uuid.uuid4()))
+            try:
+                self._clone(path, tmp_path, self.USE_HARDLINKS)
+                os.chmod(tmp_path, self.OBJECT_MODE)
+                st = os.stat(tmp_path)
+                sizes.append(st.st_size)
+                mtimes.append(st.st_mtime_ns)
+                os.replace(tmp_path, object_path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+        evicted = []
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO results (key, sizes, size, accessed, mtimes) VALUES (?, ?, ?, ?, ?)',
+                    (key, json.dumps(sizes), sum(sizes), time.time(), json.dumps(mtimes))
+                )
+                evicted = self._evict()
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._cache_evictions += len(evicted)
+        self._remove_objects(evicted)
+        get_registry().inc('ffmpeg_result_store_bytes_total', sum(sizes), result='stored')
+
+    def _evict(self) -> list:
+        evicted = []
+        total_size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        while total_size > self._max_size:
+            row = self._db.execute('SELECT key, sizes, size FROM results ORDER BY accessed LIMIT 1').fetchone()
+            if row is None:
+                break
+            self._db.execute('DELETE FROM results WHERE key = ?', (row[0], ))
+            evicted.append((row[0], len(json.loads(row[1]))))
+            total_size -= row[2]
+            self._log('Transcode result store eviction')
+        return evicted
+
+    def _remove_objects(self, entries: list) -> None:
+        for key, count in entries:
+            for n in range(count):
+                try:
+                    os.unlink(self._get_object_path(key, n))
+                except FileNotFoundError:
+                    pass
+
+    def _discard(self, key: str) -> None:
+        with self._lock:
+            row = self._db.execute('SELECT sizes FROM results WHERE key = ?', (key, )).fetchone()
+            self._db.execute('DELETE FROM results WHERE key = ?', (key, ))
+        if row is not None:
+            self._remove_objects([(key, len(json.loads(row[0])))])
+
+    def get_size(self) -> int:
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+
+    def get_stats(self):
+        total_requests = self._cache_hits + self._cache_misses
+        try:
+            ratio = self._cache_hits / total_requests
+        except ZeroDivisionError:
+            ratio = 0.0
+        return self._cache_hits, self._cache_misses, total_requests, ratio
+
+    def get_evictions(self) -> int:
+        return self._cache_evictions
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,282 @@
+import csv
+import hashlib
+import json
+import os
+import logging
+import shutil
+import tempfile
+
+from .ffmpeg import FFmpegBaseCommand
+from .ffprobe import FFprobeInfoCommand
+from .profile import FFmpegProfile
+from .segmented import FFmpegSegmentedEncoder
+from .factory import ffmpeg_factory, ffprobe_factory
+from .metrics import get_registry
+from .exceptions import FFmpegProcessException, FFprobeProcessException, FFprobeTerminatedException, \
+    FFmpegOutputAlreadyExistsException, ResumableEncodingException
+
+
+class FFmpegResumableEncoder:
+
+    SEGMENT_DURATION = 60.0
+
+    SEGMENT_FORMAT = 'matroska'
+
+    SEGMENT_EXT = '.mkv'
+
+    SEGMENT_NAME = 'out{}_%05d'
+
+    SEGMENT_LIST_NAME = 'out{}_attempt{}.csv'
+
+    JOURNAL_NAME = 'journal.json'
+
+    JOURNAL_VERSION = 1
+
+    JOB_DIR_NAME = 'resumable_{}'
+
+    MAX_ATTEMPTS = 3
+
+    TIME_TOLERANCE = 0.05
+
+    def __init__(self, work_dir: str, ffmpeg_cmd_class=FFmpegBaseCommand, segment_duration: float=None,
+                 max_attempts: int=None):
+        logging.debug('Fetching FFmpeg and FFprobe command objects...')
+        self._ffmpeg_cmd = ffmpeg_factory.get_ffmpeg_command(ffmpeg_cmd_class)
+        self._ffprobe_info_cmd = ffprobe_factory.get_ffprobe_command(FFprobeInfoCommand)
+        self._work_dir = os.path.abspath(work_dir)
+        self._segment_duration = segment_duration or self.__class__.SEGMENT_DURATION
+        self._max_attempts = max_attempts or self.__class__.MAX_ATTEMPTS
+
+    def get_job_dir(self, inputs: list, outputs: list) -> str:
+        key = json.dumps([inputs, outputs, self._segment_duration, self.SEGMENT_FORMAT])
+        return os.path.join(self._work_dir, self.JOB_DIR_NAME.format(hashlib.sha1(key.encode()).hexdigest()[:16]))
+
+    @staticmethod
+    def _get_signature(path: str) -> list:
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns]
+
+    def _new_journal(self, inputs: list, outputs: list) -> dict:
+        return {
+            'version': self.JOURNAL_VERSION,
+            'inputs': [[u, self._get_signature(u)] for a, u in inputs],
+            'segment_duration': self._segment_duration,
+            'attempts': 0,
+            'running': None,
+            'complete': False,
+            'segments': [[] for _ in outputs],
+            'joined': [],
+        }
+
+    def _load_journal(self, job_dir: str, inputs: list, outputs: list) -> dict:
+        journal_path = os.path.join(job_dir, self.JOURNAL_NAME)
+        journal = None
+        try:
+            with open(journal_path) as f:
+                journal = json.load(f)
+        except OSError:
+            pass
+        except ValueError as e:
+            logging.warning('Unable to read journal "{}": {}'.format(journal_path, e))
+        expected = self._new_journal(inputs, outputs)
+        if journal is not None and all(
+                journal.get(k) == expected[k] for k in ('version', 'inputs', 'segment_duration')):
+            logging.info('Found journal of an interrupted encode in "{}"'.format(job_dir))
+            return journal
+        if journal is not None:
+            logging.warning('Inputs changed since "{}" was written - starting over'.format(journal_path))
+        shutil.rmtree(job_dir, ignore_errors=True)
+        os.makedirs(job_dir)
+        self._save_journal(job_dir, expected)
+        return expected
+
+    def _save_journal(self, job_dir: str, journal: dict) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=job_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(journal, f)
+            os.replace(tmp_path, os.path.join(job_dir, self.JOURNAL_NAME))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @staticmethod
+    def _read_segment_list(list_path: str, offset: float) -> list:
+        segments = []
+        try:
+            with open(list_path, newline='') as f:
+                for row in csv.reader(f):
+                    try:
+                        segments.append((row[0], float(row[1]) + offset, float(row[2]) + offset))
+                    except (IndexError, ValueError):
+                        break
+        except OSError:
+            pass
+        return segments
+
+    def _verify_segment(self, path: str) -> int:
+        try:
+            size = os.path.getsize(path)
+            info = self._ffprobe_info_cmd.exec(path, show_streams=False, show_programs=False)
+            if float(info['format']['duration']) > 0:
+                return size
+        except (OSError, FFprobeProcessException, FFprobeTerminatedException, KeyError, TypeError, ValueError) as e:
+            logging.debug('Segment "{}" failed verification: {}'.format(path, e))
+        return None
+
+    def _update_journal(self, job_dir: str, journal: dict) -> bool:
+        running = journal['running']
+        verified = True
+        if running is not None:
+            for m, segments in enumerate(journal['segments']):
+                list_path = os.path.join(job_dir, self.SEGMENT_LIST_NAME.format(m, running['attempt']))
+                for name, start, end in self._read_segment_list(list_path, running['offset']):
+                    size = self._verify_segment(os.path.join(job_dir, name))
+                    if size is None:
+                        logging.warning('Segment "{}" is damaged - it will be encoded again'.format(name))
+                        verified = False
+                        break
+                    segments.append({'name': name, 'start': start, 'end': end, 'size': size})
+            journal['running'] = None
+        self._save_journal(job_dir, journal)
+        return verified
+
+    def _get_resume_point(self, job_dir: str, journal: dict) -> float:
+        for segments in journal['segments']:
+            expected = 0.0
+            for n, s in enumerate(segments):
+                path = os.path.join(job_dir, s['name'])
+                if abs(s['start'] - expected) > self.TIME_TOLERANCE or not os.path.isfile(path) or \
+                        os.path.getsize(path) != s['size']:
+                    logging.warning('Segment "{}" is missing or changed - encoding again from {:.3f}s'.format(
+                        s['name'], expected
+                    ))
+                    del segments[n:]
+                    journal['complete'] = False
+                    break
+                expected = s['end']
+        resume = min(segments[-1]['end'] if segments else 0.0 for segments in journal['segments'])
+        trimmed = not journal['complete']
+        while trimmed:
+            trimmed = False
+            for segments in journal['segments']:
+                while segments and segments[-1]['end'] > resume + self.TIME_TOLERANCE:
+                    segments.pop()
+                    trimmed = True
+            resume = min(segments[-1]['end'] if segments else 0.0 for segments in journal['segments'])
+        kept = {s['name'] for segments in journal['segments'] for s in segments}
+        for name in os.listdir(job_dir):
+            if name.endswith(self.SEGMENT_EXT) and name not in kept:
+                os.remove(os.path.join(job_dir, name))
+        return resume
+
+    @staticmethod
+    def _split_format(out_args: list) -> tuple:
+        out_args = list(out_args)
+        out_format = None
+        while '-f' in out_args[:-1]:
+            n = out_args.index('-f')
+            out_format = out_args[n + 1]
+            del out_args[n:n + 2]
+        return out_args, out_format
+
+    def _build_attempt(self, inputs: list, outputs: list, job_dir: str, journal: dict, resume: float) -> tuple:
+        seek_args = ['-ss', '{:.6f}'.format(resume)] if resume else []
+        attempt_inputs = [(seek_args + list(a), u) for a, u in inputs]
+        attempt_outputs = []
+        for m, (out_args, out_path) in enumerate(outputs):
+            out_args, _ = self._split_format(out_args)
+            if '-force_key_frames' not in out_args:
+                out_args.extend(['-force_key_frames', 'expr:gte(t,n_forced*{})'.format(self._segment_duration)])
+            out_args.extend([
+                '-f', 'segment', '-segment_format', self.SEGMENT_FORMAT,
+                '-segment_time', str(self._segment_duration),
+                '-segment_start_number', str(len(journal['segments'][m])), '-reset_timestamps', '1',
+                '-segment_list', os.path.join(job_dir, self.SEGMENT_LIST_NAME.format(m, journal['attempts'])),
+                '-segment_list_type', 'csv',
+            ])
+            attempt_outputs.append((out_args, os.path.join(job_dir, self.SEGMENT_NAME.format(m) + self.SEGMENT_EXT)))
+        return attempt_inputs, attempt_outputs
+
+    def _run_attempt(self, inputs: list, outputs: list, job_dir: str, journal: dict, resume: float) -> bool:
+        attempt_inputs, attempt_outputs = self._build_attempt(inputs, outputs, job_dir, journal, resume)
+        journal['running'] = {'attempt': journal['attempts'], 'offset': resume}
+        journal['attempts'] += 1
+        self._save_journal(job_dir, journal)
+        if resume:
+            logging.info('Resuming encode from {:.3f}s (attempt {})'.format(resume, journal['attempts']))
+            get_registry().inc('ffmpeg_resumed_seconds_total', resume, command=self.__class__.__name__)
+        try:
+            self._ffmpeg_cmd.exec(attempt_inputs, attempt_outputs, False, direct_output=True)
+        except FFmpegProcessException as e:
+            logging.warning('Encoding attempt {} failed: {}'.format(journal['attempts'], e))
+            self._update_journal(job_dir, journal)
+            raise
+        journal['complete'] = self._update_journal(job_dir, journal) and all(journal['segments'])
+        return journal['complete']
+
+    def _join(self, outputs: list, job_dir: str, journal: dict) -> list:
+        logging.info('Joining segments...')
+        reports = []
+        for m, (out_args, out_path) in enumerate(outputs):
+            if m in journal['joined']:
+                continue
+            list_path = os.path.join(job_dir, 'concat_{}.txt'.format(m))
+            FFmpegSegmentedEncoder._write_concat_list(
+                list_path, [os.path.join(job_dir, s['name']) for s in journal['segments'][m]]
+            )
+            concat_args = list(FFmpegSegmentedEncoder.CONCAT_OUTPUT_ARGS)
+            concat_args.extend(FFmpegSegmentedEncoder.get_mux_args(out_args))
+            reports.extend(self._ffmpeg_cmd.exec(
+                [(list(FFmpegSegmentedEncoder.CONCAT_INPUT_ARGS), list_path)], [(concat_args, out_path)], False,
+                use_store=False
+            ))
+            journal['joined'].append(m)
+            self._save_journal(job_dir, journal)
+        return reports
+
+    def exec(self, inputs: list, outputs: list) -> list:
+        job_dir = self.get_job_dir(inputs, outputs)
+        journal = self._load_journal(job_dir, inputs, outputs)
+        for m, (out_args, out_path) in enumerate(outputs):
+            if m not in journal['joined'] and os.path.exists(out_path):
+                msg = 'Output file "{}" already exists'.format(out_path)
+                logging.error(msg)
+                raise FFmpegOutputAlreadyExistsException(msg)
+        result_key = self._ffmpeg_cmd.get_result_key(inputs, outputs)
+        if not journal['joined']:
+            reports = self._ffmpeg_cmd.load_result(result_key, [p for a, p in outputs])
+            if reports is not None:
+                shutil.rmtree(job_dir, ignore_errors=True)
+                return reports
+        if journal['running'] is not None:
+            logging.info('Recovering segments of interrupted attempt {}'.format(journal['running']['attempt'] + 1))
+            self._update_journal(job_dir, journal)
+
+        exception = None
+        for attempt in range(self._max_attempts):
+            resume = self._get_resume_point(job_dir, journal)
+            if journal['complete']:
+                break
+            try:
+                if self._run_attempt(inputs, outputs, job_dir, journal, resume):
+                    break
+            except FFmpegProcessException as e:
+                exception = e
+        else:
+            raise ResumableEncodingException(
+                'Encoding failed after {} attempts - completed segments are kept in "{}"'.format(
+                    self._max_attempts, job_dir
+                )
+            ) from exception
+
+        reports = self._join(outputs, job_dir, journal)
+        shutil.rmtree(job_dir, ignore_errors=True)
+        if len(reports) == len(outputs):
+            self._ffmpeg_cmd.save_result(result_key, reports)
+        return reports
+
+    def encode(self, input_url: str, profile: FFmpegProfile, output_dir: str, input_urls: list=None) -> list:
+        inputs, outputs = profile.get_exec_args([input_url] + (input_urls or []), output_dir)
+        return self.exec(inputs, outputs)
@@ -0,0 +1,379 @@
+import os
+import logging
+import heapq
+import itertools
+import signal
+import threading
+import time
+
+from .ffmpeg import FFmpegBaseCommand
+from .metrics import get_registry
+from .exceptions import FFmpegJobCancelledException, SchedulerShutdownException
+
+
+class FFmpegJob:
+
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_LOW = 2
+
+    PRIORITY_NAMES = {
+        PRIORITY_HIGH: 'high',
+        PRIORITY_NORMAL: 'normal',
+        PRIORITY_LOW: 'low',
+    }
+
+    STATE_QUEUED = 'queued'
+    STATE_RUNNING = 'running'
+    STATE_PAUSED = 'paused'
+    STATE_DONE = 'done'
+    STATE_FAILED = 'failed'
+    STATE_CANCELLED = 'cancelled'
+
+    FINAL_STATES = (STATE_DONE, STATE_FAILED, STATE_CANCELLED)
+
+    def __init__(self, inputs: list, outputs: list, priority: int, threads: int, general_args: list=None,
+                 progress_pipe: bool=None):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.priority = priority
+        self.threads = threads
+        self.general_args = general_args
+        self.progress_pipe = progress_pipe
+        self.state = self.STATE_QUEUED
+        self.exception = None
+        self.reports = None
+        self.cpus = None
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self._proc = None
+        self._cancel_requested = False
+        self._finished = threading.Event()
+
+    @property
+    def pid(self) -> int:
+        return None if self._proc is None else self._proc.pid
+
+    @property
+    def queue_wait(self) -> float:
+        if self.started_at is None:
+            return None
+        return self.started_at - self.submitted_at
+
+    @property
+    def run_time(self) -> float:
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    def wait(self, timeout: float=None) -> bool:
+        return self._finished.wait(timeout)
+
+    def result(self, timeout: float=None) -> list:
+        if not self._finished.wait(timeout):
+            raise TimeoutError
+        if self.exception is not None:
+            raise self.exception
+        return self.reports
+
+    def __repr__(self):
+        return 'FFmpegJob(priority={}, threads={}, state={}, pid={})'.format(
+            self.PRIORITY_NAMES.get(self.priority, self.priority), self.threads, self.state, self.pid
+        )
+
+
+class FFmpegScheduler:
+
+    DEFAULT_JOB_THREADS = 2
+
+    PAUSABLE_PRIORITY = FFmpegJob.PRIORITY_LOW
+
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, ffmpeg_command: FFmpegBaseCommand, cpu_budget: int=None, default_threads: int=None,
+                 max_load: float=None, use_affinity: bool=False, preempt: bool=True):
+        self._ffmpeg_command = ffmpeg_command
+        self._cpu_budget = max(1, cpu_budget or os.cpu_count() or 1)
+        self._default_threads = default_threads or min(self.DEFAULT_JOB_THREADS, self._cpu_budget)
+        self._max_load = max_load
+        self._use_affinity = use_affinity and hasattr(os, 'sched_setaffinity')
+        self._preempt = preempt and hasattr(signal, 'SIGSTOP')
+        if self._use_affinity:
+            self._free_cpus = sorted(os.sched_getaffinity(0))[:self._cpu_budget]
+        else:
+            self._free_cpus = []
+        self._queue = []
+        self._sequence = itertools.count()
+        self._running = []
+        self._paused = []
+        self._used_threads = 0
+        self._shutdown = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._started_at = time.monotonic()
+        self._metrics = {}
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name='FFmpegScheduler', daemon=True)
+        self._dispatcher.start()
+
+    @property
+    def cpu_budget(self) -> int:
+        return self._cpu_budget
+
+    def submit(self, inputs: list, outputs: list, priority: int=FFmpegJob.PRIORITY_NORMAL, threads: int=None,
+               general_args: list=None, progress_pipe: bool=None) -> FFmpegJob:
+        threads = min(max(1, threads or self._default_threads), self._cpu_budget)
+        job = FFmpegJob(inputs, outputs, priority, threads, general_args, progress_pipe)
+        with self._lock:
+            if self._shutdown:
+                raise SchedulerShutdownException('Scheduler is shut down')
+            heapq.heappush(self._queue, (priority, next(self._sequence), job))
+            self._get_metrics(priority)['submitted'] += 1
+            logging.debug('Job queued: {}'.format(job))
+            self._wakeup.notify()
+        return job
+
+    def cancel(self, job: FFmpegJob) -> bool:
+        with self._lock:
+            if job.state in FFmpegJob.FINAL_STATES:
+                return False
+            job._cancel_requested = True
+            if job.state == FFmpegJob.STATE_QUEUED:
+                self._queue = [e for e in self._queue if e[2] is not job]
+                heapq.heapify(self._queue)
+                self._finish_job(job, FFmpegJob.STATE_CANCELLED, FFmpegJobCancelledException('Cancelled while queued'))
+                return True
+            logging.info('Cancelling running job {}'.format(job))
+            self._terminate(job)
+            return True
+
+    def shutdown(self, wait: bool=True, cancel_pending: bool=False) -> None:
+        with self._lock:
+            self._shutdown = True
+            if cancel_pending:
+                queued = [e[2] for e in self._queue]
+                self._queue = []
+                for job in queued:
+                    job._cancel_requested = True
+                    self._finish_job(job, FFmpegJob.STATE_CANCELLED, FFmpegJobCancelledException('Scheduler shut down'))
+            self._wakeup.notify()
+        if wait:
+            self._dispatcher.join()
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            elapsed = time.monotonic() - self._started_at
+            metrics = {}
+            for priority, m in self._metrics.items():
+                m = dict(m)
+                m['mean_queue_wait'] = m['queue_wait_total'] / m['started'] if m['started'] else 0.0
+                m['mean_run_time'] = m['run_time_total'] / m['completed'] if m['completed'] else 0.0
+                m['throughput'] = m['completed'] / elapsed if elapsed else 0.0
+                metrics[FFmpegJob.PRIORITY_NAMES.get(priority, priority)] = m
+            return metrics
+
+    def _get_metrics(self, priority: int) -> dict:
+        if priority not in self._metrics:
+            self._metrics[priority] = {
+                'submitted': 0,
+                'started': 0,
+                'completed': 0,
+                'failed': 0,
+                'cancelled': 0,
+                'paused': 0,
+                'queue_wait_total': 0.0,
+                'run_time_total': 0.0,
+            }
+        return self._metrics[priority]
+
+    def _get_load(self) -> float:
+        try:
+            return os.getloadavg()[0]
+        except (AttributeError, OSError):
+            return None
+
+    def _can_admit(self, threads: int) -> bool:
+        if not self._running:
+            return True
+        if self._used_threads + threads > self._cpu_budget:
+            return False
+        if self._max_load is not None:
+            load = self._get_load()
+            if load is not None and load > self._max_load:
+                logging.debug('Load average {} exceeds {} - holding back queued jobs'.format(load, self._max_load))
+                return False
+        return True
+
+    def _reserve(self, job: FFmpegJob) -> None:
+        self._used_threads += job.threads
+        if self._use_affinity:
+            job.cpus = self._free_cpus[:job.threads] or None
+            del self._free_cpus[:job.threads]
+
+    def _release(self, job: FFmpegJob) -> None:
+        self._used_threads -= job.threads
+        if job.cpus:
+            self._free_cpus.extend(job.cpus)
+            self._free_cpus.sort()
+        job.cpus = None
+
+    def _apply_affinity(self, job: FFmpegJob) -> None:
+        if not job.cpus or job._proc is None:
+            return
+        try:
+            tids = [int(t) for t in os.listdir('/proc/{}/task'.format(job.pid))]
+        except OSError:
+            tids = [job.pid]
+        for tid in tids:
+            try:
+                os.sched_setaffinity(tid, job.cpus)
+            except OSError as e:
+                logging.debug('Unable to set CPU affinity of {}: {}'.format(tid, e))
+
+    def _terminate(self, job: FFmpegJob) -> None:
+        if job._proc is None:
+            return
+        try:
+            job._proc.terminate()
+            if self._preempt:
+                job._proc.send_signal(signal.SIGCONT)
+        except OSError as e:
+            logging.debug('Unable to terminate {}: {}'.format(job, e))
+
+    def _pause(self, job: FFmpegJob) -> bool:
+        if job._proc is None:
+            return False
+        try:
+            job._proc.send_signal(signal.SIGSTOP)
+        except OSError as e:
+            logging.debug('Unable to pause {}: {}'.format(job, e))
+            return False
+        logging.info('Pausing {}'.format(job))
+        self._running.remove(job)
+        self._paused.append(job)
+        self._release(job)
+        job.state = FFmpegJob.STATE_PAUSED
+        self._get_metrics(job.priority)['paused'] += 1
+        return True
+
+    def _resume(self, job: FFmpegJob) -> None:
+        logging.info('Resuming {}'.format(job))
+        self._paused.remove(job)
+        self._running.append(job)
+        self._reserve(job)
+        job.state = FFmpegJob.STATE_RUNNING
+        self._apply_affinity(job)
+        try:
+            job._proc.send_signal(signal.SIGCONT)
+        except OSError as e:
+            logging.debug('Unable to resume {}: {}'.format(job, e))
+
+    def _preempt_for(self, priority: int, threads: int) -> bool:
+        victims = sorted(
+            (j for j in self._running if j.priority >= self.PAUSABLE_PRIORITY and j.priority > priority),
+            key=lambda j: (-j.priority, -(j.started_at or 0))
+        )
+        paused = False
+        for job in victims:
+            if self._used_threads + threads <= self._cpu_budget:
+                break
+            paused = self._pause(job) or paused
+        return paused
+
+    def _schedule(self) -> None:
+        while True:
+            paused = min(self._paused, key=lambda j: j.priority, default=None)
+            queued = self._queue[0][2] if self._queue else None
+            if paused is not None and (queued is None or paused.priority <= queued.priority):
+                if self._can_admit(paused.threads):
+                    self._resume(paused)
+                    continue
+                return
+            if queued is None:
+                return
+            if not self._can_admit(queued.threads):
+                if not (self._preempt and self._preempt_for(queued.priority, queued.threads)):
+                    return
+                if not self._can_admit(queued.threads):
+                    return
+            heapq.heappop(self._queue)
+            self._start(queued)
+
+    def _start(self, job: FFmpegJob) -> None:
+        self._reserve(job)
+        job.state = FFmpegJob.STATE_RUNNING
+        job.started_at = time.monotonic()
+        metrics = self._get_metrics(job.priority)
+        metrics['started'] += 1
+        metrics['queue_wait_total'] += job.queue_wait
+        get_registry().observe('ffmpeg_queue_seconds', job.queue_wait,
+                               priority=FFmpegJob.PRIORITY_NAMES.get(job.priority, job.priority))
+        self._running.append(job)
+        logging.debug('Starting {}'.format(job))
+        threading.Thread(target=self._run_job, args=(job, ), name='FFmpegJob', daemon=True).start()
+
+    def _with_threads(self, job: FFmpegJob) -> list:
+        outputs = []
+        for out_args, out_path in job.outputs:
+            if '-threads' not in out_args:
+                out_args = ['-threads', str(job.threads)] + out_args
+            outputs.append((out_args, out_path))
+        return outputs
+
+    def _attach(self, job: FFmpegJob, proc) -> None:
+        with self._lock:
+            job._proc = proc
+            if job._cancel_requested:
+                self._terminate(job)
+                return
+            self._apply_affinity(job)
+
+    def _run_job(self, job: FFmpegJob) -> None:
+        exception = None
+        try:
+            job.reports = self._ffmpeg_command.exec(
+                job.inputs, self._with_threads(job), False, job.general_args, job.progress_pipe,
+                lambda proc: self._attach(job, proc)
+            )
+        except Exception as e:
+            exception = e
+        with self._lock:
+            if job in self._paused:
+                self._paused.remove(job)
+            else:
+                self._running.remove(job)
+                self._release(job)
+            if job._cancel_requested:
+                cancelled = FFmpegJobCancelledException('Cancelled while running')
+                cancelled.__cause__ = exception
+                self._finish_job(job, FFmpegJob.STATE_CANCELLED, cancelled)
+            elif exception is not None:
+                logging.error('Job {} failed: {}'.format(job, exception))
+                self._finish_job(job, FFmpegJob.STATE_FAILED, exception)
+            else:
+                self._finish_job(job, FFmpegJob.STATE_DONE, None)
+            self._wakeup.notify()
+
+    def _finish_job(self, job: FFmpegJob, state: str, exception: Exception) -> None:
+        job.state = state
+        job.exception = exception
+        job.finished_at = time.monotonic()
+        metrics = self._get_metrics(job.priority)
+        if state == FFmpegJob.STATE_DONE:
+            metrics['completed'] += 1
+            metrics['run_time_total'] += job.run_time
+        elif state == FFmpegJob.STATE_FAILED:
+            metrics['failed'] += 1
+        else:
+            metrics['cancelled'] += 1
+        job._proc = None
+        job._finished.set()
+
+    def _dispatch_loop(self) -> None:
+        with self._lock:
+            while True:
+                self._schedule()
+                if self._shutdown and not (self._queue or self._running or self._paused):
+                    break
+                self._wakeup.wait(self.POLL_INTERVAL)
+        logging.debug('Scheduler stopped')
@@ -0,0 +1,285 @@
+import os
+import logging
+import re
+import shutil
+import tempfile
+
+from .ffmpeg import FFmpegBaseCommand
+from .ffprobe import FFprobeInfoCommand, FFprobePacketStreamCommand
+from .profile import FFmpegProfile
+from .factory import ffmpeg_factory, ffprobe_factory
+from .parallel import bounded_imap_unordered
+from .exceptions import FFmpegProcessException, FFprobeProcessException, FFprobeTerminatedException, \
+    FFmpegOutputAlreadyExistsException, SegmentedEncodingException
+
+
+class FFmpegSegmentedEncoder:
+
+    SEGMENT_DURATION = 60.0
+
+    MIN_SEGMENT_DURATION = 10.0
+
+    KEYFRAME_PROBE_PACKETS = 10
+
+    CHUNK_RETRIES = 2
+
+    CHUNK_NAME = 'chunk_{:05d}_{}{}'
+
+    AUDIO_NAME = 'audio_{}{}'
+
+    AUDIO_JOB = 'audio'
+
+    CONCAT_INPUT_ARGS = ['-f', 'concat', '-safe', '0']
+
+    CONCAT_OUTPUT_ARGS = ['-map', '0', '-c', 'copy']
+
+    AUDIO_JOIN_ARGS = ['-map', '1:a']
+
+    FILTER_COMPLEX_ARGS = ('-filter_complex', '-lavfi')
+
+    DISABLE_ARGS = {'v': '-an', 'a': '-vn'}
+
+    CHAIN_RE = re.compile(r'^\s*((?:\[[^\[\]]*\]\s*)*)([\w-]*)(.*?)((?:\[[^\[\]]*\]\s*)*)$', re.DOTALL)
+    LABEL_RE = re.compile(r'\[([^\[\]]*)\]')
+    STREAM_REF_RE = re.compile(r'^-?\d+:([va])')
+
+    MUX_OPTIONS = ('-f', '-timecode', '-movflags', '-brand', '-write_tmcd', '-use_editlist', '-metadata',
+                   '-map_metadata', '-map_chapters', '-disposition', '-tag', '-vtag', '-atag', '-aspect',
+                   '-muxdelay', '-muxpreload')
+
+    def __init__(self, ffmpeg_cmd_class=FFmpegBaseCommand, max_workers: int=None, threads_per_chunk: int=None,
+                 segment_duration: float=None, work_dir: str=None):
+        logging.debug('Fetching FFmpeg and FFprobe command objects...')
+        self._ffmpeg_cmd = ffmpeg_factory.get_ffmpeg_command(ffmpeg_cmd_class)
+        self._ffprobe_info_cmd = ffprobe_factory.get_ffprobe_command(FFprobeInfoCommand)
+        self._ffprobe_packet_cmd = ffprobe_factory.get_ffprobe_command(FFprobePacketStreamCommand)
+        cpu_count = os.cpu_count() or 1
+        self._max_workers = max_workers or max(1, cpu_count // 2)
+        self._threads_per_chunk = threads_per_chunk or max(1, cpu_count // self._max_workers)
+        self._segment_duration = segment_duration or self.__class__.SEGMENT_DURATION
+        self._work_dir = work_dir
+
+    def find_keyframes(self, input_url: str, positions: list) -> list:
+        if not positions:
+            return []
+        read_intervals = ','.join('{:.3f}%+#{}'.format(p, self.KEYFRAME_PROBE_PACKETS) for p in positions)
+        keyframes = set()
+        for packet in self._ffprobe_packet_cmd.exec(input_url, ['pts_time', 'flags'], 'v:0', read_intervals):
+            if 'K' not in str(packet.get('flags', '')):
+                continue
+            try:
+                keyframes.add(float(packet['pts_time']))
+            except (KeyError, ValueError):
+                continue
+        return sorted(keyframes)
+
+    def get_segments(self, input_url: str, duration: float, start_time: float=0.0) -> list:
+        targets = []
+        t = self._segment_duration
+        while t < duration - self.MIN_SEGMENT_DURATION:
+            targets.append(start_time + t)
+            t += self._segment_duration
+        boundaries = []
+        for keyframe in self.find_keyframes(input_url, targets):
+            offset = keyframe - start_time
+            previous = boundaries[-1] if boundaries else 0.0
+            if offset - previous >= self.MIN_SEGMENT_DURATION and duration - offset >= self.MIN_SEGMENT_DURATION:
+                boundaries.append(offset)
+        logging.debug('Segment boundaries: {}'.format(boundaries))
+        return list(zip([0.0] + boundaries, boundaries + [None]))
+
+    def _probe_input(self, input_url: str) -> tuple:
+        try:
+            info = self._ffprobe_info_cmd.exec(input_url, show_programs=False)
+        except (FFprobeProcessException, FFprobeTerminatedException) as e:
+            raise SegmentedEncodingException('Unable to probe "{}"'.format(input_url)) from e
+        has_audio = any(s.get('codec_type') == 'audio' for s in info.get('streams', ()))
+        try:
+            duration = float(info['format']['duration'])
+        except (KeyError, TypeError, ValueError):
+            duration = None
+        try:
+            start_time = float(info['format']['start_time'])
+        except (KeyError, TypeError, ValueError):
+            start_time = 0.0
+        return duration, start_time, has_audio
+
+    def _get_chain_type(self, m, label_types: dict) -> str:
+        for label in self.LABEL_RE.findall(m.group(1)):
+            ref = self.STREAM_REF_RE.match(label)
+            stream_type = ref.group(1) if ref else label_types.get(label)
+            if stream_type is not None:
+                return stream_type
+        return 'a' if m.group(2).startswith('a') else 'v'
+
+    def _split_graph(self, graph: str, stream_type: str, label_types: dict) -> str:
+        chains = []
+        for chain in graph.split(';'):
+            m = self.CHAIN_RE.match(chain)
+            if not chain.strip() or m is None:
+                continue
+            chain_type = self._get_chain_type(m, label_types)
+            for label in self.LABEL_RE.findall(m.group(4)):
+                label_types[label] = chain_type
+            if chain_type == stream_type:
+                chains.append(chain)
+        return ';'.join(chains)
+
+    def split_streams(self, out_args: list, stream_type: str) -> list:
+        label_types = {}
+        split_args = []
+        n = 0
+        while n < len(out_args):
+            arg = out_args[n]
+            if arg in self.FILTER_COMPLEX_ARGS and n + 1 < len(out_args):
+                graph = self._split_graph(out_args[n + 1], stream_type, label_types)
+                if graph:
+                    split_args.extend([arg, graph])
+                n += 2
+                continue
+            if arg == '-map' and n + 1 < len(out_args):
+                ref = out_args[n + 1]
+                labels = self.LABEL_RE.findall(ref)
+                ref_type = label_types.get(labels[0]) if labels else None
+                if ref_type is None and not labels:
+                    m = self.STREAM_REF_RE.match(ref)
+                    ref_type = m.group(1) if m else None
+                if ref_type in (None, stream_type):
+                    split_args.extend([arg, ref])
+                n += 2
+                continue
+            split_args.append(arg)
+            n += 1
+        if self.DISABLE_ARGS[stream_type] not in split_args:
+            split_args.append(self.DISABLE_ARGS[stream_type])
+        return split_args
+
+    def _build_chunk(self, n: int, segment: tuple, inputs: list, outputs: list, video_outputs: list,
+                     audio_outputs: list, chunk_dir: str) -> tuple:
+        start, end = segment
+        seek_args = ['-ss', '{:.6f}'.format(start)]
+        if end is not None:
+            seek_args.extend(['-t', '{:.6f}'.format(end - start)])
+        chunk_inputs = [(seek_args + list(a), u) for a, u in inputs]
+        chunk_outputs = []
+        for m in video_outputs:
+            out_args, out_path = outputs[m]
+            out_args = self.split_streams(out_args, 'v') if m in audio_outputs else list(out_args)
+            if '-threads' not in out_args:
+                out_args = ['-threads', str(self._threads_per_chunk)] + out_args
+            ext = os.path.splitext(out_path)[1]
+            chunk_outputs.append((out_args, os.path.join(chunk_dir, self.CHUNK_NAME.format(n, m, ext))))
+        return chunk_inputs, chunk_outputs
+
+    def _build_audio(self, inputs: list, outputs: list, video_outputs: list, audio_outputs: list,
+                     chunk_dir: str) -> tuple:
+        audio_inputs = [(list(a), u) for a, u in inputs]
+        audio_outputs_args = []
+        for m in audio_outputs:
+            out_args, out_path = outputs[m]
+            out_args = self.split_streams(out_args, 'a') if m in video_outputs else list(out_args)
+            ext = os.path.splitext(out_path)[1]
+            audio_outputs_args.append((out_args, os.path.join(chunk_dir, self.AUDIO_NAME.format(m, ext))))
+        return audio_inputs, audio_outputs_args
+
+    def _encode_chunk(self, chunk: tuple) -> list:
+        n, chunk_inputs, chunk_outputs = chunk
+        exception = None
+        for attempt in range(self.CHUNK_RETRIES + 1):
+            if attempt:
+                logging.warning('Retrying chunk {} (attempt {})'.format(n, attempt + 1))
+            try:
+                reports = self._ffmpeg_cmd.exec(
+                    [(list(a), u) for a, u in chunk_inputs], [(list(a), p) for a, p in chunk_outputs], False,
+                    use_store=False
+                )
+                return [r.out_path for r in reports]
+            except FFmpegProcessException as e:
+                exception = e
+                for a, p in chunk_outputs:
+                    if os.path.exists(p):
+                        os.remove(p)
+        raise SegmentedEncodingException('Chunk {} failed after {} attempts'.format(
+            n, self.CHUNK_RETRIES + 1)) from exception
+
+    @classmethod
+    def get_mux_args(cls, out_args: list) -> list:
+        mux_args = []
+        n = 0
+        while n < len(out_args) - 1:
+            if out_args[n].split(':')[0] in cls.MUX_OPTIONS:
+                mux_args.extend(out_args[n:n + 2])
+                n += 2
+            else:
+                n += 1
+        return mux_args
+
+    @staticmethod
+    def _write_concat_list(list_path: str, chunk_paths: list) -> None:
+        with open(list_path, 'w') as f:
+            for p in chunk_paths:
+                f.write("file '{}'\n".format(p.replace("'", "'\\''")))
+
+    def encode(self, input_url: str, profile: FFmpegProfile, output_dir: str, input_urls: list=None) -> list:
+        inputs, outputs = profile.get_exec_args([input_url] + (input_urls or []), output_dir)
+        for out_args, out_path in outputs:
+            if os.path.exists(out_path):
+                msg = 'Output file "{}" already exists'.format(out_path)
+                logging.error(msg)
+                raise FFmpegOutputAlreadyExistsException(msg)
+        result_key = self._ffmpeg_cmd.get_result_key(inputs, outputs)
+        reports = self._ffmpeg_cmd.load_result(result_key, [p for a, p in outputs])
+        if reports is not None:
+            return reports
+        duration, start_time, has_audio = self._probe_input(input_url)
+        segments = self.get_segments(input_url, duration, start_time) if duration else [(0.0, None)]
+        if len(segments) < 2:
+            logging.info('Input is too short for segmented encoding - encoding in one pass')
+            reports = self._ffmpeg_cmd.exec(inputs, outputs, False, use_store=False)
+            return self._ffmpeg_cmd.save_result(result_key, reports)
+
+        logging.info('Encoding "{}" in {} segments with {} workers'.format(input_url, len(segments), self._max_workers))
+        video_outputs = [m for m, (a, p) in enumerate(outputs) if '-vn' not in a]
+        audio_outputs = [m for m, (a, p) in enumerate(outputs) if has_audio and '-an' not in a]
+        chunk_dir = tempfile.mkdtemp(prefix='segments_', dir=self._work_dir)
+        try:
+            chunks = []
+            if audio_outputs:
+                logging.debug('Encoding audio of outputs {} in one pass'.format(audio_outputs))
+                chunks.append((self.AUDIO_JOB, ) + self._build_audio(
+                    inputs, outputs, video_outputs, audio_outputs, chunk_dir
+                ))
+            if video_outputs:
+                chunks.extend((n, ) + self._build_chunk(n, s, inputs, outputs, video_outputs, audio_outputs, chunk_dir)
+                              for n, s in enumerate(segments))
+            chunk_paths = {}
+            failed = []
+            for chunk, result, exception in bounded_imap_unordered(self._encode_chunk, chunks, self._max_workers):
+                if exception is not None:
+                    logging.error(str(exception))
+                    failed.append(exception)
+                else:
+                    chunk_paths[chunk[0]] = result
+            if failed:
+                raise SegmentedEncodingException('{} of {} chunks failed'.format(len(failed), len(chunks))) \
+                    from failed[0]
+
+            logging.info('Joining chunks...')
+            reports = []
+            for m, (out_args, out_path) in enumerate(outputs):
+                join_inputs = []
+                join_args = list(self.CONCAT_OUTPUT_ARGS)
+                if m in video_outputs:
+                    list_path = os.path.join(chunk_dir, 'concat_{}.txt'.format(m))
+                    k = video_outputs.index(m)
+                    self._write_concat_list(list_path, [chunk_paths[n][k] for n in range(len(segments))])
+                    join_inputs.append((list(self.CONCAT_INPUT_ARGS), list_path))
+                if m in audio_outputs:
+                    join_inputs.append(([], chunk_paths[self.AUDIO_JOB][audio_outputs.index(m)]))
+                    if len(join_inputs) > 1:
+                        join_args.extend(self.AUDIO_JOIN_ARGS)
+                join_args.extend(self.get_mux_args(out_args))
+                reports.extend(self._ffmpeg_cmd.exec(join_inputs, [(join_args, out_path)], False, use_store=False))
+        finally:
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+        return self._ffmpeg_cmd.save_result(result_key, reports)
@@ -0,0 +1,232 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from _common import ROOT_DIR, import_module  # noqa: E402
+
+cache = import_module('cache')
+factory = import_module('factory')
+resumable = import_module('resumable')
+exceptions = import_module('exceptions')
+
+STUB_DIR = os.path.join(ROOT_DIR, 'benchmarks', 'stubs')
+
+FRAME_RATE = 25
+
+DURATION = 300
+
+SEGMENT_DURATION = 60.0
+
+OUT_ARGS = ['-c:v', 'libx264']
+
+
+class FFmpegSpy:
+
+    def __init__(self, cmd):
+        self._exec = cmd.exec
+        self.seeks = []
+        self.joins = []
+        self.interrupt_attempt = False
+        self.interrupt_join = None
+
+    @staticmethod
+    def _read_concat_list(list_path: str) -> list:
+        with open(list_path) as f:
+            return [os.path.basename(line.strip()[len("file '"):-1]) for line in f if line.strip()]
+
+    def exec(self, inputs: list, outputs: list, simulate: bool, **kwargs):
+        in_args, in_url = inputs[0]
+        if 'concat' in in_args:
+            self.joins.append((outputs[0][1], self._read_concat_list(in_url)))
+            if self.interrupt_join == len(self.joins):
+                raise KeyboardInterrupt
+        else:
+            self.seeks.append(float(in_args[in_args.index('-ss') + 1]) if '-ss' in in_args else 0.0)
+        try:
+            return self._exec(inputs, outputs, simulate, **kwargs)
+        except exceptions.FFmpegProcessException:
+            if self.interrupt_attempt:
+                raise KeyboardInterrupt
+            raise
+
+
+@pytest.fixture
+def env(tmp_path, monkeypatch):
+    tmp_dir = tmp_path / 'tmp'
+    tmp_dir.mkdir()
+    monkeypatch.setattr(cache, '_cache_manager', cache.CacheManager())
+    monkeypatch.setattr(resumable, 'ffmpeg_factory', factory.FFmpegFactory(
+        os.path.join(STUB_DIR, 'ffmpeg'), str(tmp_dir)
+    ))
+    monkeypatch.setattr(resumable, 'ffprobe_factory', factory.FFprobeFactory(os.path.join(STUB_DIR, 'ffprobe')))
+    monkeypatch.setenv('PYFF_STUB_FRAMES', str(DURATION * FRAME_RATE))
+    for name in ('PYFF_STUB_FAIL_AT', 'PYFF_STUB_FAIL_ONCE', 'PYFF_STUB_EXIT', 'PYFF_STUB_LATENCY'):
+        monkeypatch.delenv(name, raising=False)
+    return tmp_path
+
+
+def make_input(path, fixture: str='hd_tff_mxf') -> str:
+    path.write_text(json.dumps({'fixture': fixture}))
+    return str(path)
+
+
+def make_encoder(env, monkeypatch, max_attempts: int=None) -> tuple:
+    encoder = resumable.FFmpegResumableEncoder(
+        str(env / 'work'), segment_duration=SEGMENT_DURATION, max_attempts=max_attempts
+    )
+    spy = FFmpegSpy(encoder._ffmpeg_cmd)
+    monkeypatch.setattr(encoder._ffmpeg_cmd, 'exec', spy.exec)
+    return encoder, spy
+
+
+def fail_once_at(env, monkeypatch, fail_at: float) -> None:
+    flag = env / 'fail_once'
+    flag.touch()
+    monkeypatch.setenv('PYFF_STUB_FAIL_AT', str(fail_at))
+    monkeypatch.setenv('PYFF_STUB_FAIL_ONCE', str(flag))
+
+
+def load_journal(job_dir: str) -> dict:
+    with open(os.path.join(job_dir, resumable.FFmpegResumableEncoder.JOURNAL_NAME)) as f:
+        return json.load(f)
+
+
+def segment_names(output: int, count: int) -> list:
+    return ['out{}_{:05d}.mkv'.format(output, n) for n in range(count)]
+
+
+def test_interrupted_attempt_resumes_from_last_complete_segment(env, monkeypatch):
+    encoder, spy = make_encoder(env, monkeypatch)
+    inputs = [([], make_input(env / 'in.json'))]
+    outputs = [(OUT_ARGS, str(env / 'out.mp4'))]
+    job_dir = encoder.get_job_dir(inputs, outputs)
+    fail_once_at(env, monkeypatch, 130)
+    spy.interrupt_attempt = True
+    with pytest.raises(KeyboardInterrupt):
+        encoder.exec(inputs, outputs)
+    journal = load_journal(job_dir)
+    assert journal['running'] == {'attempt': 0, 'offset': 0.0}
+    assert journal['segments'] == [[]]
+
+    spy.interrupt_attempt = False
+    reports = encoder.exec(inputs, outputs)
+    assert spy.seeks == [0.0, 120.0]
+    assert spy.joins == [(outputs[0][1], segment_names(0, 5))]
+    assert [r.out_path for r in reports] == [outputs[0][1]]
+    assert os.path.isfile(outputs[0][1])
+    assert not os.path.exists(job_dir)
+
+
+def test_failed_attempts_keep_segments_for_next_run(env, monkeypatch):
+    encoder, spy = make_encoder(env, monkeypatch, max_attempts=2)
+    inputs = [([], make_input(env / 'in.json'))]
+    outputs = [(OUT_ARGS, str(env / 'out.mp4'))]
+    job_dir = encoder.get_job_dir(inputs, outputs)
+    monkeypatch.setenv('PYFF_STUB_FAIL_AT', '130')
+    with pytest.raises(exceptions.ResumableEncodingException):
+        encoder.exec(inputs, outputs)
+    assert spy.seeks == [0.0, 120.0]
+    journal = load_journal(job_dir)
+    assert journal['running'] is None
+    assert journal['attempts'] == 2
+    assert [s['name'] for s in journal['segments'][0]] == segment_names(0, 2)
+    assert not os.path.exists(outputs[0][1])
+
+    monkeypatch.delenv('PYFF_STUB_FAIL_AT')
+    encoder.exec(inputs, outputs)
+    assert spy.seeks == [0.0, 120.0, 120.0]
+    assert spy.joins == [(outputs[0][1], segment_names(0, 5))]
+
+
+def test_damaged_middle_segment_is_encoded_again(env, monkeypatch):
+    encoder, spy = make_encoder(env, monkeypatch)
+    inputs = [([], make_input(env / 'in.json'))]
+    outputs = [(OUT_ARGS, str(env / 'out.mp4'))]
+    job_dir = encoder.get_job_dir(inputs, outputs)
+    fail_once_at(env, monkeypatch, 250)
+    spy.interrupt_attempt = True
+    with pytest.raises(KeyboardInterrupt):
+        encoder.exec(inputs, outputs)
+    with open(os.path.join(job_dir, 'out0_00001.mkv'), 'w') as f:
+        f.write('{"fixture": ')
+
+    spy.interrupt_attempt = False
+    encoder.exec(inputs, outputs)
+    assert spy.seeks == [0.0, 60.0]
+    assert spy.joins == [(outputs[0][1], segment_names(0, 5))]
+
+
+def test_changed_segment_trims_every_output(env, monkeypatch):
+    encoder, spy = make_encoder(env, monkeypatch, max_attempts=1)
+    inputs = [([], make_input(env / 'in.json'))]
+    outputs = [(OUT_ARGS, str(env / 'out0.mp4')), (OUT_ARGS, str(env / 'out1.mp4'))]
+    job_dir = encoder.get_job_dir(inputs, outputs)
+    monkeypatch.setenv('PYFF_STUB_FAIL_AT', '250')
+    with pytest.raises(exceptions.ResumableEncodingException):
+        encoder.exec(inputs, outputs)
+    journal = load_journal(job_dir)
+    assert [len(segments) for segments in journal['segments']] == [4, 4]
+    with open(os.path.join(job_dir, 'out1_00001.mkv'), 'a') as f:
+        f.write(' ')
+
+    journal = load_journal(job_dir)
+    assert encoder._get_resume_point(job_dir, journal) == 60.0
+    assert [[s['name'] for s in segments] for segments in journal['segments']] == \
+        [segment_names(0, 1), segment_names(1, 1)]
+    assert sorted(n for n in os.listdir(job_dir) if n.endswith('.mkv')) == ['out0_00000.mkv', 'out1_00000.mkv']
+
+    monkeypatch.delenv('PYFF_STUB_FAIL_AT')
+    encoder.exec(inputs, outputs)
+    assert spy.seeks == [0.0, 60.0]
+    assert spy.joins == [(outputs[0][1], segment_names(0, 5)), (outputs[1][1], segment_names(1, 5))]
+
+
+def test_changed_input_discards_journal(env, monkeypatch):
+    encoder, spy = make_encoder(env, monkeypatch, max_attempts=1)
+    in_path = env / 'in.json'
+    inputs = [([], make_input(in_path))]
+    outputs = [(OUT_ARGS, str(env / 'out.mp4'))]
+    job_dir = encoder.get_job_dir(inputs, outputs)
+    monkeypatch.setenv('PYFF_STUB_FAIL_AT', '130')
+    with pytest.raises(exceptions.ResumableEncodingException):
+        encoder.exec(inputs, outputs)
+    assert load_journal(job_dir)['segments'][0]
+    stale_segment = os.path.join(job_dir, 'out0_00000.mkv')
+    assert os.path.isfile(stale_segment)
+
+    in_path.write_text(json.dumps({'fixture': 'hd_tff_mxf', 'duration': DURATION}))
+    journal = encoder._load_journal(job_dir, inputs, outputs)
+    assert journal['attempts'] == 0
+    assert journal['segments'] == [[]]
+    assert not os.path.exists(stale_segment)
+    assert load_journal(job_dir)['inputs'] == [[inputs[0][1], encoder._get_signature(inputs[0][1])]]
+
+    monkeypatch.delenv('PYFF_STUB_FAIL_AT')
+    encoder.exec(inputs, outputs)
+    assert spy.seeks == [0.0, 0.0]
+    assert spy.joins == [(outputs[0][1], segment_names(0, 5))]
+
+
+def test_interrupted_join_keeps_joined_outputs(env, monkeypatch):
+    encoder, spy = make_encoder(env, monkeypatch)
+    inputs = [([], make_input(env / 'in.json'))]
+    outputs = [(OUT_ARGS, str(env / 'out0.mp4')), (OUT_ARGS, str(env / 'out1.mp4'))]
+    job_dir = encoder.get_job_dir(inputs, outputs)
+    spy.interrupt_join = 2
+    with pytest.raises(KeyboardInterrupt):
+        encoder.exec(inputs, outputs)
+    assert load_journal(job_dir)['joined'] == [0]
+    joined = os.stat(outputs[0][1])
+    assert not os.path.exists(outputs[1][1])
+
+    spy.interrupt_join = None
+    encoder.exec(inputs, outputs)
+    assert spy.seeks == [0.0]
+    assert [p for p, names in spy.joins] == [outputs[0][1], outputs[1][1], outputs[1][1]]
+    assert os.stat(outputs[0][1]).st_ino == joined.st_ino
+    assert os.path.isfile(outputs[1][1])
+    assert not os.path.exists(job_dir)